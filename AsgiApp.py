@@ -0,0 +1,270 @@
+# AsgiApp.py
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from FlaskApp import FlaskApp, SESSION_TIMEOUT_SECONDS, CLEANUP_INTERVAL_SECONDS, PORT
+from BackendRoutes import PREGENERATED_DATA, parse_chunk_size, garbage_headers, empty_headers, client_ip_from, transfer_stats
+from Routes import live_location_payload, LIVE_STREAM_HEARTBEAT_SECONDS, LIVE_STREAM_RETRY_MS
+
+# --- ASGI Configuration ---
+ASGI_STREAM_POLL_SECONDS = 0.25 # How often live location streams check the SQLite session store, the memory one pushes changes
+ASGI_MAX_LIVE_STREAMS = 10000 # Streams are coroutines here, so the cap is much higher than MAX_LIVE_STREAMS
+ASGI_WSGI_THREADS = int(os.getenv("ASGI_WSGI_THREADS", "32")) # Flask requests handled at once behind the ASGI app
+LIVE_STREAM_PREFIX = "/live-location-stream/"
+# --- End ASGI Configuration ---
+
+
+def encode_headers(headers):
+    return [(name.lower().encode("latin-1"), str(value).encode("latin-1")) for name, value in headers]
+
+def asgi_client_ip(scope):
+    """get_client_ip for an ASGI scope. Werkzeug looks up HTTP_CLIENT_IP as the Http-Client-Ip header."""
+    headers = {name.decode("latin-1"): value.decode("latin-1") for name, value in scope.get("headers", [])}
+    client = scope.get("client")
+    return client_ip_from(lambda name: headers.get(name.lower().replace("_", "-")), client[0] if client else None)
+
+
+class PooledWsgiToAsgiInstance(WsgiToAsgiInstance):
+    """
+    asgiref runs run_wsgi_app thread-sensitively, i.e. every request on the same single thread.
+    This overrides it to run the WSGI app on the given executor instead, using only the public
+    pieces of WsgiToAsgiInstance (build_environ, start_response and the scope and sync_send that
+    __call__ sets up) rather than asgiref's own wrapped function.
+    """
+    def __init__(self, wsgi_application, executor, duplicate_header_limit=100):
+        super().__init__(wsgi_application, duplicate_header_limit)
+        self.executor = executor
+
+    async def run_wsgi_app(self, body):
+        await sync_to_async(self.run_wsgi_app_sync, thread_sensitive=False, executor=self.executor)(body)
+
+    def run_wsgi_app_sync(self, body):
+        """Runs the WSGI app on a pool thread, start_response included, and sends its response."""
+        try:
+            environ = self.build_environ(self.scope, body)
+        except ValueError: # Too many duplicate headers
+            self.sync_send({"type": "http.response.start", "status": 400, "headers": [(b"content-type", b"text/plain")]})
+            self.sync_send({"type": "http.response.body", "body": b"Bad Request: Too many duplicate headers"})
+            return
+        bytes_sent = 0
+        output = self.wsgi_application(environ, self.start_response)
+        try:
+            for chunk in output:
+                if not self.response_started:
+                    self.response_started = True # start_response refuses to be called again now
+                    self.sync_send(self.response_start)
+                if self.response_content_length is not None:
+                    # Never send more than the Content-Length the app announced
+                    chunk = chunk[:self.response_content_length - bytes_sent]
+                self.sync_send({"type": "http.response.body", "body": chunk, "more_body": True})
+                bytes_sent += len(chunk)
+                if bytes_sent == self.response_content_length:
+                    break
+        finally:
+            if hasattr(output, "close"):
+                output.close() # PEP 3333: the server closes the iterable the app returned
+        if not self.response_started:
+            self.response_started = True
+            self.sync_send(self.response_start)
+        self.sync_send({"type": "http.response.body"})
+
+
+class PooledWsgiToAsgi(WsgiToAsgi):
+    """asgiref's WSGI adapter, running the WSGI app on a pool of threads so requests are served concurrently."""
+    def __init__(self, wsgi_application, threads=ASGI_WSGI_THREADS):
+        super().__init__(wsgi_application)
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="wsgi")
+
+    async def __call__(self, scope, receive, send):
+        await PooledWsgiToAsgiInstance(self.wsgi_application, self.executor, self.duplicate_header_limit)(scope, receive, send)
+
+
+class AsgiApp:
+    """
+    ASGI entry point. The long-lived endpoints (/backend/garbage, /backend/empty and
+    /live-location-stream/<session_id>) are served as coroutines on the event loop, so an open
+    transfer or stream does not hold an OS thread. Every other route goes to the Flask app
+    through asgiref's WSGI adapter on ASGI_WSGI_THREADS threads, so URLs and responses stay the
+    same as under FlaskApp.run().
+    """
+    def __init__(self, flask_app=None):
+        self.flask_app = FlaskApp() if flask_app is None else flask_app
+        self.sessions = self.flask_app.routes_instance.sessions
+        self.wsgi = PooledWsgiToAsgi(self.flask_app.app)
+        self.live_streams = 0
+        self.cleanup_task = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return # No websocket routes
+        path = scope["path"]
+        method = scope["method"]
+        if path == "/backend/garbage" and method == "GET":
+            await self.garbage(scope, send)
+        elif path == "/backend/empty" and method in ("GET", "POST"):
+            await self.empty(scope, receive, send)
+        elif path.startswith(LIVE_STREAM_PREFIX) and method == "GET" and "/" not in path[len(LIVE_STREAM_PREFIX):]:
+            await self.live_location_stream(path[len(LIVE_STREAM_PREFIX):], receive, send)
+        else:
+            await self.wsgi(scope, receive, send)
+
+    # --- Lifespan ---
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.cleanup_task = asyncio.create_task(self.run_cleanup_loop())
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.cleanup_task is not None:
+                    self.cleanup_task.cancel()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def run_cleanup_loop(self):
+        """Same job as FlaskApp.run_cleanup_loop, scheduled on the event loop."""
+        while True:
+            await asyncio.sleep(CLEANUP_INTERVAL_SECONDS)
+            try:
+                # Expiry may touch the SQLite session file, keep it off the event loop
+                await asyncio.to_thread(self.flask_app.routes_instance.cleanup_inactive_sessions, SESSION_TIMEOUT_SECONDS)
+            except Exception as e:
+                print(f"Error during session cleanup: {e}")
+
+    # --- Speed Test Endpoints ---
+    async def garbage(self, scope, send):
+        query = parse_qs(scope["query_string"].decode("latin-1"), keep_blank_values=True)
+        ck_size = parse_chunk_size(query.get("ckSize", ["4"])[0])
+        headers = garbage_headers(ck_size, "cors" in query)
+        await send({"type": "http.response.start", "status": 200, "headers": encode_headers(headers.items())})
+        # The server applies backpressure in send(), so only one chunk is in flight per transfer
+        started = time.perf_counter()
+        sent = 0
+        try:
+            for i in range(ck_size):
+                await send({"type": "http.response.body", "body": PREGENERATED_DATA, "more_body": i < ck_size - 1})
+                sent += len(PREGENERATED_DATA)
+        finally:
+            test_id = query.get("test_id", [None])[0]
+            transfer_stats.record(asgi_client_ip(scope), test_id, "download", sent, started, time.perf_counter())
+
+    async def empty(self, scope, receive, send):
+        # Upload test: read and drop the request body chunk by chunk
+        query = parse_qs(scope["query_string"].decode("latin-1"), keep_blank_values=True)
+        started = time.perf_counter()
+        received = 0
+        try:
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    return # LibreSpeed aborts uploads when its test time is up, the bytes still count
+                received += len(message.get("body", b""))
+                if not message.get("more_body", False):
+                    break
+        finally:
+            if scope["method"] == "POST":
+                test_id = query.get("test_id", [None])[0]
+                transfer_stats.record(asgi_client_ip(scope), test_id, "upload", received, started, time.perf_counter())
+        headers = [("Content-Type", "text/html; charset=utf-8"), ("Content-Length", "0")]
+        headers += empty_headers("cors" in query)
+        await send({"type": "http.response.start", "status": 200, "headers": encode_headers(headers)})
+        await send({"type": "http.response.body", "body": b""})
+
+    # --- Live Location Stream ---
+    async def live_location_stream(self, session_id, receive, send, heartbeat_seconds=LIVE_STREAM_HEARTBEAT_SECONDS):
+        """
+        Same events as Routes.stream_live_location. The in-memory session store pushes the
+        session's changes to the stream through a listener, so an idle stream costs nothing until
+        its session moves or a heartbeat is due. The SQLite store cannot see other processes'
+        writes as they happen, so it is polled every ASGI_STREAM_POLL_SECONDS.
+        """
+        if self.live_streams >= ASGI_MAX_LIVE_STREAMS:
+            body = json.dumps({"error": "Too many live location streams, poll /get-live-location instead"}).encode()
+            headers = [("Content-Type", "application/json"), ("Retry-After", str(LIVE_STREAM_RETRY_MS // 1000))]
+            await send({"type": "http.response.start", "status": 503, "headers": encode_headers(headers)})
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        self.live_streams += 1
+        disconnected = asyncio.create_task(self.wait_for_disconnect(receive))
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+        latest = {}
+        def deliver(location):
+            latest["location"] = location
+            changed.set()
+        def on_change(location): # Runs on the updating thread, under its stripe lock
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(deliver, location)
+        pushed = hasattr(self.sessions, "add_listener")
+        try:
+            headers = [("Content-Type", "text/event-stream; charset=utf-8"), ("Cache-Control", "no-cache"), ("X-Accel-Buffering", "no")]
+            await send({"type": "http.response.start", "status": 200, "headers": encode_headers(headers)})
+            await self.send_event(send, f"retry: {LIVE_STREAM_RETRY_MS}\n\n")
+            if pushed:
+                deliver(self.sessions.add_listener(session_id, on_change))
+            last_session_data = object() # Sentinel so the current state is always sent first
+            last_payload = None
+            next_heartbeat = loop.time() + heartbeat_seconds
+            while not disconnected.done():
+                if pushed:
+                    changed.clear()
+                    session_data = latest["location"]
+                else:
+                    # The SQLite session store reads a file, keep it off the event loop
+                    session_data = await asyncio.to_thread(self.sessions.get_location, session_id)
+                if session_data != last_session_data:
+                    last_session_data = session_data
+                    payload = live_location_payload(session_data)
+                    if payload != last_payload: # A new fix on the same pixel is not worth an event
+                        last_payload = payload
+                        await self.send_event(send, f"data: {json.dumps(payload)}\n\n")
+                        next_heartbeat = loop.time() + heartbeat_seconds
+                elif loop.time() >= next_heartbeat:
+                    await self.send_event(send, ": heartbeat\n\n")
+                    next_heartbeat = loop.time() + heartbeat_seconds
+                if pushed:
+                    change = asyncio.create_task(changed.wait())
+                    await asyncio.wait({disconnected, change}, timeout=max(0.0, next_heartbeat - loop.time()),
+                                       return_when=asyncio.FIRST_COMPLETED)
+                    change.cancel()
+                else:
+                    await asyncio.wait({disconnected}, timeout=ASGI_STREAM_POLL_SECONDS)
+        finally:
+            if pushed:
+                self.sessions.remove_listener(session_id, on_change)
+            disconnected.cancel()
+            self.live_streams -= 1
+
+    async def send_event(self, send, text):
+        await send({"type": "http.response.body", "body": text.encode(), "more_body": True})
+
+    async def wait_for_disconnect(self, receive):
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+
+def create_asgi_app():
+    """Factory for ASGI servers, e.g. `uvicorn --factory AsgiApp:create_asgi_app`."""
+    return AsgiApp()
+
+
+if __name__ == "__main__":
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit("The ASGI server needs uvicorn: pip install uvicorn")
+    ssl_options = {}
+    if os.path.exists("cert.pem") and os.path.exists("key.pem"):
+        ssl_options = {"ssl_certfile": "cert.pem", "ssl_keyfile": "key.pem"}
+    else:
+        print("\n*** Warning: cert.pem or key.pem not found. Running without HTTPS. ***\n")
+    uvicorn.run(create_asgi_app(), host="0.0.0.0", port=PORT, **ssl_options)
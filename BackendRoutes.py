@@ -1,21 +1,158 @@
 import os
 import json
-import requests
+import threading
+import time
+from collections import OrderedDict
 from flask import Blueprint, request, jsonify, Response, make_response
+from IspLookup import IspLookup
 
 backend_bp = Blueprint("backend_bp", __name__)
 
 # Pre-generate a buffer of random data (1 MB of random bytes).
 PREGENERATED_DATA = os.urandom(1024 * 1024)
 
-def get_client_ip():
+# --- Transfer Accounting Configuration ---
+UPLOAD_CHUNK_SIZE = 64 * 1024 # Upload bodies are read and dropped this many bytes at a time
+MAX_TRACKED_TESTS = 10000 # Per client/test transfer records kept, oldest dropped first
+# --- End Transfer Accounting Configuration ---
+
+class TransferStats:
+    """
+    Bounded table of what the server itself observed per (client ip, test id).
+    Parallel streams overlap, so throughput is bytes over the span from the first request's
+    start to the last request's end rather than over the summed request durations.
+    """
+    def __init__(self, max_tests=MAX_TRACKED_TESTS):
+        self.max_tests = max_tests
+        self.tests = OrderedDict() # {(client_ip, test_id): record}, least recently updated first
+        self.lock = threading.Lock()
+
+    def record(self, client_ip, test_id, direction, nbytes, started, finished):
+        """Adds one finished request ("upload" or "download") to its test's totals."""
+        key = (client_ip, test_id)
+        with self.lock:
+            record = self.tests.pop(key, None)
+            if record is None:
+                record = {}
+                if len(self.tests) >= self.max_tests:
+                    self.tests.popitem(last=False)
+            self.tests[key] = record
+            totals = record.setdefault(direction, {"bytes": 0, "requests": 0, "busy_seconds": 0.0,
+                                                   "first_start": started, "last_end": finished})
+            totals["bytes"] += nbytes
+            totals["requests"] += 1
+            totals["busy_seconds"] += finished - started
+            totals["first_start"] = min(totals["first_start"], started)
+            totals["last_end"] = max(totals["last_end"], finished)
+
+    def get(self, client_ip, test_id):
+        """Returns {direction: totals with seconds and mbps} for a test, or None if unknown."""
+        with self.lock:
+            record = self.tests.get((client_ip, test_id))
+            if record is None:
+                return None
+            result = {direction: dict(totals) for direction, totals in record.items()}
+        for totals in result.values():
+            totals["seconds"] = totals["last_end"] - totals["first_start"]
+            totals["mbps"] = totals["bytes"] * 8 / totals["seconds"] / 1e6 if totals["seconds"] > 0 else None
+        return result
+
+transfer_stats = TransferStats()
+
+# ISP names for /backend/getIP?isp, from ISP_PREFIX_FILE or cached ipinfo.io lookups
+isp_lookup = IspLookup.from_env()
+
+def discard_request_body(stream, chunk_size=UPLOAD_CHUNK_SIZE, on_close=None):
+    """
+    Reads a request body to the end into one reused buffer. Returns the number of bytes read.
+    on_close(nbytes, started, finished) is called when reading stops, also when the client
+    aborts the upload and the read raises, with nbytes counting what arrived until then.
+    """
+    buffer = bytearray(chunk_size)
+    started = time.perf_counter()
+    total = 0
+    readinto = getattr(stream, "readinto", None)
+    try:
+        while True:
+            if readinto is not None:
+                count = readinto(buffer)
+            else:
+                count = len(stream.read(chunk_size)) # Some servers' input streams only have read()
+            if not count:
+                return total
+            total += count
+    finally:
+        if on_close is not None:
+            on_close(total, started, time.perf_counter())
+
+def stream_garbage(ck_size, on_close=None):
+    """
+    Yields the pregenerated 1 MB buffer ck_size times without copying it.
+    on_close(nbytes, started, finished) is called when the server finishes or abandons the response,
+    with nbytes counting only the chunks the server had written before asking for the next one.
+    """
+    # WSGI servers only accept bytes, so the same bytes object is handed out
+    # every time. Memory per request stays constant whatever ck_size is.
+    chunk = PREGENERATED_DATA
+    started = time.perf_counter()
+    sent = 0
+    try:
+        for _ in range(ck_size):
+            yield chunk
+            sent += len(chunk) # Resumed, so the server has written the previous chunk
+    finally:
+        if on_close is not None:
+            on_close(sent, started, time.perf_counter())
+
+def parse_chunk_size(value):
+    # Mimic PHP default to 4 if invalid, and max 1024
+    try:
+        ckSize = int(value)
+        return max(1, min(ckSize, 1024))
+    except:
+        return 4
+
+def garbage_headers(ck_size, cors):
+    """Response headers for /backend/garbage, shared by the Flask route and the ASGI app."""
+    headers = {
+        "Content-Description": "File Transfer",
+        "Content-Type": "application/octet-stream",
+        "Content-Disposition": "attachment; filename=random.dat",
+        "Content-Transfer-Encoding": "binary",
+        "Cache-Control": "no-store, no-cache, must-revalidate, max-age=0, s-maxage=0",
+        "Pragma": "no-cache",
+        "Content-Length": str(len(PREGENERATED_DATA) * ck_size)
+    }
+    if cors:
+        headers["Access-Control-Allow-Origin"] = "*"
+        headers["Access-Control-Allow-Methods"] = "GET, POST"
+    return headers
+
+def empty_headers(cors):
+    """Response headers for /backend/empty as (name, value) pairs, Cache-Control is sent twice."""
+    headers = []
+    if cors:
+        headers.append(("Access-Control-Allow-Origin", "*"))
+        headers.append(("Access-Control-Allow-Methods", "GET, POST"))
+        headers.append(("Access-Control-Allow-Headers", "Content-Encoding, Content-Type"))
+    headers.append(("Cache-Control", "no-store, no-cache, must-revalidate, max-age=0, s-maxage=0"))
+    headers.append(("Cache-Control", "post-check=0, pre-check=0"))
+    headers.append(("Pragma", "no-cache"))
+    headers.append(("Connection", "keep-alive"))
+    return headers
+
+def client_ip_from(get_header, remote_addr):
+    """Client ip from a header getter and the peer address, shared by the Flask routes and the ASGI app."""
     return (
-        request.headers.get("HTTP_CLIENT_IP") or
-        request.headers.get("HTTP_X_REAL_IP") or
-        request.headers.get("HTTP_X_FORWARDED_FOR", "").split(",")[0] or
-        request.remote_addr or "0.0.0.0"
+        get_header("HTTP_CLIENT_IP") or
+        get_header("HTTP_X_REAL_IP") or
+        (get_header("HTTP_X_FORWARDED_FOR") or "").split(",")[0] or
+        remote_addr or "0.0.0.0"
     ).replace("::ffff:", "")
 
+def get_client_ip():
+    return client_ip_from(request.headers.get, request.remote_addr)
+
 @backend_bp.route("/backend/getIP", methods=["GET"])
 def get_ip():
     ip = get_client_ip()
@@ -28,20 +165,8 @@ def get_ip():
         if ip.startswith("127.") or ip.startswith("192.168.") or ip == "::1":
             isp_info = "localhost IPv4 access"
         else:
-            # Try ipinfo.io API (token optional via env var or config)
-            token = os.getenv("IPINFO_APIKEY")
-            if token:
-                try:
-                    res = requests.get(f"https://ipinfo.io/{ip}/json?token={token}", timeout=2)
-                    if res.ok:
-                        data = res.json()
-                        raw_info = data
-                        if "org" in data:
-                            isp_info = data["org"].replace("AS", "").strip()
-                        elif "asn" in data and "name" in data["asn"]:
-                            isp_info = data["asn"]["name"]
-                except:
-                    pass  # Fallback if API fails
+            # Offline prefix table, or ipinfo.io (token via IPINFO_APIKEY) behind a cache
+            isp_info, raw_info = isp_lookup.lookup(ip)
 
     processed_string = ip
     if isp_info:
@@ -67,44 +192,40 @@ def get_ip():
 
 @backend_bp.route("/backend/empty", methods=["GET", "POST"])
 def empty():
+    if request.method == "POST":
+        # Upload test: drop the body as it arrives and note what the server actually received,
+        # including the part of an upload LibreSpeed aborts when its test time is up
+        client_ip = get_client_ip()
+        test_id = request.args.get("test_id")
+        def record_upload(nbytes, started, finished):
+            transfer_stats.record(client_ip, test_id, "upload", nbytes, started, finished)
+        discard_request_body(request.stream, on_close=record_upload)
     response = make_response("", 200)
-    if "cors" in request.args:
-        response.headers["Access-Control-Allow-Origin"] = "*"
-        response.headers["Access-Control-Allow-Methods"] = "GET, POST"
-        response.headers["Access-Control-Allow-Headers"] = "Content-Encoding, Content-Type"
-
-    response.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0, s-maxage=0"
-    response.headers.add("Cache-Control", "post-check=0, pre-check=0")
-    response.headers["Pragma"] = "no-cache"
-    response.headers["Connection"] = "keep-alive"
+    for name, value in empty_headers("cors" in request.args):
+        response.headers.add(name, value)
     return response
 
 @backend_bp.route("/backend/garbage", methods=["GET"])
 def garbage():
-    # Mimic PHP default to 4 if invalid, and max 1024
-    try:
-        ckSize = int(request.args.get("ckSize", "4"))
-        ckSize = max(1, min(ckSize, 1024))
-    except:
-        ckSize = 4
-
-    chunk = PREGENERATED_DATA  # 1 MB
-    payload = chunk * ckSize
-    headers = {
-        "Content-Description": "File Transfer",
-        "Content-Type": "application/octet-stream",
-        "Content-Disposition": "attachment; filename=random.dat",
-        "Content-Transfer-Encoding": "binary",
-        "Cache-Control": "no-store, no-cache, must-revalidate, max-age=0, s-maxage=0",
-        "Pragma": "no-cache",
-        "Content-Length": str(len(payload))
-    }
-
-    if "cors" in request.args:
-        headers["Access-Control-Allow-Origin"] = "*"
-        headers["Access-Control-Allow-Methods"] = "GET, POST"
-
-    return Response(payload, headers=headers)
+    ckSize = parse_chunk_size(request.args.get("ckSize", "4"))
+    headers = garbage_headers(ckSize, "cors" in request.args)
+
+    # The response is iterated after the request context is gone, so look these up now
+    client_ip = get_client_ip()
+    test_id = request.args.get("test_id")
+    def record_download(nbytes, started, finished):
+        transfer_stats.record(client_ip, test_id, "download", nbytes, started, finished)
+
+    # Stream the shared buffer instead of building ckSize MB in memory
+    return Response(stream_garbage(ckSize, on_close=record_download), headers=headers, direct_passthrough=True)
+
+@backend_bp.route("/backend/transfer-stats", methods=["GET"])
+def get_transfer_stats():
+    # Server-observed totals for the calling client's test (?test_id=<id>)
+    stats = transfer_stats.get(get_client_ip(), request.args.get("test_id"))
+    if stats is None:
+        return jsonify({"error": "No transfers recorded for this test"}), 404
+    return jsonify(stats)
 
 @backend_bp.route("/results/telemetry", methods=["POST"])
 def save_telemetry():
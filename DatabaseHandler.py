@@ -1,23 +1,165 @@
 import os
 import django
 import sys
+import atexit
+import itertools
+import queue
+import threading
+import time
+from datetime import datetime, timezone
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "database"))
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "database.settings")
 django.setup()
 
-from myapp.models import Location, Internet
+from django.db import connection, connections, transaction, IntegrityError
+from django.db.models import F
+from myapp.models import Location, Internet, IdCounter, FIRST_ALLOCATED_ID
+from myapp.spatial import spatial_cell, covering_ranges
+
+# --- Write-Behind Configuration ---
+# Set DB_WRITE_BEHIND=1 to queue saves and write them in batches
+WRITE_BEHIND_ENABLED = os.getenv("DB_WRITE_BEHIND", "0") == "1"
+FLUSH_INTERVAL_MS = 200 # Flush at least this often while records are queued
+FLUSH_BATCH_SIZE = 500 # ...or as soon as this many records are queued
+MAX_QUEUE_SIZE = 10000 # Bound on queued records before saves start blocking
+ENQUEUE_TIMEOUT_SECONDS = 1.0 # Wait this long for space before writing directly
+# --- End Write-Behind Configuration ---
+
+# --- Test ID Allocation Configuration ---
+ID_BLOCK_SIZE = 100 # Test ids reserved from the database at a time, ids left in a block are skipped after a restart
+TEST_ID_COUNTER = "test_id" # IdCounter row the blocks are reserved from
+DATA_VERSION_COUNTER = "data_version" # IdCounter row bumped by every write, shared by all processes
+ROWS_REPLACED_COUNTER = "rows_replaced" # IdCounter row bumped when a retried save replaces a stored row
+# Columns a retried save replaces on the row already stored for an allocated test id
+REPLACED_FIELDS = {
+    Location: ("latitude", "longitude", "cell"),
+    Internet: ("download", "upload", "ping", "jitter", "measured_at"),
+}
+# --- End Test ID Allocation Configuration ---
+
+# Speed tests left-joined to their locations on the indexed unique_id column.
+# Only the columns get_data needs are selected, so no model instances are built.
+JOINED_COLUMNS_SQL = "SELECT i.unique_id, i.download, i.upload, i.ping, l.latitude, l.longitude, i.id, l.id"
+JOINED_DATA_SQL = f"""
+    {JOINED_COLUMNS_SQL}
+    FROM {Internet._meta.db_table} AS i
+    LEFT JOIN {Location._meta.db_table} AS l ON l.unique_id = i.unique_id
+    {{where}}
+    ORDER BY {{order_by}}
+"""
+
+# Pairs where either row is newer than a (speed test id, location id) cursor.
+# Each half walks one table's primary key range, so the cost follows the delta size
+# (CROSS JOIN makes SQLite keep the location table as the outer loop).
+JOINED_DATA_SINCE_SQL = f"""
+    {JOINED_COLUMNS_SQL}
+    FROM {Internet._meta.db_table} AS i
+    LEFT JOIN {Location._meta.db_table} AS l ON l.unique_id = i.unique_id
+    WHERE i.id > %s{{window}}
+    UNION ALL
+    {JOINED_COLUMNS_SQL}
+    FROM {Location._meta.db_table} AS l
+    CROSS JOIN {Internet._meta.db_table} AS i ON i.unique_id = l.unique_id
+    WHERE l.id > %s AND i.id <= %s{{window}}
+    ORDER BY 7, 8
+"""
+
+# Highest download speed among speed tests that have usable coordinates
+MAX_DOWNLOAD_SQL = f"""
+    SELECT MAX(i.download)
+    FROM {Internet._meta.db_table} AS i
+    JOIN {Location._meta.db_table} AS l ON l.unique_id = i.unique_id
+    WHERE l.latitude IS NOT NULL AND l.longitude IS NOT NULL{{window}}
+"""
+
+# Speed tests whose location lies in a bounding box. The OR of cell key ranges lets SQLite
+# range-scan the cell index once per covering cell range; the coordinate test drops the overscan.
+BBOX_DATA_SQL = f"""
+    {JOINED_COLUMNS_SQL}
+    FROM {Location._meta.db_table} AS l
+    CROSS JOIN {Internet._meta.db_table} AS i ON i.unique_id = l.unique_id
+    WHERE ({{cells}})
+    AND l.latitude BETWEEN %s AND %s AND l.longitude BETWEEN %s AND %s{{window}}
+    ORDER BY i.id, l.id
+"""
+
+def measured_at_window(start=None, end=None):
+    """
+    SQL conditions and params keeping speed tests (aliased i) measured between start and end,
+    unix seconds, both inclusive and optional. They compare the indexed measured_at column directly,
+    so SQLite can range-scan its index. Tests saved before measured_at existed never match.
+    Returns (conditions, params) with conditions like ["i.measured_at >= %s"].
+    """
+    conditions = []; params = []
+    for operator, value in ((">=", start), ("<=", end)):
+        if value is not None:
+            conditions.append(f"i.measured_at {operator} %s")
+            params.append(connection.ops.adapt_datetimefield_value(datetime.fromtimestamp(value, tz=timezone.utc)))
+    return conditions, params
+
+class IdAllocator:
+    """
+    Hands out unique test ids from blocks reserved with reserve_block(size) -> (start, end).
+    Within a block an id is one next() on an itertools.count, which is atomic under the GIL,
+    so allocation takes no lock. Only reserving the next block does, once per block_size ids.
+    Ids increase within a process. Processes allocate from their own blocks.
+    """
+    def __init__(self, reserve_block, block_size=ID_BLOCK_SIZE):
+        self.reserve_block = reserve_block
+        self.block_size = block_size
+        self.block = (iter(()), 0, None) # (counter, end, owning pid), empty until the first id
+        self.refill_lock = threading.Lock()
+
+    def next_id(self):
+        while True:
+            block = self.block
+            counter, end, pid = block
+            if pid == os.getpid(): # A forked child must not reuse its parent's block
+                value = next(counter, end)
+                if value < end:
+                    return value
+            with self.refill_lock:
+                if self.block is block: # Another thread may have refilled already
+                    start, end = self.reserve_block(self.block_size)
+                    self.block = (itertools.count(start), end, os.getpid())
+
 
 class DatabaseHandler:
-    def __init__(self):
-        print("Database Handler initilized")
-        
+    def __init__(self, write_behind=None, flush_interval_ms=FLUSH_INTERVAL_MS,
+                 flush_batch_size=FLUSH_BATCH_SIZE, max_queue_size=MAX_QUEUE_SIZE):
+        self.write_behind = WRITE_BEHIND_ENABLED if write_behind is None else write_behind
+        self.id_allocator = IdAllocator(self.reserve_id_block)
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.flush_batch_size = flush_batch_size
+        self.write_queue = None
+        self.writer_thread = None
+        self.stats_lock = threading.Lock()
+        self.write_stats = {
+            "flushes": 0,
+            "records_flushed": 0,
+            "flush_errors": 0,
+            "direct_writes": 0, # Saves written on the caller thread because the queue was full
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "total_flush_ms": 0.0,
+        }
+        if self.write_behind:
+            self.write_queue = queue.Queue(maxsize=max_queue_size)
+            self.writer_thread = threading.Thread(target=self._run_writer, daemon=True)
+            self.writer_thread.start()
+            atexit.register(self.close) # Flush whatever is still queued on shutdown
+        print("Database Handler initilized" + (" (write-behind)" if self.write_behind else ""))
+
     def save_location(self, latitude, longitude, unique_id):
         # Saves location data to the database
         try:
-            location = Location(latitude=latitude, longitude=longitude, unique_id=unique_id)
-            location.save()
+            location = Location(latitude=latitude, longitude=longitude, unique_id=unique_id,
+                                cell=spatial_cell(latitude, longitude))
+            if self._enqueue(location):
+                return
+            self._save_record(location)
             print(f"Saved location: Latitude {latitude}, Longitude {longitude}, ID {unique_id}")
         except Exception as e:
             print(f"Error saving location: {e}")
@@ -26,37 +168,318 @@ class DatabaseHandler:
         # Saves speed test to database
         try:
             internet = Internet(download=download, upload=upload, ping=ping, unique_id=unique_id)
-            internet.save()
+            if self._enqueue(internet):
+                return
+            self._save_record(internet)
             print(f"Saved speed test: {download} Mbps / {upload} Mbps / {ping} ms (ID: {unique_id})")
         except Exception as e:
             print(f"Error saving speed test: {e}")
 
-    def get_data(self):
-        #Fetch all data from the Internet and Location models
-        internet_data = Internet.objects.all() # Query all Internet entries
-        location_data = Location.objects.all() # Query all Location entries
+    def save_measurement(self, download, upload, ping, jitter, latitude, longitude, unique_id):
+        """
+        Saves a speed test and its location in one transaction, so neither row exists without
+        the other. Pass latitude/longitude as None to save the speed test alone.
+        Unlike the single-record saves, database errors are raised to the caller.
+        """
+        internet = Internet(download=download, upload=upload, ping=ping, jitter=jitter, unique_id=unique_id)
+        if latitude is None or longitude is None:
+            records = (internet,)
+        else:
+            records = (internet, Location(latitude=latitude, longitude=longitude, unique_id=unique_id,
+                                          cell=spatial_cell(latitude, longitude)))
+        if self._enqueue(records): # Queued together, so they land in the same flush
+            return
+        with transaction.atomic():
+            for record in records:
+                record.save()
+            self._bump_data_version()
+        print(f"Saved measurement: {download} Mbps / {upload} Mbps / {ping} ms at {latitude}, {longitude} (ID: {unique_id})")
+
+    def _save_record(self, record):
+        """
+        Inserts a location or speed test. A test id that already has one (a retried /save_location
+        or /submit-speed) gets its values replaced instead, since allocated ids allow only one row
+        of each kind.
+        """
+        try:
+            with transaction.atomic():
+                record.save(force_insert=True)
+                self._bump_data_version()
+        except IntegrityError:
+            model = type(record)
+            with transaction.atomic():
+                updated = model.objects.filter(unique_id=record.unique_id, unique_id__gte=FIRST_ALLOCATED_ID).update(
+                    **{field: getattr(record, field) for field in REPLACED_FIELDS[model]})
+                if not updated:
+                    raise
+                self._bump_data_version()
+                IdCounter.objects.filter(name=ROWS_REPLACED_COUNTER).update(next_id=F("next_id") + 1)
+
+    def allocate_test_id(self):
+        """Returns a test id no other process or earlier run has been given."""
+        return self.id_allocator.next_id()
+
+    def reserve_id_block(self, size):
+        """
+        Moves the persisted id counter forward by size in one transaction.
+        Returns (start, end): the ids start..end-1 now belong to the caller.
+        """
+        with transaction.atomic():
+            updated = IdCounter.objects.filter(name=TEST_ID_COUNTER).update(next_id=F("next_id") + size)
+            if not updated:
+                raise RuntimeError(f"No '{TEST_ID_COUNTER}' id counter, run 'python manage.py migrate'")
+            end = IdCounter.objects.values_list("next_id", flat=True).get(name=TEST_ID_COUNTER)
+        return end - size, end
+
+    def _bump_data_version(self):
+        # Called inside the write's transaction, so no process sees the new version before the new rows
+        IdCounter.objects.filter(name=DATA_VERSION_COUNTER).update(next_id=F("next_id") + 1)
+
+    def get_data_version(self):
+        """Returns a counter that changes whenever any process has written new data."""
+        version = IdCounter.objects.filter(name=DATA_VERSION_COUNTER).values_list("next_id", flat=True).first()
+        if version is None:
+            raise RuntimeError(f"No '{DATA_VERSION_COUNTER}' counter, run 'python manage.py migrate'")
+        return version
+
+    def get_rows_replaced(self):
+        """
+        Returns a counter that changes whenever a stored row was replaced in place. Those rows
+        keep their ids, so readers following new ids must start over when it moves.
+        """
+        count = IdCounter.objects.filter(name=ROWS_REPLACED_COUNTER).values_list("next_id", flat=True).first()
+        if count is None:
+            raise RuntimeError(f"No '{ROWS_REPLACED_COUNTER}' counter, run 'python manage.py migrate'")
+        return count
 
+    # --- Write-Behind Queue ---
+    def _enqueue(self, record):
+        """
+        Queues an unsaved model instance (or a tuple of them that must be written together) for the writer thread.
+        Blocks for up to ENQUEUE_TIMEOUT_SECONDS when the queue is full (backpressure).
+        Returns False if the caller should save the record itself.
+        """
+        if not self.write_behind or self.write_queue is None:
+            return False
+        try:
+            self.write_queue.put(record, timeout=ENQUEUE_TIMEOUT_SECONDS)
+            return True
+        except queue.Full:
+            with self.stats_lock:
+                self.write_stats["direct_writes"] += 1
+            return False
+
+    def _run_writer(self):
+        """Collects queued records and writes them in batches until closed."""
+        try:
+            while True:
+                batch = []
+                waiters = []
+                stop = False
+                item = self.write_queue.get() # Sleep until there is something to write
+                deadline = time.monotonic() + self.flush_interval
+                while True:
+                    if item is None:
+                        stop = True
+                    elif isinstance(item, threading.Event):
+                        waiters.append(item) # flush() marker, write immediately
+                    else:
+                        batch.append(item)
+                    if stop or waiters or len(batch) >= self.flush_batch_size:
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self.write_queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                if stop:
+                    # Drain everything queued before the stop marker
+                    while True:
+                        try:
+                            item = self.write_queue.get_nowait()
+                        except queue.Empty:
+                            break
+                        if isinstance(item, threading.Event):
+                            waiters.append(item)
+                        elif item is not None:
+                            batch.append(item)
+                self._write_batch(batch)
+                for waiter in waiters:
+                    waiter.set()
+                if stop:
+                    return
+        finally:
+            connections.close_all() # Release this thread's database connection
+
+    def _write_batch(self, batch):
+        """Writes a batch of records with bulk_create in a single transaction."""
+        if not batch:
+            return
+        records = [r for item in batch for r in (item if isinstance(item, tuple) else (item,))]
+        locations = [r for r in records if isinstance(r, Location)]
+        speed_tests = [r for r in records if isinstance(r, Internet)]
+        start = time.perf_counter()
+        try:
+            with transaction.atomic():
+                if locations:
+                    Location.objects.bulk_create(locations)
+                if speed_tests:
+                    Internet.objects.bulk_create(speed_tests)
+                self._bump_data_version()
+        except IntegrityError as e:
+            # A duplicate test id fails the whole bulk insert, so keep the rest by writing items one by one
+            print(f"Batch of {len(records)} queued records hit a constraint ({e}), writing items separately")
+            self._write_items(batch)
+            return
+        except Exception as e:
+            # Write what can still be written, only the items that fail on their own are lost
+            print(f"Error flushing {len(records)} queued records ({e}), writing items separately")
+            self._write_items(batch)
+            return
+        elapsed_ms = (time.perf_counter() - start) * 1000.0
+        with self.stats_lock:
+            self.write_stats["flushes"] += 1
+            self.write_stats["records_flushed"] += len(records)
+            self.write_stats["last_flush_ms"] = elapsed_ms
+            self.write_stats["max_flush_ms"] = max(self.write_stats["max_flush_ms"], elapsed_ms)
+            self.write_stats["total_flush_ms"] += elapsed_ms
+        print(f"Flushed {len(locations)} locations and {len(speed_tests)} speed tests in {elapsed_ms:.1f} ms")
+
+    def _write_items(self, batch):
+        """Writes each queued item (a record or a tuple of records) in its own transaction."""
+        for item in batch:
+            try:
+                if not isinstance(item, tuple):
+                    item.pk = None # bulk_create may have set it before the batch rolled back
+                    self._save_record(item) # A retried save replaces the queued-earlier one
+                    continue
+                with transaction.atomic():
+                    for record in (item if isinstance(item, tuple) else (item,)):
+                        record.pk = None # bulk_create may have set it before the batch rolled back
+                        record.save(force_insert=True)
+                    self._bump_data_version()
+            except Exception as e:
+                with self.stats_lock:
+                    self.write_stats["flush_errors"] += 1
+                print(f"Error writing queued record: {e}")
+
+    def flush(self, timeout=5.0):
+        """Writes everything queued so far. Returns True once it is in the database, False if timeout ran out first."""
+        if not self.write_behind or self.writer_thread is None or not self.writer_thread.is_alive():
+            return True
+        deadline = time.monotonic() + timeout
+        done = threading.Event()
+        try:
+            self.write_queue.put(done, timeout=timeout) # A full queue must not block the caller forever
+        except queue.Full:
+            return False
+        return done.wait(max(0.0, deadline - time.monotonic()))
+
+    def close(self, timeout=5.0):
+        """Flushes the queue and stops the writer thread. Returns False if it is still running after timeout."""
+        if self.writer_thread is None:
+            return True
+        if self.writer_thread.is_alive():
+            deadline = time.monotonic() + timeout
+            try:
+                self.write_queue.put(None, timeout=timeout)
+            except queue.Full:
+                print("Write-behind queue still full, writer thread not stopped")
+                return False
+            self.writer_thread.join(max(0.0, deadline - time.monotonic()))
+            if self.writer_thread.is_alive():
+                return False
+        self.writer_thread = None
+        return True
+
+    def get_write_stats(self):
+        """Returns queue depth and flush latency counters for the write-behind queue."""
+        with self.stats_lock:
+            stats = dict(self.write_stats)
+        stats["write_behind"] = self.write_behind
+        stats["queue_depth"] = self.write_queue.qsize() if self.write_queue is not None else 0
+        stats["queue_capacity"] = self.write_queue.maxsize if self.write_queue is not None else 0
+        stats["avg_flush_ms"] = stats["total_flush_ms"] / stats["flushes"] if stats["flushes"] else 0.0
+        return stats
+
+    def get_data(self, start=None, end=None):
+        # Join speed tests to their locations in one query, fetching plain tuples,
+        # optionally only tests measured between start and end (unix seconds)
+        conditions, params = measured_at_window(start, end)
+        if conditions:
+            # The unary + keeps SQLite from walking the whole table in id order to skip the sort,
+            # so it range-scans the measured_at index and sorts just the window
+            sql = JOINED_DATA_SQL.format(where="WHERE " + " AND ".join(conditions), order_by="+i.id, l.id")
+        else:
+            sql = JOINED_DATA_SQL.format(where="", order_by="i.id, l.id")
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+        return self._combine_rows(rows)
+
+    def get_data_since(self, internet_cursor, location_cursor, start=None, end=None):
+        """
+        Returns (combined_data, (internet_cursor, location_cursor)) for the speed test/location
+        pairs added after the given row ids. Pass (0, 0) to get everything.
+        The returned cursor is the position to pass in on the next call.
+        start/end limit the pairs to tests measured in that window, as in get_data.
+        """
+        conditions, params = measured_at_window(start, end)
+        window = "".join(" AND " + condition for condition in conditions)
+        with connection.cursor() as cursor:
+            cursor.execute(JOINED_DATA_SINCE_SQL.format(window=window),
+                           [internet_cursor, *params, location_cursor, internet_cursor, *params])
+            rows = cursor.fetchall()
+        for row in rows:
+            internet_cursor = max(internet_cursor, row[6])
+            if row[7] is not None:
+                location_cursor = max(location_cursor, row[7])
+        return self._combine_rows(rows), (internet_cursor, location_cursor)
+
+    def get_data_in_bbox(self, min_lat, min_lon, max_lat, max_lon, start=None, end=None):
+        """
+        Returns get_data style combined data for the speed tests located inside the bounding box
+        (edges included), optionally only those measured between start and end.
+        Only the index entries of the cells covering the box are read.
+        """
+        ranges = covering_ranges(min_lat, min_lon, max_lat, max_lon)
+        conditions, window_params = measured_at_window(start, end)
+        sql = BBOX_DATA_SQL.format(cells=" OR ".join("l.cell BETWEEN %s AND %s" for _ in ranges),
+                                   window="".join(" AND " + condition for condition in conditions))
+        params = [key for key_range in ranges for key in key_range]
+        params += [min_lat, max_lat, min_lon, max_lon, *window_params]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+        return self._combine_rows(rows)
+
+    def get_max_download(self, start=None, end=None):
+        """Returns the highest download speed with a stored location (in the window, if given), or None if there is none."""
+        conditions, params = measured_at_window(start, end)
+        window = "".join(" AND " + condition for condition in conditions)
+        with connection.cursor() as cursor:
+            cursor.execute(MAX_DOWNLOAD_SQL.format(window=window), params)
+            return cursor.fetchone()[0]
+
+    def _combine_rows(self, rows):
         # Dictionary to store the data based on the unique_id
         combined_data = {}
 
-        # Store Internet data in the dictionary using unique_id as key
-        for internet_entry in internet_data:
-            unique_id = internet_entry.unique_id
+        # Later rows win for repeated unique_ids, matching the query ordering
+        for unique_id, download, upload, ping, latitude, longitude, _, _ in rows:
             combined_data[unique_id] = {
-                'download': internet_entry.download,
-                'upload': internet_entry.upload,
-                'ping': internet_entry.ping,
+                'download': download,
+                'upload': upload,
+                'ping': ping,
                 'location': None # Placeholdder for location data
             }
-
-        # Store Location data in the dictionary using unique_id
-        for location_entry in location_data:
-            unique_id = location_entry.unique_id
-            if unique_id in combined_data:
+            if latitude is not None or longitude is not None:
                 #Add location data to corresponding unique_id
                 combined_data[unique_id]['location'] = {
-                    'latitude': location_entry.latitude,
-                    'longitude': location_entry.longitude
+                    'latitude': latitude,
+                    'longitude': longitude
                 }
         return combined_data
 
@@ -202,23 +202,35 @@
 
 
 # FlaskApp.py
+import argparse
+import os
 import threading
 import time # <-- Import time
 import logging # <-- Import logging
 import re # <-- Import re for parsing log messages
 from flask import Flask
 # from Routes import Routes # setup_routes returns the instance now
-from Routes import setup_routes # <-- Import setup_routes instead
+from Routes import setup_routes, live_stream_limit, MAX_LIVE_STREAMS # <-- Import setup_routes instead
 # from NgrokTunnel import NgrokTunnel # Keep if used
 # from EmailSender import EmailSender # Keep if used
 from DatabaseHandler import DatabaseHandler
 from BackendRoutes import backend_bp
+from SessionStore import create_session_store, SESSION_BACKEND
 
 # --- Configuration ---
 SESSION_TIMEOUT_SECONDS = 1800 # e.g., 30 minutes
 CLEANUP_INTERVAL_SECONDS = 300 # e.g., Check every 5 minutes
+PORT = 8000
 # --- End Configuration ---
 
+# --- Production Server Configuration ---
+# Used by `python FlaskApp.py --production` (requires gunicorn)
+PRODUCTION_WORKERS = int(os.getenv("FLASK_WORKERS", str(os.cpu_count() or 1))) # Worker processes
+PRODUCTION_THREADS = int(os.getenv("FLASK_WORKER_THREADS", "32")) # Concurrent requests per worker
+GRACEFUL_TIMEOUT_SECONDS = 30 # Time in-flight requests get to finish on restart/shutdown
+KEEPALIVE_SECONDS = 5
+# --- End Production Server Configuration ---
+
 # --- Logging Configuration ---
 class RequestPathFilter(logging.Filter):
     """A logging filter that blocks records for specific request paths."""
@@ -281,13 +293,14 @@ def configure_logging(app, paths_to_block):
 
 
 class FlaskApp:
-    def __init__(self):
+    def __init__(self, session_backend=None, max_live_streams=MAX_LIVE_STREAMS, check_speeds=True):
         self.app = Flask(__name__)
         # Configure logging before running the app
         # Pass only the base paths without '<...>' placeholders
         # UPDATED: Added /backend/garbage and /backend/empty
         configure_logging(self.app, [
             '/save_user_location',
+            '/save_user_location_batch',
             '/get-live-location',
             '/backend/garbage',
             '/backend/empty'
@@ -296,7 +309,8 @@ class FlaskApp:
         # self.tunnel = NgrokTunnel() # Keep if used
         # self.sender = EmailSender() # Keep if used
         # Use the setup_routes function which returns the Routes instance
-        self.routes_instance = setup_routes(self.app) # <-- Store the Routes instance
+        self.routes_instance = setup_routes(self.app, create_session_store(session_backend), max_live_streams, check_speeds) # <-- Store the Routes instance
+        self.app.register_blueprint(backend_bp)
 
     def run_cleanup_loop(self):
         """Periodically cleans up inactive sessions."""
@@ -310,11 +324,9 @@ class FlaskApp:
                 print(f"Error during session cleanup: {e}") # Log errors
 
     def run(self):
-        port = 8000
+        port = PORT
         # ... (ngrok/email code if used) ...
 
-        self.app.register_blueprint(backend_bp)
-
         # --- Start Cleanup Thread ---
         cleanup_thread = threading.Thread(target=self.run_cleanup_loop, daemon=True)
         cleanup_thread.start()
@@ -366,10 +378,8 @@ class FlaskApp:
 
                 if lat is not None and long is not None:
                      # Get timestamp too for display if desired
-                     with self.routes_instance.session_lock:
-                          # Ensure the session data has the expected structure (tuple of 3 elements)
-                          session_data = self.routes_instance.user_sessions.get(selected_sid)
-                          last_seen = session_data[2] if session_data and len(session_data) == 3 else 0
+                     session_data = self.routes_instance.sessions.get_location(selected_sid)
+                     last_seen = session_data[2] if session_data else 0
                      last_seen_str = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last_seen)) if last_seen else "N/A"
                      print(f"Session {selected_sid} -> Latitude: {lat}, Longitude: {long} (Last seen: {last_seen_str})")
                 else:
@@ -379,7 +389,102 @@ class FlaskApp:
                 print("Invalid input")
 
 
+def run_session_cleanup_loop(sessions):
+    """Expires inactive sessions in a shared session store. Runs in the production master process."""
+    print("Starting session cleanup thread in the master process...")
+    while True:
+        time.sleep(CLEANUP_INTERVAL_SECONDS)
+        try:
+            expired = sessions.expire(SESSION_TIMEOUT_SECONDS)
+            if expired:
+                print(f"Cleaning up inactive sessions: {expired}")
+        except Exception as e:
+            print(f"Error during session cleanup: {e}")
+
+def build_production_server(workers=PRODUCTION_WORKERS, threads=PRODUCTION_THREADS, session_backend=None):
+    """
+    Builds the gunicorn application for run_production without starting it.
+    With more than one worker, sessions must be shared, so the SQLite session backend is used.
+    Live location streams each hold one of a worker's `threads`, so at most half of them may stream.
+    Submitted speeds are only checked against the server's transfer totals with a single worker,
+    since each worker only counts the transfers it served itself.
+    """
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise SystemExit("Production mode needs gunicorn: pip install gunicorn")
+
+    session_backend = SESSION_BACKEND if session_backend is None else session_backend
+    if workers > 1 and session_backend == "memory":
+        print("More than one worker, switching sessions to the shared SQLite backend.")
+        session_backend = "sqlite"
+    max_live_streams = live_stream_limit(threads)
+    check_speeds = workers == 1
+    if not check_speeds:
+        print("More than one worker, submitted speeds are not checked against server transfer totals.")
+
+    def when_ready(server):
+        if session_backend != "memory":
+            sessions = create_session_store(session_backend)
+            threading.Thread(target=run_session_cleanup_loop, args=(sessions,), daemon=True).start()
+
+    def post_worker_init(worker):
+        if session_backend == "memory": # Only possible with a single worker
+            threading.Thread(target=worker.app.flask_app.run_cleanup_loop, daemon=True).start()
+
+    options = {
+        "bind": f"0.0.0.0:{PORT}",
+        "workers": workers,
+        "worker_class": "gthread",
+        "threads": threads,
+        "graceful_timeout": GRACEFUL_TIMEOUT_SECONDS,
+        "keepalive": KEEPALIVE_SECONDS,
+        "when_ready": when_ready,
+        "post_worker_init": post_worker_init,
+    }
+    if os.path.exists("cert.pem") and os.path.exists("key.pem"):
+        options.update({"certfile": "cert.pem", "keyfile": "key.pem"})
+    else:
+        print("\n*** Warning: cert.pem or key.pem not found. Running without HTTPS. ***\n")
+
+    class ProductionServer(BaseApplication):
+        def load_config(self):
+            self.session_backend = session_backend
+            self.max_live_streams = max_live_streams
+            self.check_speeds = check_speeds
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            # Runs in each worker after the fork, so every worker gets its own DB connections
+            self.flask_app = FlaskApp(session_backend, max_live_streams, check_speeds)
+            return self.flask_app.app
+
+    return ProductionServer()
+
+def run_production(workers=PRODUCTION_WORKERS, threads=PRODUCTION_THREADS, session_backend=None):
+    """
+    Serves the app with gunicorn: a master process owning the listening socket and `workers`
+    forked worker processes, each handling `threads` requests at a time.
+    SIGHUP restarts the workers gracefully, SIGTERM drains them and shuts down.
+    Session cleanup runs once: in the master for the shared backend, in the only worker otherwise.
+    """
+    server = build_production_server(workers, threads, session_backend)
+    print(f" * Production server starting on port {PORT} with {workers} workers x {threads} threads"
+          f" (up to {server.max_live_streams} live location streams per worker)")
+    server.run()
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="AccessPointer web server")
+    parser.add_argument("--production", action="store_true", help="serve with multiple gunicorn worker processes")
+    parser.add_argument("--workers", type=int, default=PRODUCTION_WORKERS, help="worker processes in production mode")
+    parser.add_argument("--threads", type=int, default=PRODUCTION_THREADS, help="request threads per worker in production mode")
+    args = parser.parse_args()
+    if args.production:
+        run_production(args.workers, args.threads)
+        raise SystemExit(0)
+
     flask_app = FlaskApp()
 
     # Start input listener in separate thread
@@ -0,0 +1,210 @@
+# IspLookup.py
+import ipaddress
+import os
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import requests
+from requests.adapters import HTTPAdapter
+
+# --- ISP Lookup Configuration ---
+ISP_CACHE_SIZE = 10000 # Client IPs whose ISP is remembered, least recently used dropped first
+ISP_CACHE_TTL_SECONDS = 6 * 60 * 60 # How long a successful ipinfo.io answer is reused
+ISP_NEGATIVE_TTL_SECONDS = 5 * 60 # How long a failed lookup is remembered before ipinfo.io is asked again
+ISP_LOOKUP_WAIT_SECONDS = 0.3 # A request waits this long for an uncached lookup, later requests get the cached answer
+ISP_LOOKUP_TIMEOUT_SECONDS = 2 # ipinfo.io request timeout, spent on a lookup thread instead of a request thread
+ISP_LOOKUP_WORKERS = 4 # Concurrent ipinfo.io requests (and pooled connections)
+# --- End ISP Lookup Configuration ---
+
+NO_ISP = (None, "") # (isp_info, raw_info) when nothing is known
+
+
+def isp_from_info(data):
+    """ISP string from an ipinfo.io style response, or None."""
+    if "org" in data:
+        return data["org"].replace("AS", "").strip()
+    if "asn" in data and "name" in data["asn"]:
+        return data["asn"]["name"]
+    return None
+
+
+class PrefixTrie:
+    """
+    Longest-prefix match from IP addresses to values, for IPv4 and IPv6 CIDR prefixes.
+    A binary radix trie with one address bit per level. The child links are array columns
+    (0 means no child, the roots are never children), so a large prefix table stays compact.
+    """
+    ROOTS = {4: 0, 6: 1}
+
+    def __init__(self):
+        self.zero = array("i", [0, 0])
+        self.one = array("i", [0, 0])
+        self.values = [None, None]
+        self.prefixes = 0
+
+    def insert(self, prefix, value):
+        """Stores value for a CIDR prefix such as "8.8.8.0/24". Raises ValueError for invalid prefixes."""
+        network = ipaddress.ip_network(prefix, strict=False)
+        bits = int(network.network_address)
+        node = self.ROOTS[network.version]
+        for shift in range(network.max_prefixlen - 1, network.max_prefixlen - network.prefixlen - 1, -1):
+            children = self.one if (bits >> shift) & 1 else self.zero
+            child = children[node]
+            if not child:
+                child = len(self.values)
+                self.zero.append(0); self.one.append(0); self.values.append(None)
+                children[node] = child
+            node = child
+        if self.values[node] is None:
+            self.prefixes += 1
+        self.values[node] = value
+
+    def lookup(self, ip):
+        """Value of the longest prefix containing ip, or None. Raises ValueError for invalid addresses."""
+        address = ipaddress.ip_address(ip)
+        bits = int(address)
+        node = self.ROOTS[address.version]
+        zero = self.zero; one = self.one; values = self.values
+        found = values[node]
+        for shift in range(address.max_prefixlen - 1, -1, -1):
+            node = one[node] if (bits >> shift) & 1 else zero[node]
+            if not node:
+                break
+            if values[node] is not None:
+                found = values[node]
+        return found
+
+    def __len__(self):
+        return self.prefixes
+
+
+def load_prefix_file(path):
+    """
+    Builds a PrefixTrie from a text file of "<cidr> <asn> <organisation name>" lines,
+    e.g. "8.8.8.0/24 AS15169 Google LLC". Blank lines and lines starting with # are ignored.
+    Values are ipinfo.io style dicts so they are processed like online answers.
+    """
+    trie = PrefixTrie()
+    with open(path, encoding="utf-8") as prefix_file:
+        for line_number, line in enumerate(prefix_file, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            parts = line.split(None, 2)
+            if len(parts) < 2:
+                raise ValueError(f"{path}:{line_number}: expected '<cidr> <asn> [name]'")
+            prefix, asn = parts[0], parts[1]
+            org = f"{asn} {parts[2]}" if len(parts) == 3 else asn
+            try:
+                trie.insert(prefix, {"network": prefix, "org": org})
+            except ValueError as e:
+                raise ValueError(f"{path}:{line_number}: {e}") from e
+    return trie
+
+
+class IspLookup:
+    """
+    ISP lookup for /backend/getIP?isp.
+    With a prefix table every lookup is answered offline from the trie. Otherwise, with an
+    ipinfo.io token, answers are kept in an LRU cache with a TTL (failures with a shorter one).
+    Uncached lookups run on a small thread pool over pooled connections, concurrent requests
+    for the same IP share one lookup, and a request only waits ISP_LOOKUP_WAIT_SECONDS for it.
+    """
+    def __init__(self, token=None, prefix_table=None, cache_size=ISP_CACHE_SIZE,
+                 ttl_seconds=ISP_CACHE_TTL_SECONDS, negative_ttl_seconds=ISP_NEGATIVE_TTL_SECONDS,
+                 wait_seconds=ISP_LOOKUP_WAIT_SECONDS, workers=ISP_LOOKUP_WORKERS):
+        self.token = token
+        self.prefix_table = prefix_table
+        self.cache_size = cache_size
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.wait_seconds = wait_seconds
+        self.workers = workers
+        self.cache = OrderedDict() # {ip: (expires_at, (isp_info, raw_info))}, least recently used first
+        self.pending = {} # {ip: Future} for lookups in flight
+        self.lock = threading.Lock()
+        self.executor = None # Created on first use, so forked server workers each get their own
+        self.session = None
+        self.stats = {"hits": 0, "misses": 0, "failures": 0, "timeouts": 0}
+
+    @classmethod
+    def from_env(cls):
+        """Uses ISP_PREFIX_FILE for offline lookups if set, otherwise IPINFO_APIKEY for ipinfo.io."""
+        path = os.getenv("ISP_PREFIX_FILE")
+        prefix_table = load_prefix_file(path) if path else None
+        return cls(token=os.getenv("IPINFO_APIKEY"), prefix_table=prefix_table)
+
+    def lookup(self, ip):
+        """Returns (isp_info, raw_info) for ip, NO_ISP if it is unknown or still being looked up."""
+        if self.prefix_table is not None:
+            try:
+                data = self.prefix_table.lookup(ip)
+            except ValueError:
+                return NO_ISP
+            return (isp_from_info(data), dict(data, ip=ip)) if data else NO_ISP
+        if not self.token:
+            return NO_ISP
+
+        now = time.monotonic()
+        with self.lock:
+            entry = self.cache.get(ip)
+            if entry is not None and entry[0] > now:
+                self.cache.move_to_end(ip)
+                self.stats["hits"] += 1
+                return entry[1]
+            self.stats["misses"] += 1
+            future = self.pending.get(ip)
+            if future is None:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="isp-lookup")
+                future = self.executor.submit(self._fetch_and_cache, ip)
+                self.pending[ip] = future
+        try:
+            return future.result(timeout=self.wait_seconds)
+        except FutureTimeoutError:
+            with self.lock:
+                self.stats["timeouts"] += 1
+            return NO_ISP # The lookup carries on and fills the cache for the next request
+
+    def _fetch_and_cache(self, ip):
+        result = NO_ISP
+        ttl = self.negative_ttl_seconds
+        try:
+            result = self._fetch(ip)
+            ttl = self.ttl_seconds
+        except Exception as e: # Any failure, e.g. an odd response shape, is remembered like a network error
+            print(f"ISP lookup for {ip} failed: {e}")
+            with self.lock:
+                self.stats["failures"] += 1
+        finally:
+            with self.lock:
+                self.cache.pop(ip, None)
+                if len(self.cache) >= self.cache_size:
+                    self.cache.popitem(last=False)
+                self.cache[ip] = (time.monotonic() + ttl, result)
+                self.pending.pop(ip, None) # Never leave a finished lookup behind for later requests to wait on
+        return result
+
+    def _fetch(self, ip):
+        """Asks ipinfo.io. Raises on network errors and unexpected responses."""
+        if self.session is None:
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=self.workers))
+            self.session = session
+        res = self.session.get(f"https://ipinfo.io/{ip}/json", params={"token": self.token}, timeout=ISP_LOOKUP_TIMEOUT_SECONDS)
+        res.raise_for_status()
+        data = res.json()
+        if not isinstance(data, dict):
+            raise ValueError("Unexpected ipinfo.io response")
+        return isp_from_info(data), data
+
+    def get_stats(self):
+        """Returns cache hit/miss counters and sizes."""
+        with self.lock:
+            stats = dict(self.stats)
+            stats["cached"] = len(self.cache)
+            stats["pending"] = len(self.pending)
+        stats["offline_prefixes"] = len(self.prefix_table) if self.prefix_table is not None else 0
+        return stats
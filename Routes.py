@@ -1,10 +1,17 @@
 # Routes.py (Complete - Handles Out-of-Bounds Live Location)
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response
 import uuid
-import random
+from django.db import close_old_connections
 from DatabaseHandler import DatabaseHandler # Assuming DatabaseHandler.py is accessible
+from SessionStore import create_session_store
+from BackendRoutes import transfer_stats, get_client_ip
+import os
 import threading
 import time
+import json
+import hashlib
+from datetime import datetime, timezone
+import numpy as np
 
 # --- Coordinate Mapping Section ---
 # --- UPDATED DIMENSIONS ---
@@ -12,69 +19,373 @@ IMAGE_WIDTH = 1003
 IMAGE_HEIGHT = 800
 # --- END UPDATED DIMENSIONS ---
 
-# Bounds derived from user-provided corner coordinates
-MIN_LAT = 43.037278
-MAX_LAT = 43.037944
-MIN_LON = -76.132944
-MAX_LON = -76.132194
+# Corner control points: ((latitude, longitude), (pixel x, pixel y)), from user-provided corner coordinates.
+# The image is rotated so North is on the left and West is at the bottom.
+# Any number (3 or more) of non-collinear points can be used; the affine fit is least squares.
+CONTROL_POINTS = [
+    ((43.037944, -76.132194), (0, 0)),                      # North-East corner -> top left
+    ((43.037278, -76.132194), (IMAGE_WIDTH, 0)),            # South-East corner -> top right
+    ((43.037944, -76.132944), (0, IMAGE_HEIGHT)),           # North-West corner -> bottom left
+    ((43.037278, -76.132944), (IMAGE_WIDTH, IMAGE_HEIGHT)), # South-West corner -> bottom right
+]
+BOUNDS_EPSILON_PX = 1e-3 # Tolerance in pixels for the in-bounds check
+
+def calibrate_affine(control_points):
+    """
+    Fits the affine transform [x, y] = matrix @ [lat - lat0, lon - lon0, 1] to the control points.
+    Coordinates are taken relative to their mean (lat0, lon0) to keep the fit well conditioned.
+    Returns (matrix, origin).
+    """
+    geo = np.array([point[0] for point in control_points], dtype=np.float64)
+    pixels = np.array([point[1] for point in control_points], dtype=np.float64)
+    origin = geo.mean(axis=0)
+    design = np.column_stack([geo - origin, np.ones(len(geo))])
+    solution, _, rank, _ = np.linalg.lstsq(design, pixels, rcond=None)
+    if rank < 3:
+        raise ValueError("Control points are collinear, cannot calibrate the map transform")
+    return solution.T, origin
+
+# Precomputed once at import, each mapping is then a single matrix product
+AFFINE_MATRIX, AFFINE_ORIGIN = calibrate_affine(CONTROL_POINTS)
+
+def to_float_array(values):
+    """Converts a sequence to a float64 array, with NaN for anything that is not a number."""
+    try:
+        return np.asarray(values, dtype=np.float64).reshape(-1)
+    except (ValueError, TypeError):
+        converted = np.full(len(values), np.nan)
+        for i, value in enumerate(values):
+            try:
+                converted[i] = float(value)
+            except (ValueError, TypeError):
+                pass
+        return converted
+
+def project_lat_lon_batch(latitudes, longitudes):
+    """
+    Applies the affine transform without clamping or rounding.
+    Returns (x, y, valid): float pixel arrays (0 where invalid) and the mask of numeric entries.
+    """
+    lat = to_float_array(latitudes)
+    lon = to_float_array(longitudes)
+    valid = np.isfinite(lat) & np.isfinite(lon)
+
+    geo = np.column_stack([lat - AFFINE_ORIGIN[0], lon - AFFINE_ORIGIN[1], np.ones(len(lat))])
+    pixels = geo @ AFFINE_MATRIX.T
+    return np.where(valid, pixels[:, 0], 0.0), np.where(valid, pixels[:, 1], 0.0), valid
+
+def map_pixels_to_lat_lon_batch(x_pixels, y_pixels):
+    """Inverse of the affine transform: image pixel coordinates to (latitudes, longitudes) arrays."""
+    pixels = np.column_stack([to_float_array(x_pixels), to_float_array(y_pixels)]) - AFFINE_MATRIX[:, 2]
+    geo = np.linalg.solve(AFFINE_MATRIX[:, :2], pixels.T).T + AFFINE_ORIGIN
+    return geo[:, 0], geo[:, 1]
+
+def map_lat_lon_batch(latitudes, longitudes):
+    """
+    Maps arrays of geographic coordinates to image pixel coordinates in one NumPy pass.
+    Points outside the image are clamped to the closest edge, like map_lat_lon_to_pixels.
+    Returns (x, y, in_bounds, valid): int pixel arrays plus boolean masks. Entries that are
+    not numbers have valid=False, in_bounds=False and x=y=0.
+    """
+    x_float, y_float, valid = project_lat_lon_batch(latitudes, longitudes)
+
+    in_bounds = (valid &
+                 (x_float >= -BOUNDS_EPSILON_PX) & (x_float <= IMAGE_WIDTH + BOUNDS_EPSILON_PX) &
+                 (y_float >= -BOUNDS_EPSILON_PX) & (y_float <= IMAGE_HEIGHT + BOUNDS_EPSILON_PX))
+
+    # Clamp to image edges - this finds the 'closest edge' point
+    x_pixels = np.clip(x_float, 0.0, IMAGE_WIDTH - 1).astype(np.int64)
+    y_pixels = np.clip(y_float, 0.0, IMAGE_HEIGHT - 1).astype(np.int64)
+    return x_pixels, y_pixels, in_bounds, valid
 
 def map_lat_lon_to_pixels(latitude, longitude):
     """
     Maps geographic coordinates to image pixel coordinates.
     Calculates mapping even if outside bounds and returns clamped coordinates
     along with an 'in_bounds' status.
-    Assumes West corresponds to the bottom of the image.
+    Thin wrapper around map_lat_lon_batch for single lookups such as /get-live-location.
     Returns (x, y, is_within_bounds) or (None, None, False) if conversion fails.
     """
-    try:
-        lat = float(latitude)
-        lon = float(longitude)
-        epsilon = 1e-9 # Tolerance for float comparison
+    x_pixels, y_pixels, in_bounds, valid = map_lat_lon_batch([latitude], [longitude])
+    if not valid[0]:
+        print(f"DEBUG: Error converting lat/lon ({latitude}, {longitude})")
+        return None, None, False # Indicate mapping failure
+    return int(x_pixels[0]), int(y_pixels[0]), bool(in_bounds[0])
+
+# --- End Coordinate Mapping Section ---
 
-        # Determine if the original point is within bounds BEFORE clamping
-        is_within_bounds = (MIN_LAT - epsilon <= lat <= MAX_LAT + epsilon and
-                            MIN_LON - epsilon <= lon <= MAX_LON + epsilon)
 
-        # Avoid division by zero if bounds are identical
-        if abs(MAX_LAT - MIN_LAT) < epsilon or abs(MAX_LON - MIN_LON) < epsilon:
-             print(f"DEBUG: Error - MIN/MAX Lat or Lon are too close, cannot map.")
-             return None, None, False # Indicate mapping failure
+# --- Heatmap Binning Section ---
+MAX_BIN_SIZE = max(IMAGE_WIDTH, IMAGE_HEIGHT) # One cell covering the whole image
 
-        # --- ROTATED MAPPING LOGIC (Calculate floats regardless of bounds) ---
-        # Uses the updated IMAGE_WIDTH and IMAGE_HEIGHT constants
-        x_pixel_float = ((MAX_LAT - lat) / (MAX_LAT - MIN_LAT)) * IMAGE_WIDTH
-        y_pixel_float = ((MAX_LON - lon) / (MAX_LON - MIN_LON)) * IMAGE_HEIGHT
-        # --- END ROTATED MAPPING LOGIC ---
+def bin_heatmap_points(x_pixels, y_pixels, values, cell_size):
+    """
+    Aggregates pixel points into square cells of cell_size pixels over the floor image.
+    Returns (center_x, center_y, mean, max, count) arrays for the occupied cells only.
+    """
+    x_pixels = np.asarray(x_pixels, dtype=np.int64)
+    y_pixels = np.asarray(y_pixels, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+
+    columns = -(-IMAGE_WIDTH // cell_size) # Ceiling division so edge pixels get a cell
+    rows = -(-IMAGE_HEIGHT // cell_size)
+    cell_count = columns * rows
+    cells = (y_pixels // cell_size) * columns + (x_pixels // cell_size)
+
+    counts = np.bincount(cells, minlength=cell_count)
+    sums = np.bincount(cells, weights=values, minlength=cell_count)
+    maxima = np.full(cell_count, -np.inf)
+    np.maximum.at(maxima, cells, values)
+
+    occupied = np.flatnonzero(counts)
+    center_x = np.minimum((occupied % columns) * cell_size + cell_size // 2, IMAGE_WIDTH - 1)
+    center_y = np.minimum((occupied // columns) * cell_size + cell_size // 2, IMAGE_HEIGHT - 1)
+    return center_x, center_y, sums[occupied] / counts[occupied], maxima[occupied], counts[occupied]
+
+def parse_bin_size(value):
+    """Parses the /heatmap-data?bin= cell size in pixels. Raises ValueError if out of range."""
+    cell_size = int(value)
+    if not 1 <= cell_size <= MAX_BIN_SIZE:
+        raise ValueError(f"bin must be between 1 and {MAX_BIN_SIZE} pixels")
+    return cell_size
+
+# --- End Heatmap Binning Section ---
+
+# --- Live Location Stream Configuration ---
+LIVE_STREAM_HEARTBEAT_SECONDS = 15 # Comment line sent on idle streams so proxies keep them open
+MAX_LIVE_STREAMS = 200 # Concurrent /live-location-stream connections, each holds a server thread
+LIVE_STREAM_RETRY_MS = 5000 # Reconnect delay suggested to EventSource clients
+# --- End Live Location Stream Configuration ---
+
+def live_stream_limit(threads):
+    """Stream cap for a server with a fixed number of request threads: half of them, so streams never starve other requests."""
+    return min(MAX_LIVE_STREAMS, threads // 2)
+
+def live_location_payload(session_data):
+    """Builds the /get-live-location response for a (lat, lon, timestamp) session location (or None)."""
+    if session_data and len(session_data) == 3:
+        lat, lon, timestamp = session_data
+         # map_lat_lon_to_pixels uses updated dimensions
+        x_pixel, y_pixel, is_within_bounds = map_lat_lon_to_pixels(lat, lon)
+
+        if x_pixel is not None and y_pixel is not None:
+            return {
+                "x": x_pixel,
+                "y": y_pixel,
+                "in_bounds": is_within_bounds,
+                "found": True
+            }
+        else:
+            return {"found": False, "reason": "Mapping failed"}
+    else:
+         # Check if session exists but has old/invalid data format if needed
+        return {"found": False, "reason": "No recent data for session"}
+
+
+def live_location_payloads(session_ids, locations):
+    """
+    Builds live_location_payload style entries for many sessions with one batch transform.
+    locations is a {session_id: (lat, lon, timestamp)} snapshot; ids missing from it are not found.
+    Entries are keyed by str(session_id), as JSON would, so ids of mixed types still sort for jsonify.
+    """
+    found_ids = [session_id for session_id in session_ids if session_id in locations]
+    x_pixels, y_pixels, in_bounds, valid = map_lat_lon_batch(
+        [locations[session_id][0] for session_id in found_ids],
+        [locations[session_id][1] for session_id in found_ids])
+    payloads = {str(session_id): {"found": False, "reason": "No recent data for session"} for session_id in session_ids}
+    for session_id, x, y, inside, ok in zip(found_ids, x_pixels.tolist(), y_pixels.tolist(), in_bounds.tolist(), valid.tolist()):
+        payloads[str(session_id)] = {"x": x, "y": y, "in_bounds": inside, "found": True} if ok else {"found": False, "reason": "Mapping failed"}
+    return payloads
+
+def heatmap_max(points_mapped, max_speed):
+    """Picks the max value sent to heatmap.js."""
+    # Ensure max is at least 1 for heatmap.js if points exist but max is 0
+    if points_mapped > 0 and max_speed <= 0:
+        return 1.0
+    elif points_mapped == 0:
+         return 1.0 # Default max if no data
+    else:
+         return max_speed
+
+def parse_heatmap_cursor(cursor):
+    """
+    Parses a /heatmap-data?since= cursor "<speed test id>.<location id>.<rows replaced>" into
+    (speed test id, location id, rows replaced). Rows replaced is None for "0" (or an empty
+    value), which starts from the beginning, and for the older two-part cursors.
+    Raises ValueError if malformed.
+    """
+    if cursor in (None, "", "0"):
+        return 0, 0, None
+    parts = cursor.split(".")
+    if len(parts) not in (2, 3):
+        raise ValueError(f"Malformed cursor '{cursor}'")
+    values = [int(part) for part in parts]
+    if min(values) < 0:
+        raise ValueError(f"Malformed cursor '{cursor}'")
+    return values[0], values[1], values[2] if len(values) == 3 else None
 
-        # Clamp float values to image edges - this finds the 'closest edge' point
-        x_pixel_clamped = max(0.0, min(x_pixel_float, float(IMAGE_WIDTH - 1)))
-        y_pixel_clamped = max(0.0, min(y_pixel_float, float(IMAGE_HEIGHT - 1)))
 
-        # Convert clamped values to int
-        x_pixel = int(x_pixel_clamped)
-        y_pixel = int(y_pixel_clamped)
+# --- Batched Location Fixes ---
+MAX_LOCATION_BATCH = 1000 # Most fixes accepted by one /save_user_location_batch request
 
-        return x_pixel, y_pixel, is_within_bounds # Return statement was indented incorrectly in user-provided code
+def parse_location_fixes(data, now):
+    """
+    Validates a /save_user_location_batch payload in one pass.
+    Client timestamps (unix seconds) are shifted onto the server clock using the payload's
+    "sent_at", and never placed in the future. Fixes without a timestamp get `now`.
+    Returns (fixes, rejected): (session_id, lat, lon, timestamp) tuples and [{"index", "error"}].
+    Raises ValueError if the payload itself is malformed.
+    """
+    raw_fixes = data.get("fixes")
+    if not isinstance(raw_fixes, list):
+        raise ValueError("'fixes' must be a list")
+    if len(raw_fixes) > MAX_LOCATION_BATCH:
+        raise ValueError(f"At most {MAX_LOCATION_BATCH} fixes per request")
+    default_session_id = data.get("session_id")
+    sent_at = data.get("sent_at")
+    clock_offset = 0.0 if sent_at is None else now - float(sent_at)
+
+    fixes = []; rejected = []
+    for index, fix in enumerate(raw_fixes):
+        if not isinstance(fix, dict):
+            rejected.append({"index": index, "error": "Fix must be an object"}); continue
+        session_id = fix.get("session_id", default_session_id)
+        if session_id is None:
+            rejected.append({"index": index, "error": "Missing session_id"}); continue
+        if not isinstance(session_id, str):
+            # Mixed key types would break sorting the sessions when they are listed as JSON
+            rejected.append({"index": index, "error": "session_id must be a string"}); continue
+        try:
+            lat_float = float(fix["latitude"]); lon_float = float(fix["longitude"])
+            timestamp = now if fix.get("timestamp") is None else float(fix["timestamp"]) + clock_offset
+        except KeyError as e:
+            rejected.append({"index": index, "error": f"Missing {e.args[0]}"}); continue
+        except (TypeError, ValueError):
+            rejected.append({"index": index, "error": "Invalid lat/lon/timestamp format"}); continue
+        if not (np.isfinite(lat_float) and np.isfinite(lon_float) and np.isfinite(timestamp)):
+            rejected.append({"index": index, "error": "Invalid lat/lon/timestamp format"}); continue
+        fixes.append((session_id, lat_float, lon_float, min(timestamp, now)))
+    return fixes, rejected
+
+
+def parse_trail_time(value):
+    """Parses an optional from/to query value (unix seconds). Returns None when absent."""
+    if value is None or value == "":
+        return None
+    timestamp = float(value)
+    if not np.isfinite(timestamp):
+        raise ValueError(f"Invalid timestamp '{value}'")
+    try:
+        datetime.fromtimestamp(timestamp, tz=timezone.utc) # Windows are compared as datetimes in SQL
+    except (OverflowError, OSError, ValueError):
+        raise ValueError(f"Timestamp '{value}' is out of range")
+    return timestamp
 
-    except (ValueError, TypeError) as e:
-        print(f"DEBUG: Error converting lat/lon ({latitude}, {longitude}): {e}")
-        return None, None, False # Indicate mapping failure
 
-# --- End Coordinate Mapping Section ---
+def parse_bbox(value):
+    """
+    Parses a "min_a,min_b,max_a,max_b" bounding box, e.g. ?bbox=min_lat,min_lon,max_lat,max_lon
+    or ?pixel_bbox=min_x,min_y,max_x,max_y. Raises ValueError if malformed.
+    """
+    parts = value.split(",")
+    if len(parts) != 4:
+        raise ValueError("expected four comma-separated numbers")
+    min_a, min_b, max_a, max_b = (float(part) for part in parts)
+    if not all(np.isfinite([min_a, min_b, max_a, max_b])):
+        raise ValueError("coordinates must be finite")
+    if min_a > max_a or min_b > max_b:
+        raise ValueError("minimum is above maximum")
+    return min_a, min_b, max_a, max_b
+
+
+# --- Speed Plausibility Configuration ---
+SPEED_PLAUSIBILITY_FACTOR = 2.0 # Client speeds above this multiple of the server-observed speed are flagged
+MIN_OBSERVED_BYTES = 1024 * 1024 # Transfers smaller than this are too short to judge a client speed by
+REJECT_IMPLAUSIBLE_SPEEDS = os.getenv("REJECT_IMPLAUSIBLE_SPEEDS", "0") == "1" # Refuse flagged results instead of saving them
+# --- End Speed Plausibility Configuration ---
+
+def check_speed_plausibility(download, upload, observed, factor=SPEED_PLAUSIBILITY_FACTOR):
+    """
+    Compares client-reported Mbps with the server's transfer_stats totals for the same test.
+    Returns (server_mbps, flags): {"download": Mbps or None, "upload": ...} and a list of
+    "<direction>_exceeds_server_observed" flags. Directions without enough traffic are not judged.
+    """
+    server_mbps = {}; flags = []
+    for direction, client_mbps in (("download", download), ("upload", upload)):
+        totals = (observed or {}).get(direction)
+        if totals is None or totals["mbps"] is None or totals["bytes"] < MIN_OBSERVED_BYTES:
+            server_mbps[direction] = None
+            continue
+        server_mbps[direction] = round(totals["mbps"], 2)
+        if client_mbps > totals["mbps"] * factor:
+            flags.append(f"{direction}_exceeds_server_observed")
+    return server_mbps, flags
+
+
+def parse_measurement(data):
+    """
+    Validates a /submit-measurement payload. Speeds may be "Fail" (stored as 0), jitterStatus is
+    optional, and latitude/longitude are sent together or not at all (speed test without location).
+    Returns (download, upload, ping, jitter, latitude, longitude). Raises ValueError for invalid values.
+    """
+    def number(key, required=True):
+        value = data.get(key)
+        if value is None:
+            if required:
+                raise ValueError(f"Missing {key}")
+            return None
+        if value == "Fail":
+            return 0.0
+        try:
+            result = float(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid {key} '{value}'")
+        if not np.isfinite(result):
+            raise ValueError(f"Invalid {key} '{value}'")
+        return result
+
+    download = number("dlStatus"); upload = number("ulStatus"); ping = number("pingStatus")
+    jitter = number("jitterStatus", required=False)
+    latitude = number("latitude", required=False); longitude = number("longitude", required=False)
+    if (latitude is None) != (longitude is None):
+        raise ValueError("latitude and longitude must be sent together")
+    return download, upload, ping, jitter, latitude, longitude
 
 
 class Routes:
-    def __init__(self, app: Flask):
+    def __init__(self, app: Flask, session_store=None, max_live_streams=MAX_LIVE_STREAMS, check_speeds=True):
         self.app = app
         self.db_handler = DatabaseHandler()
-        self.session_ids_to_generated_ids = {}
-        self.id_lock = threading.Lock()
-        self.user_sessions = {} # Stores {session_id: (lat, lon, timestamp)}
-        self.session_lock = threading.Lock()
+        # Latest (lat, lon, timestamp) and generated test id per session, expired together.
+        # In memory by default, or shared between worker processes with SESSION_BACKEND=sqlite.
+        self.sessions = create_session_store() if session_store is None else session_store
+        self.live_stream_slots = threading.BoundedSemaphore(max_live_streams) # 0 sends every page to polling
+        # transfer_stats only sees this process's transfers, so with several workers a test's
+        # downloads and uploads may have gone elsewhere and it cannot be judged
+        self.check_speeds = check_speeds
+        self.heatmap_cache = {} # {bin size or None: (data_version, etag, serialized payload)}
+        self.heatmap_max_cache = None # (data_version, max download) over all data, for deltas
+        self.heatmap_cache_lock = threading.Lock()
+        # Django recycles connections (CONN_MAX_AGE, CONN_HEALTH_CHECKS) on its own request
+        # signals, which Flask never sends, so do the same around every Flask request
+        self.app.before_request(close_old_connections)
+        self.app.teardown_request(lambda exc: close_old_connections())
         self.setup_routes()
 
     def generate_id(self):
-        return random.randint(100000, 999999)
+        # Block-reserved from the database, so ids never repeat across restarts or worker processes
+        return self.db_handler.allocate_test_id()
+
+    def check_submitted_speeds(self, download, upload, test_id):
+        """
+        Compares submitted speeds with what the server measured on /backend/garbage and /backend/empty for the test.
+        Without check_speeds nothing is judged and the server speeds are reported as None.
+        """
+        observed = transfer_stats.get(get_client_ip(), str(test_id)) if self.check_speeds else None
+        server_mbps, flags = check_speed_plausibility(download, upload, observed)
+        if flags:
+            print(f"Implausible speed test for ID {test_id}: client {download}/{upload} Mbps, server observed {server_mbps}")
+        return server_mbps, flags
 
     def setup_routes(self):
         @self.app.route("/")
@@ -86,11 +397,10 @@ class Routes:
         def generate_id_route():
             session_id = request.args.get("session_id")
             if not session_id: return jsonify({"error": "Missing session_id parameter"}), 400
-            with self.id_lock:
-                new_id = self.generate_id()
-                # Check if session_id already exists and handle if necessary (e.g., log, overwrite, return error)
-                # For now, it overwrites the previous ID for the session
-                self.session_ids_to_generated_ids[session_id] = new_id
+            new_id = self.generate_id()
+            # Check if session_id already exists and handle if necessary (e.g., log, overwrite, return error)
+            # For now, it overwrites the previous ID for the session
+            self.sessions.set_generated_id(session_id, new_id)
             return jsonify({"id": new_id})
 
         @self.app.route("/save_location", methods=["POST"])
@@ -116,12 +426,14 @@ class Routes:
         @self.app.route("/save_user_location", methods=["POST"])
         def save_user_location():
             data = request.get_json(silent=True) # Use silent=True to avoid exception on bad JSON
-            if not data: return jsonify({"error": "Invalid or empty JSON payload"}), 400
+            if not isinstance(data, dict) or not data: return jsonify({"error": "Invalid or empty JSON payload"}), 400
             latitude = data.get("latitude"); longitude = data.get("longitude"); session_id = data.get("session_id")
+            # Same rule as the batch route: only string ids, so session listings stay sortable
+            if session_id is not None and not isinstance(session_id, str): return jsonify({"error": "session_id must be a string"}), 400
             if latitude is not None and longitude is not None and session_id is not None:
                 try:
                     lat_float = float(latitude); lon_float = float(longitude); current_time = time.time()
-                    with self.session_lock: self.user_sessions[session_id] = (lat_float, lon_float, current_time)
+                    self.sessions.update_location(session_id, lat_float, lon_float, current_time)
                     return jsonify({"status": "User location updated", "session_id": session_id}), 200
                 except (TypeError, ValueError): return jsonify({"error": "Invalid lat/lon format"}), 400
             else:
@@ -129,6 +441,17 @@ class Routes:
                 missing = [f for f in ['latitude', 'longitude', 'session_id'] if data.get(f) is None]
                 return jsonify({"error": f"Missing required fields: {', '.join(missing)}"}), 400
 
+        @self.app.route("/save_user_location_batch", methods=["POST"])
+        def save_user_location_batch():
+            # Many timestamped fixes (possibly for several sessions), e.g. a backlog after a reconnect
+            data = request.get_json(silent=True)
+            if not isinstance(data, dict): return jsonify({"error": "Invalid or empty JSON payload"}), 400
+            try:
+                fixes, rejected = parse_location_fixes(data, time.time())
+            except (TypeError, ValueError) as e: return jsonify({"error": f"Invalid batch: {e}"}), 400
+            applied, stale = self.sessions.update_locations(fixes)
+            return jsonify({"status": "User locations updated", "applied": applied, "stale": stale, "rejected": rejected}), 200
+
         @self.app.route("/submit-speed", methods=["POST"])
         def submit_speed():
             data = request.json
@@ -154,161 +477,394 @@ class Routes:
             session_id = data.get("session_id")
             if not session_id: return jsonify({"error": "Missing session_id"}), 400
 
-            with self.id_lock: current_db_id = self.session_ids_to_generated_ids.get(session_id)
+            current_db_id = self.sessions.get_generated_id(session_id)
             # Check if an ID was generated for this session
             if current_db_id is None: return jsonify({"error": "No test ID found for this session. Please run a test first or refresh."}), 400
 
+            server_mbps, flags = self.check_submitted_speeds(dl, ul, current_db_id)
+            if flags and REJECT_IMPLAUSIBLE_SPEEDS:
+                return jsonify({"error": "Speed results do not match the transfers the server observed", "flags": flags, "server_observed": server_mbps}), 422
+
             try:
                 self.db_handler.save_speed_test(dl, ul, p, current_db_id)
-                return jsonify({"message": "Speed test results saved!", "id": current_db_id}), 200 # Return 200 OK
+                return jsonify({"message": "Speed test results saved!", "id": current_db_id, "server_observed": server_mbps, "flags": flags}), 200 # Return 200 OK
             except Exception as e: print(f"DB save speed error for ID {current_db_id}: {e}"); return jsonify({"error": "Failed to save speed results"}), 500
 
+        @self.app.route("/submit-measurement", methods=["POST"])
+        def submit_measurement():
+            # Speed test, jitter and location in one request, written in one transaction
+            data = request.get_json(silent=True)
+            if not isinstance(data, dict) or not data: return jsonify({"error": "Invalid or empty JSON payload"}), 400
+            session_id = data.get("session_id")
+            if not session_id: return jsonify({"error": "Missing session_id"}), 400
+            if not isinstance(session_id, str): return jsonify({"error": "session_id must be a string"}), 400
+            try:
+                dl, ul, p, jitter, lat, lon = parse_measurement(data)
+            except ValueError as e: return jsonify({"error": str(e)}), 400
+
+            # Use the id the session's transfers were tagged with, or allocate one so the
+            # client can skip /generate_unique_id entirely. An id is used for one measurement only.
+            current_db_id = self.sessions.get_generated_id(session_id)
+            if current_db_id is None:
+                current_db_id = self.generate_id()
+                self.sessions.set_generated_id(session_id, current_db_id)
+
+            server_mbps, flags = self.check_submitted_speeds(dl, ul, current_db_id)
+            if flags and REJECT_IMPLAUSIBLE_SPEEDS:
+                return jsonify({"error": "Speed results do not match the transfers the server observed", "flags": flags, "server_observed": server_mbps}), 422
+
+            try:
+                self.db_handler.save_measurement(dl, ul, p, jitter, lat, lon, current_db_id)
+            except Exception as e: print(f"DB save measurement error for ID {current_db_id}: {e}"); return jsonify({"error": "Failed to save measurement"}), 500
+            self.sessions.clear_generated_id(session_id, current_db_id) # The next submission gets a fresh id
+            return jsonify({"message": "Measurement saved!", "id": current_db_id, "location_saved": lat is not None,
+                            "server_observed": server_mbps, "flags": flags}), 200
+
         @self.app.route("/heatmap-data", methods=["GET"])
         def get_heatmap_data():
+            # Optional time window: only tests measured between ?from=<ts> and ?to=<ts> (unix seconds)
             try:
-                combined_data = self.db_handler.get_data()
-                heatmap_points = []
-                max_speed = 0.0 # Use float for max speed
-                points_processed = 0; points_mapped = 0
-                for unique_id, info in combined_data.items():
-                    points_processed += 1
-                    # Safely get speed value
-                    speed = 0.0
-                    try:
-                        # Check if download exists and is not None before converting
-                        dl_value = info.get('download')
-                        if dl_value is not None:
-                            speed = float(dl_value)
-                    except (ValueError, TypeError):
-                        print(f"Warning: Could not convert download speed '{info.get('download')}' for ID {unique_id} to float. Using 0.")
-                        speed = 0.0 # Default to 0 if conversion fails
-
-                    if info.get('location'):
-                        lat = info['location']['latitude']; lon = info['location']['longitude']
-                        # map_lat_lon_to_pixels uses updated dimensions
-                        x_pixel, y_pixel, _ = map_lat_lon_to_pixels(lat, lon)
-                        if x_pixel is not None and y_pixel is not None:
-                            points_mapped += 1
-                            heatmap_points.append({"x": x_pixel, "y": y_pixel, "value": speed})
-                            if speed > max_speed: max_speed = speed
-                # Ensure max is at least 1 for heatmap.js if points exist but max is 0
-                if points_mapped > 0 and max_speed <= 0:
-                    max_to_send = 1.0
-                elif points_mapped == 0:
-                     max_to_send = 1.0 # Default max if no data
-                else:
-                     max_to_send = max_speed
-
-                return jsonify({"max": max_to_send, "data": heatmap_points})
+                start_time = parse_trail_time(request.args.get("from"))
+                end_time = parse_trail_time(request.args.get("to"))
+                if start_time is not None and end_time is not None and start_time > end_time:
+                    raise ValueError("'from' is after 'to'")
+            except (TypeError, ValueError) as e: return jsonify({"error": f"Invalid time range: {e}"}), 400
+            # Incremental mode: only the points added after the client's cursor
+            if "since" in request.args:
+                try:
+                    return jsonify(self.build_heatmap_delta(request.args.get("since"), start_time, end_time))
+                except ValueError as e: return jsonify({"error": f"Invalid since cursor: {e}"}), 400
+                except Exception as e: print(f"Error generating heatmap delta: {e}"); return jsonify({"error": "Failed to generate heatmap data"}), 500
+            # Binned mode: per-cell mean/max/count instead of one point per test
+            cell_size = None
+            if "bin" in request.args:
+                try:
+                    cell_size = parse_bin_size(request.args.get("bin"))
+                except (TypeError, ValueError) as e: return jsonify({"error": f"Invalid bin size: {e}"}), 400
+            try:
+                etag, body = self.get_heatmap_payload(cell_size, start_time, end_time)
             except Exception as e: print(f"Error generating heatmap data: {e}"); return jsonify({"error": "Failed to generate heatmap data"}), 500
+            response = Response(body, mimetype="application/json")
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = "no-cache" # Browsers revalidate with If-None-Match every time
+            # Turns the response into a bodyless 304 when the client's ETag still matches
+            return response.make_conditional(request)
+
+        @self.app.route("/measurements", methods=["GET"])
+        def get_measurements():
+            # Speed tests in a region: ?bbox=min_lat,min_lon,max_lat,max_lon or ?pixel_bbox=min_x,min_y,max_x,max_y
+            # on the floor image, optionally with ?from=&to= (unix seconds)
+            if ("bbox" in request.args) == ("pixel_bbox" in request.args):
+                return jsonify({"error": "Give exactly one of bbox or pixel_bbox"}), 400
+            try:
+                pixel_box = parse_bbox(request.args["pixel_bbox"]) if "pixel_bbox" in request.args else None
+                geo_box = parse_bbox(request.args["bbox"]) if pixel_box is None else None
+            except (TypeError, ValueError) as e: return jsonify({"error": f"Invalid bounding box: {e}"}), 400
+            try:
+                start_time = parse_trail_time(request.args.get("from"))
+                end_time = parse_trail_time(request.args.get("to"))
+            except (TypeError, ValueError) as e: return jsonify({"error": f"Invalid time range: {e}"}), 400
+            try:
+                return jsonify(self.build_region_payload(geo_box, pixel_box, start_time, end_time))
+            except Exception as e: print(f"Error querying measurements: {e}"); return jsonify({"error": "Failed to query measurements"}), 500
 
         @self.app.route("/get-live-location/<session_id>", methods=["GET"])
         def get_live_location(session_id):
             if not session_id:
                 return jsonify({"error": "Missing session_id"}), 400
 
-            with self.session_lock:
-                session_data = self.user_sessions.get(session_id)
-
-            if session_data and len(session_data) == 3:
-                lat, lon, timestamp = session_data
-                 # map_lat_lon_to_pixels uses updated dimensions
-                x_pixel, y_pixel, is_within_bounds = map_lat_lon_to_pixels(lat, lon)
-
-                if x_pixel is not None and y_pixel is not None:
-                    return jsonify({
-                        "x": x_pixel,
-                        "y": y_pixel,
-                        "in_bounds": is_within_bounds,
-                        "found": True
-                    })
-                else:
-                    return jsonify({"found": False, "reason": "Mapping failed"})
+            session_data = self.sessions.get_location(session_id)
+
+            return jsonify(live_location_payload(session_data))
+
+        @self.app.route("/get-live-locations", methods=["GET", "POST"])
+        def get_live_locations():
+            # Live dots for many sessions from one snapshot: ?session_ids=a,b or {"session_ids": [...]}, or all
+            if request.method == "POST":
+                data = request.get_json(silent=True)
+                if not isinstance(data, dict): return jsonify({"error": "Invalid or empty JSON payload"}), 400
+                session_ids = data.get("session_ids")
+                if session_ids is not None and not (isinstance(session_ids, list) and all(isinstance(sid, str) for sid in session_ids)):
+                    return jsonify({"error": "'session_ids' must be a list of strings"}), 400
             else:
-                 # Check if session exists but has old/invalid data format if needed
-                return jsonify({"found": False, "reason": "No recent data for session"})
+                session_ids = request.args.get("session_ids")
+                session_ids = [sid for sid in session_ids.split(",") if sid] if session_ids else None
+            snapshot_time = time.time()
+            locations = self.sessions.get_locations(session_ids)
+            if session_ids is None:
+                session_ids = list(locations.keys())
+            return jsonify({"timestamp": snapshot_time, "sessions": live_location_payloads(session_ids, locations)})
+
+        @self.app.route("/get-location-trail/<session_id>", methods=["GET"])
+        def get_location_trail(session_id):
+            # Recent samples of one session, optionally limited to ?from=<ts>&to=<ts> (unix seconds)
+            try:
+                start_time = parse_trail_time(request.args.get("from"))
+                end_time = parse_trail_time(request.args.get("to"))
+            except (TypeError, ValueError) as e: return jsonify({"error": f"Invalid time range: {e}"}), 400
+            payload = self.build_trail_payload(session_id, start_time, end_time)
+            if payload is None:
+                return jsonify({"error": "Session ID not found"}), 404
+            return jsonify(payload)
+
+        @self.app.route("/live-location-stream/<session_id>", methods=["GET"])
+        def live_location_stream(session_id):
+            # Server-Sent Events: pushes the live location only when it changes
+            if not self.live_stream_slots.acquire(blocking=False):
+                response = jsonify({"error": "Too many live location streams, poll /get-live-location instead"})
+                response.headers["Retry-After"] = str(LIVE_STREAM_RETRY_MS // 1000)
+                return response, 503
+            response = Response(self.stream_live_location(session_id), mimetype="text/event-stream")
+            response.headers["Cache-Control"] = "no-cache"
+            response.headers["X-Accel-Buffering"] = "no" # Stop reverse proxies from buffering events
+            # Free the slot when the connection closes, even if the stream never started
+            response.call_on_close(self.live_stream_slots.release)
+            return response
 
 
         @self.app.route("/get_all_sessions", methods=["GET"])
         def get_all_sessions_route():
-             with self.session_lock:
-                 # Filter out potentially malformed entries just in case
-                active_sessions = {
-                    sid: time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(sdata[2]))
-                    for sid, sdata in self.user_sessions.items()
-                    if isinstance(sdata, tuple) and len(sdata) == 3 and isinstance(sdata[2], (int, float))
-                }
-                return jsonify(active_sessions)
+            # String keys, so jsonify can sort ids of mixed types
+            active_sessions = {
+                str(sid): time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(sdata[2]))
+                for sid, sdata in self.sessions.get_locations().items()
+            }
+            return jsonify(active_sessions)
 
         @self.app.route("/get_location/<session_id>", methods=["GET"])
         def get_location_route(session_id):
-            with self.session_lock:
-                session_data = self.user_sessions.get(session_id)
-                if session_data and isinstance(session_data, tuple) and len(session_data) == 3:
-                    lat, lon, last_seen_ts = session_data
-                    # Ensure timestamp is valid before formatting
-                    try:
-                        last_seen_str = time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(last_seen_ts))
-                    except (ValueError, TypeError):
-                        last_seen_str = "Invalid timestamp"
-                    return jsonify({"latitude": lat, "longitude": lon, "last_seen": last_seen_str})
-                return jsonify({"error": "Session ID not found or data invalid"}), 404
+            session_data = self.sessions.get_location(session_id)
+            if session_data:
+                lat, lon, last_seen_ts = session_data
+                # Ensure timestamp is valid before formatting
+                try:
+                    last_seen_str = time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(last_seen_ts))
+                except (ValueError, TypeError):
+                    last_seen_str = "Invalid timestamp"
+                return jsonify({"latitude": lat, "longitude": lon, "last_seen": last_seen_str})
+            return jsonify({"error": "Session ID not found or data invalid"}), 404
+
+    # --- Live Location Stream ---
+    def stream_live_location(self, session_id, heartbeat_seconds=LIVE_STREAM_HEARTBEAT_SECONDS):
+        """
+        Yields Server-Sent Events for a session: a "data:" event with the /get-live-location
+        payload whenever it changes, and a comment line as heartbeat when nothing changed.
+        """
+        yield f"retry: {LIVE_STREAM_RETRY_MS}\n\n"
+        last_session_data = object() # Sentinel so the current state is always sent first
+        last_payload = None
+        while True:
+            session_data = self.sessions.wait_for_location_change(session_id, last_session_data, heartbeat_seconds)
+            if session_data == last_session_data:
+                yield ": heartbeat\n\n"
+                continue
+            last_session_data = session_data
+            payload = live_location_payload(session_data)
+            if payload != last_payload: # A new fix on the same pixel is not worth an event
+                last_payload = payload
+                yield f"data: {json.dumps(payload)}\n\n"
+
+    # --- Heatmap Payload ---
+    def build_heatmap_payload(self, start_time=None, end_time=None):
+        """Builds the heatmap.js payload ({"max": ..., "data": [...]}) from the database, optionally for a time window."""
+        heatmap_points, max_speed = self.map_heatmap_points(self.db_handler.get_data(start_time, end_time))
+        return {"max": heatmap_max(len(heatmap_points), max_speed), "data": heatmap_points}
+
+    def build_binned_heatmap_payload(self, cell_size, start_time=None, end_time=None):
+        """
+        Builds a heatmap.js payload with one point per occupied cell_size grid cell.
+        Each point's value is the cell's mean download speed, with its max and count alongside.
+        """
+        x_pixels, y_pixels, speeds = self.map_heatmap_arrays(self.db_handler.get_data(start_time, end_time))
+        center_x, center_y, means, maxima, counts = bin_heatmap_points(x_pixels, y_pixels, speeds, cell_size)
+        binned_points = [
+            {"x": x, "y": y, "value": mean, "max": cell_max, "count": count}
+            for x, y, mean, cell_max, count in zip(center_x.tolist(), center_y.tolist(), means.tolist(), maxima.tolist(), counts.tolist())
+        ]
+        max_mean = float(means.max()) if len(binned_points) else 0.0
+        return {"max": heatmap_max(len(binned_points), max_mean), "bin": cell_size, "data": binned_points}
+
+    def build_heatmap_delta(self, cursor, start_time=None, end_time=None):
+        """
+        Builds the heatmap points added after a "<speed test id>.<location id>.<rows replaced>"
+        cursor, along with the cursor for the next call and the current max over all data
+        (both limited to the time window, if given). Replaced rows keep their ids, so when rows
+        were replaced since the cursor was issued every point is sent again with "reset" set,
+        and the client replaces its points instead of adding to them.
+        Raises ValueError for a malformed cursor.
+        """
+        internet_cursor, location_cursor, rows_replaced = parse_heatmap_cursor(cursor)
+        # Read before the rows, so a replacement racing this call shows up on the next one
+        current_replaced = self.db_handler.get_rows_replaced()
+        reset = rows_replaced is not None and rows_replaced != current_replaced
+        if reset:
+            internet_cursor, location_cursor = 0, 0
+        combined_data, (internet_cursor, location_cursor) = self.db_handler.get_data_since(
+            internet_cursor, location_cursor, start_time, end_time)
+        heatmap_points, _ = self.map_heatmap_points(combined_data)
+        max_speed = self.get_max_download(start_time, end_time) or 0.0
+        return {
+            "max": max_speed if max_speed > 0 else 1.0, # Same floor of 1 as the full payload
+            "data": heatmap_points,
+            "cursor": f"{internet_cursor}.{location_cursor}.{current_replaced}",
+            "reset": reset,
+        }
+
+    def get_max_download(self, start_time=None, end_time=None):
+        """
+        Returns the highest located download speed, or None. The aggregate reads the whole
+        history, so without a time window it only runs again once the data version has moved.
+        """
+        if start_time is not None or end_time is not None:
+            return self.db_handler.get_max_download(start_time, end_time)
+        # Read the version first: a write landing during the query then only makes the entry stale
+        version = self.db_handler.get_data_version()
+        with self.heatmap_cache_lock:
+            cached = self.heatmap_max_cache
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        max_speed = self.db_handler.get_max_download()
+        with self.heatmap_cache_lock:
+            self.heatmap_max_cache = (version, max_speed)
+        return max_speed
+
+    def build_region_payload(self, geo_box=None, pixel_box=None, start_time=None, end_time=None):
+        """
+        Builds the /measurements response for a (min_lat, min_lon, max_lat, max_lon) box or a
+        (min_x, min_y, max_x, max_y) box in image pixels. A pixel box is queried through the
+        lat/lon box around its corners, then filtered exactly in pixel space.
+        """
+        if pixel_box is not None:
+            min_x, min_y, max_x, max_y = pixel_box
+            latitudes, longitudes = map_pixels_to_lat_lon_batch([min_x, max_x, min_x, max_x], [min_y, min_y, max_y, max_y])
+            geo_box = (latitudes.min(), longitudes.min(), latitudes.max(), longitudes.max())
+        combined_data = self.db_handler.get_data_in_bbox(*(float(value) for value in geo_box), start=start_time, end=end_time)
+
+        unique_ids = list(combined_data.keys())
+        latitudes = [combined_data[uid]['location']['latitude'] for uid in unique_ids]
+        longitudes = [combined_data[uid]['location']['longitude'] for uid in unique_ids]
+        x_float, y_float, valid = project_lat_lon_batch(latitudes, longitudes)
+        keep = valid.copy()
+        if pixel_box is not None:
+            keep &= (x_float >= min_x) & (x_float <= max_x) & (y_float >= min_y) & (y_float <= max_y)
+
+        measurements = []
+        for index in np.flatnonzero(keep).tolist():
+            info = combined_data[unique_ids[index]]
+            measurements.append({
+                "id": unique_ids[index],
+                "latitude": latitudes[index], "longitude": longitudes[index],
+                "x": round(float(x_float[index]), 2), "y": round(float(y_float[index]), 2),
+                "download": info['download'], "upload": info['upload'], "ping": info['ping'],
+            })
+        summary = {"count": len(measurements)}
+        for key in ("download", "upload", "ping"):
+            values = to_float_array([m[key] for m in measurements])
+            values = values[np.isfinite(values)]
+            summary[f"{key}_mean"] = float(values.mean()) if len(values) else None
+        return {"summary": summary, "measurements": measurements}
+
+    def map_heatmap_arrays(self, combined_data):
+        """
+        Maps get_data style rows to pixel arrays with one batch transform.
+        Returns (x, y, speed) arrays for the rows whose location could be mapped.
+        """
+        latitudes = []; longitudes = []; downloads = []
+        for info in combined_data.values():
+            location = info.get('location')
+            if location:
+                latitudes.append(location['latitude']); longitudes.append(location['longitude'])
+                downloads.append(info.get('download'))
+
+        speeds = to_float_array(downloads)
+        # Missing downloads count as 0 like before, anything else unparseable ("Fail") gets a warning
+        missing = np.array([value is None for value in downloads], dtype=bool)
+        unparseable = int(np.count_nonzero(np.isnan(speeds) & ~missing))
+        if unparseable:
+            print(f"Warning: Could not convert {unparseable} download speeds to float. Using 0.")
+        speeds = np.nan_to_num(speeds, nan=0.0)
+
+        x_pixels, y_pixels, _, valid = map_lat_lon_batch(latitudes, longitudes)
+        return x_pixels[valid], y_pixels[valid], speeds[valid]
+
+    def map_heatmap_points(self, combined_data):
+        """Maps get_data style rows to heatmap.js points. Returns (points, max_speed)."""
+        x_pixels, y_pixels, speeds = self.map_heatmap_arrays(combined_data)
+        heatmap_points = [
+            {"x": x, "y": y, "value": speed}
+            for x, y, speed in zip(x_pixels.tolist(), y_pixels.tolist(), speeds.tolist())
+        ]
+        max_speed = max(0.0, float(speeds.max())) if len(speeds) else 0.0 # Use float for max speed
+        return heatmap_points, max_speed
+
+    def get_heatmap_payload(self, cell_size=None, start_time=None, end_time=None):
+        """
+        Returns (etag, serialized payload) for /heatmap-data, binned when cell_size is given.
+        The payload is only rebuilt when the data version stored in the database has moved,
+        so a write made by any worker process invalidates every worker's cache.
+        Time-windowed payloads are not cached, since a moving "last hour" window rarely repeats.
+        """
+        windowed = start_time is not None or end_time is not None
+        version = self.db_handler.get_data_version()
+        with self.heatmap_cache_lock:
+            cached = None if windowed else self.heatmap_cache.get(cell_size)
+        if cached is not None and cached[0] == version:
+            return cached[1], cached[2]
+
+        if cell_size is None:
+            payload = self.build_heatmap_payload(start_time, end_time)
+        else:
+            payload = self.build_binned_heatmap_payload(cell_size, start_time, end_time)
+        body = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+        etag = hashlib.sha1(body).hexdigest()
+        if windowed:
+            return etag, body
+        with self.heatmap_cache_lock:
+            # Drop payloads built from older data so only one version is ever held
+            self.heatmap_cache = {key: entry for key, entry in self.heatmap_cache.items() if entry[0] == version}
+            self.heatmap_cache[cell_size] = (version, etag, body)
+        return etag, body
+
+    # --- Location Trail ---
+    def build_trail_payload(self, session_id, start_time=None, end_time=None):
+        """
+        Returns the /get-location-trail payload: the session's samples in the time range,
+        oldest first and mapped to pixels in one batch. None if the session is not tracked.
+        """
+        trail = self.sessions.get_trail(session_id, start_time, end_time)
+        if trail is None:
+            return None
+        timestamps, latitudes, longitudes = trail
+        x_pixels, y_pixels, in_bounds, _ = map_lat_lon_batch(latitudes, longitudes)
+        points = [
+            {"timestamp": timestamp, "latitude": lat, "longitude": lon, "x": x, "y": y, "in_bounds": inside}
+            for timestamp, lat, lon, x, y, inside in zip(
+                timestamps, latitudes, longitudes, x_pixels.tolist(), y_pixels.tolist(), in_bounds.tolist())
+        ]
+        return {"session_id": session_id, "points": points}
 
     # --- Helper Methods ---
     def get_user_session_location(self, session_id):
-        with self.session_lock:
-            session_data = self.user_sessions.get(session_id)
-             # Add check for valid format
-            if session_data and isinstance(session_data, tuple) and len(session_data) == 3:
-                # Ensure lat/lon are potentially valid numbers before returning
-                 try:
-                     float(session_data[0])
-                     float(session_data[1])
-                     return (session_data[0], session_data[1])
-                 except (ValueError, TypeError):
-                     print(f"Warning: Invalid lat/lon format in session data for {session_id}")
-                     return (None, None)
-            return (None, None)
+        session_data = self.sessions.get_location(session_id)
+        if session_data:
+            return (session_data[0], session_data[1])
+        return (None, None)
 
     def get_all_sessions(self):
-        # Ensure thread safety
-        with self.session_lock:
-            return list(self.user_sessions.keys())
+        return self.sessions.session_ids()
 
     def cleanup_inactive_sessions(self, timeout_seconds):
-        current_time = time.time()
-        inactive_session_ids = []
-        # Need to operate on a copy of keys or handle dict changes during iteration carefully
-        with self.session_lock:
-            all_session_ids = list(self.user_sessions.keys()) # Get keys first
-
-        for session_id in all_session_ids:
-            with self.session_lock: # Re-acquire lock to safely access data
-                sdata = self.user_sessions.get(session_id)
-            # Check if data exists, is a tuple, has 3 elements, and timestamp is valid before comparing
-            if not (sdata and isinstance(sdata, tuple) and len(sdata) == 3 and isinstance(sdata[2], (int, float))):
-                 inactive_session_ids.append(session_id) # Mark invalid format sessions for cleanup
-            elif (current_time - sdata[2]) > timeout_seconds:
-                inactive_session_ids.append(session_id) # Mark timed-out sessions
-
+        # Only sessions that are due are examined; their location and generated id go together
+        inactive_session_ids = self.sessions.expire(timeout_seconds)
         if inactive_session_ids:
-            print(f"Cleaning up inactive/invalid sessions: {inactive_session_ids}")
-            with self.session_lock:
-                for session_id in inactive_session_ids:
-                    self.user_sessions.pop(session_id, None) # Use pop with default None
-            # Also clean up the associated generated ID mapping
-            with self.id_lock:
-                 for session_id in inactive_session_ids:
-                     self.session_ids_to_generated_ids.pop(session_id, None)
-            # Log remaining sessions safely
-            with self.session_lock:
-                 remaining_sessions = list(self.user_sessions.keys())
-            print(f"Cleanup complete. Remaining sessions: {remaining_sessions}")
+            print(f"Cleaning up inactive sessions: {inactive_session_ids}")
+            stats = self.sessions.get_stats()
+            print(f"Cleanup complete. {stats['sessions']} sessions remaining, ~{stats['memory_bytes'] // 1024} KiB used.")
 
 
 # --- Function to initialize routes ---
-def setup_routes(app):
-    routes_instance = Routes(app)
+def setup_routes(app, session_store=None, max_live_streams=MAX_LIVE_STREAMS, check_speeds=True):
+    routes_instance = Routes(app, session_store, max_live_streams, check_speeds)
     return routes_instance
 
 
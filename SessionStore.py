@@ -0,0 +1,704 @@
+import math
+import os
+import sqlite3
+import sys
+import threading
+import time
+from array import array
+from contextlib import ExitStack
+
+# --- Session Store Configuration ---
+SESSION_LOCK_STRIPES = 16 # Sessions are spread over this many independently locked stripes
+SESSION_CAPACITY = 100000 # Hard cap on tracked sessions, least recently updated ones are evicted beyond it
+NO_GENERATED_ID = -1 # Stored in the generated id column for sessions without a test id
+NO_SLOT = -1 # Ends the LRU and free slot chains
+SESSION_TRAIL_LENGTH = 16 # Recent location samples kept per session (about 30 s at one fix every 2 s), 24 bytes each
+# Set SESSION_BACKEND=sqlite to share sessions between worker processes through a local SQLite file
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "database", "sessions.sqlite3"))
+SESSION_POLL_INTERVAL_SECONDS = 0.25 # How often SQLite-backed live streams look for changes from other processes
+SESSION_DB_BUSY_TIMEOUT_MS = 5000
+# --- End Session Store Configuration ---
+
+
+class SessionWaiter:
+    """The live streams waiting for one session's location to change."""
+    def __init__(self, lock):
+        self.condition = threading.Condition(lock) # For threads in wait_for_location_change
+        self.count = 0
+        self.listeners = [] # callback(location) functions registered with add_listener
+
+
+class SessionStripe:
+    """
+    One lock and the session state for the session ids that hash to it.
+
+    Session ids map to slot numbers in preallocated columns instead of owning a tuple each.
+    The slots in use form a doubly linked list through the lru_prev/lru_next columns, least
+    recently updated first. Slots are handed out in order; freed ones are chained through
+    lru_next and reused first.
+    """
+    def __init__(self, capacity, trail_length=SESSION_TRAIL_LENGTH):
+        self.lock = threading.Lock()
+        # {session_id: SessionWaiter} for the sessions that live streams are waiting on, notified
+        # when that session's location changes or it is removed, so streams of other sessions sleep on
+        self.waiters = {}
+        self.capacity = capacity
+        self.slots = {} # {session_id: slot}
+        self.slot_ids = [None] * capacity # Session id occupying each slot, None when free
+        self.lru_prev = array('i', [NO_SLOT]) * capacity
+        self.lru_next = array('i', [NO_SLOT]) * capacity # Also links the free slots
+        self.lru_head = NO_SLOT # Least recently updated slot
+        self.lru_tail = NO_SLOT # Most recently updated slot
+        self.free_head = NO_SLOT
+        self.next_slot = 0 # Slots at or above this have never been used
+        self.latitude = array('d', [0.0]) * capacity
+        self.longitude = array('d', [0.0]) * capacity
+        self.location_time = array('d', [math.nan]) * capacity # NaN while the session has no location
+        self.last_seen = array('d', [0.0]) * capacity # Last update of either kind, drives expiry
+        self.generated_id = array('q', [NO_GENERATED_ID]) * capacity
+        # Each slot's trail is a ring buffer of its last trail_length samples, stored in
+        # rows [slot * trail_length, (slot + 1) * trail_length) of the trail columns
+        self.trail_length = trail_length
+        self.trail_time = array('d', [0.0]) * (capacity * trail_length)
+        self.trail_latitude = array('d', [0.0]) * (capacity * trail_length)
+        self.trail_longitude = array('d', [0.0]) * (capacity * trail_length)
+        self.trail_start = array('i', [0]) * capacity # Ring offset of the slot's oldest sample
+        self.trail_count = array('i', [0]) * capacity
+
+    def allocate(self):
+        """Returns a free slot, or NO_SLOT when the stripe is full."""
+        slot = self.free_head
+        if slot != NO_SLOT:
+            self.free_head = self.lru_next[slot]
+        elif self.next_slot < self.capacity:
+            slot = self.next_slot
+            self.next_slot += 1
+        return slot
+
+    def release(self, slot):
+        self.lru_next[slot] = self.free_head
+        self.free_head = slot
+
+    def link(self, slot):
+        """Appends the slot to the LRU list as the most recently updated."""
+        self.lru_prev[slot] = self.lru_tail
+        self.lru_next[slot] = NO_SLOT
+        if self.lru_tail == NO_SLOT:
+            self.lru_head = slot
+        else:
+            self.lru_next[self.lru_tail] = slot
+        self.lru_tail = slot
+
+    def unlink(self, slot):
+        prev_slot = self.lru_prev[slot]
+        next_slot = self.lru_next[slot]
+        if prev_slot == NO_SLOT:
+            self.lru_head = next_slot
+        else:
+            self.lru_next[prev_slot] = next_slot
+        if next_slot == NO_SLOT:
+            self.lru_tail = prev_slot
+        else:
+            self.lru_prev[next_slot] = prev_slot
+
+    def notify(self, session_id, slot=None):
+        """
+        Wakes the live streams waiting on the session and passes its listeners the location in
+        slot, or None when the session was removed. Caller holds the lock.
+        """
+        waiter = self.waiters.get(session_id)
+        if waiter is not None:
+            waiter.condition.notify_all()
+            location = None if slot is None else self.location(slot)
+            for callback in waiter.listeners:
+                callback(location)
+
+    def waiter(self, session_id):
+        waiter = self.waiters.get(session_id)
+        if waiter is None:
+            waiter = self.waiters[session_id] = SessionWaiter(self.lock)
+        return waiter
+
+    def drop_waiter(self, session_id, waiter):
+        if not waiter.count and not waiter.listeners:
+            del self.waiters[session_id]
+
+    def location(self, slot):
+        timestamp = self.location_time[slot]
+        if math.isnan(timestamp):
+            return None
+        return (self.latitude[slot], self.longitude[slot], timestamp)
+
+    def append_trail(self, slot, timestamp, latitude, longitude):
+        """Adds a sample to the slot's trail, overwriting its oldest sample once the trail is full."""
+        length = self.trail_length
+        start = self.trail_start[slot]
+        count = self.trail_count[slot]
+        row = slot * length + (start + count) % length
+        self.trail_time[row] = timestamp
+        self.trail_latitude[row] = latitude
+        self.trail_longitude[row] = longitude
+        if count < length:
+            self.trail_count[slot] = count + 1
+        else:
+            self.trail_start[slot] = (start + 1) % length
+
+    def clear_trail(self, slot):
+        self.trail_start[slot] = 0
+        self.trail_count[slot] = 0
+
+    def trail_samples(self, slot, start_time=None, end_time=None):
+        """Returns the slot's (timestamps, latitudes, longitudes) lists, oldest first, within [start_time, end_time]."""
+        length = self.trail_length
+        start = self.trail_start[slot]
+        timestamps = []; latitudes = []; longitudes = []
+        for offset in range(self.trail_count[slot]):
+            row = slot * length + (start + offset) % length
+            timestamp = self.trail_time[row]
+            if start_time is not None and timestamp < start_time: continue
+            if end_time is not None and timestamp > end_time: continue
+            timestamps.append(timestamp)
+            latitudes.append(self.trail_latitude[row])
+            longitudes.append(self.trail_longitude[row])
+        return timestamps, latitudes, longitudes
+
+    def column_bytes(self):
+        columns = (self.latitude, self.longitude, self.location_time, self.last_seen, self.generated_id,
+                   self.lru_prev, self.lru_next)
+        return sum(column.itemsize * len(column) for column in columns)
+
+    def trail_bytes(self):
+        columns = (self.trail_time, self.trail_latitude, self.trail_longitude, self.trail_start, self.trail_count)
+        return sum(column.itemsize * len(column) for column in columns)
+
+
+class SessionStore:
+    """
+    Live user sessions: the latest location and the generated test id per session id.
+
+    Writes only lock the stripe their session id hashes to, so updates for different
+    sessions rarely contend. Each stripe holds at most capacity / stripes sessions and evicts
+    its least recently updated session to make room for a new one.
+    A session's last_seen never runs behind that of the sessions updated before it in its
+    stripe, so the LRU list is also in last_seen order: expiry pops due sessions off its head
+    instead of scanning every session or keeping a separate queue.
+    """
+    def __init__(self, stripes=SESSION_LOCK_STRIPES, capacity=SESSION_CAPACITY, trail_length=SESSION_TRAIL_LENGTH):
+        stripe_capacity = max(1, math.ceil(capacity / stripes))
+        self.stripes = [SessionStripe(stripe_capacity, trail_length) for _ in range(stripes)]
+        self.stats_lock = threading.Lock()
+        self.stats = {"evictions": 0, "expirations": 0}
+
+    def _stripe_index(self, session_id):
+        return hash(session_id) % len(self.stripes)
+
+    def _stripe(self, session_id):
+        return self.stripes[self._stripe_index(session_id)]
+
+    def _touch(self, stripe, session_id, timestamp):
+        """
+        Returns the session's slot, allocating one (and evicting if the stripe is full) for a new
+        session, and marks it as the most recently updated. Caller holds stripe.lock.
+        """
+        if stripe.lru_tail != NO_SLOT:
+            # Late batched samples don't roll last_seen back, which keeps the LRU list sorted by it
+            timestamp = max(timestamp, stripe.last_seen[stripe.lru_tail])
+        slot = stripe.slots.get(session_id)
+        if slot is not None:
+            if slot != stripe.lru_tail:
+                stripe.unlink(slot)
+                stripe.link(slot)
+        else:
+            slot = stripe.allocate()
+            if slot == NO_SLOT:
+                self._remove_locked(stripe, stripe.slot_ids[stripe.lru_head])
+                with self.stats_lock:
+                    self.stats["evictions"] += 1
+                slot = stripe.allocate()
+            stripe.slots[session_id] = slot
+            stripe.slot_ids[slot] = session_id
+            stripe.link(slot)
+        stripe.last_seen[slot] = timestamp
+        return slot
+
+    # --- Updates ---
+    def update_location(self, session_id, latitude, longitude, timestamp=None):
+        """Stores the latest location for a session and wakes its live streams."""
+        timestamp = time.time() if timestamp is None else timestamp
+        stripe = self._stripe(session_id)
+        with stripe.lock:
+            slot = self._touch(stripe, session_id, timestamp)
+            stripe.latitude[slot] = latitude
+            stripe.longitude[slot] = longitude
+            stripe.location_time[slot] = timestamp
+            stripe.append_trail(slot, timestamp, latitude, longitude)
+            stripe.notify(session_id, slot)
+
+    def update_locations(self, fixes):
+        """
+        Applies many (session_id, lat, lon, timestamp) fixes, taking each stripe's lock once.
+        Fixes are applied oldest first; a fix not newer than the session's current location is
+        skipped so late samples never overwrite a newer position.
+        Returns (applied, stale) counts.
+        """
+        by_stripe = {}
+        for fix in fixes:
+            by_stripe.setdefault(hash(fix[0]) % len(self.stripes), []).append(fix)
+        applied = 0
+        stale = 0
+        for stripe_index, stripe_fixes in by_stripe.items():
+            stripe_fixes.sort(key=lambda fix: fix[3])
+            stripe = self.stripes[stripe_index]
+            stripe_applied = 0
+            with stripe.lock:
+                for session_id, latitude, longitude, timestamp in stripe_fixes:
+                    slot = stripe.slots.get(session_id)
+                    if slot is not None and timestamp <= stripe.location_time[slot]: # False while it is NaN
+                        stale += 1
+                        continue
+                    slot = self._touch(stripe, session_id, timestamp)
+                    stripe.latitude[slot] = latitude
+                    stripe.longitude[slot] = longitude
+                    stripe.location_time[slot] = timestamp
+                    stripe.append_trail(slot, timestamp, latitude, longitude)
+                    stripe.notify(session_id, slot)
+                    stripe_applied += 1
+            applied += stripe_applied
+        return applied, stale
+
+    def set_generated_id(self, session_id, generated_id, timestamp=None):
+        """Records the test id generated for a session, replacing any previous one."""
+        timestamp = time.time() if timestamp is None else timestamp
+        stripe = self._stripe(session_id)
+        with stripe.lock:
+            slot = self._touch(stripe, session_id, timestamp)
+            stripe.generated_id[slot] = generated_id
+
+    def clear_generated_id(self, session_id, generated_id):
+        """Forgets the session's test id once it is used up, unless a newer id has replaced it meanwhile."""
+        stripe = self._stripe(session_id)
+        with stripe.lock:
+            slot = stripe.slots.get(session_id)
+            if slot is not None and stripe.generated_id[slot] == generated_id:
+                stripe.generated_id[slot] = NO_GENERATED_ID
+
+    def remove(self, session_id):
+        """Drops everything stored for a session."""
+        stripe = self._stripe(session_id)
+        with stripe.lock:
+            self._remove_locked(stripe, session_id)
+
+    def _remove_locked(self, stripe, session_id):
+        slot = stripe.slots.pop(session_id, None)
+        if slot is None:
+            return
+        stripe.notify(session_id) # Let live streams report the removal, eviction or expiry
+        stripe.location_time[slot] = math.nan
+        stripe.generated_id[slot] = NO_GENERATED_ID
+        stripe.slot_ids[slot] = None
+        stripe.clear_trail(slot)
+        stripe.unlink(slot)
+        stripe.release(slot)
+
+    # --- Reads ---
+    def get_location(self, session_id):
+        """Returns (lat, lon, timestamp) for a session, or None if it has no location."""
+        stripe = self._stripe(session_id)
+        with stripe.lock:
+            slot = stripe.slots.get(session_id)
+            return None if slot is None else stripe.location(slot)
+
+    def get_generated_id(self, session_id):
+        stripe = self._stripe(session_id)
+        with stripe.lock:
+            slot = stripe.slots.get(session_id)
+            if slot is None or stripe.generated_id[slot] == NO_GENERATED_ID:
+                return None
+            return stripe.generated_id[slot]
+
+    def get_trail(self, session_id, start_time=None, end_time=None):
+        """
+        Returns the session's recent (timestamps, latitudes, longitudes) within the time range,
+        oldest first, or None if the session is not tracked.
+        """
+        stripe = self._stripe(session_id)
+        with stripe.lock:
+            slot = stripe.slots.get(session_id)
+            if slot is None:
+                return None
+            return stripe.trail_samples(slot, start_time, end_time)
+
+    def get_locations(self, session_ids=None):
+        """
+        Returns a {session_id: (lat, lon, timestamp)} snapshot of the given sessions (or of all of
+        them) that have a location. All stripe locks are held together, in stripe order, so the
+        snapshot is consistent across stripes.
+        """
+        snapshot = {}
+        with ExitStack() as stack:
+            for stripe in self.stripes:
+                stack.enter_context(stripe.lock)
+            if session_ids is None:
+                for stripe in self.stripes:
+                    for session_id, slot in stripe.slots.items():
+                        location = stripe.location(slot)
+                        if location is not None:
+                            snapshot[session_id] = location
+            else:
+                for session_id in session_ids:
+                    stripe = self._stripe(session_id)
+                    slot = stripe.slots.get(session_id)
+                    location = None if slot is None else stripe.location(slot)
+                    if location is not None:
+                        snapshot[session_id] = location
+        return snapshot
+
+    def session_ids(self):
+        """Returns the ids of the sessions that have a location."""
+        return list(self.get_locations().keys())
+
+    def wait_for_location_change(self, session_id, previous, timeout):
+        """
+        Blocks until the session's location differs from previous or timeout seconds pass.
+        Returns the current location (equal to previous on timeout).
+        """
+        stripe = self._stripe(session_id)
+        deadline = time.monotonic() + timeout
+        with stripe.lock:
+            slot = stripe.slots.get(session_id)
+            current = None if slot is None else stripe.location(slot)
+            if current != previous:
+                return current
+            waiter = stripe.waiter(session_id)
+            waiter.count += 1
+            try:
+                # Condition waits can wake up spuriously, so keep waiting until the location differs
+                while current == previous:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    waiter.condition.wait(remaining)
+                    slot = stripe.slots.get(session_id)
+                    current = None if slot is None else stripe.location(slot)
+            finally:
+                waiter.count -= 1
+                stripe.drop_waiter(session_id, waiter)
+            return current
+
+    def add_listener(self, session_id, callback):
+        """
+        Calls callback(location) whenever the session's location changes, with None once the
+        session is removed, until remove_listener. Lets event loops follow a session without
+        polling or a thread per stream. The callback runs on the updating thread under the stripe
+        lock, so it must only hand the location over, e.g. with loop.call_soon_threadsafe.
+        Returns the current location, read under the same lock so no change is missed.
+        """
+        stripe = self._stripe(session_id)
+        with stripe.lock:
+            stripe.waiter(session_id).listeners.append(callback)
+            slot = stripe.slots.get(session_id)
+            return None if slot is None else stripe.location(slot)
+
+    def remove_listener(self, session_id, callback):
+        stripe = self._stripe(session_id)
+        with stripe.lock:
+            waiter = stripe.waiters.get(session_id)
+            if waiter is not None and callback in waiter.listeners:
+                waiter.listeners.remove(callback)
+                stripe.drop_waiter(session_id, waiter)
+
+    # --- Expiry ---
+    def expire(self, timeout_seconds, now=None):
+        """
+        Removes sessions not updated for more than timeout_seconds.
+        Only the due sessions at the head of each stripe's LRU list are looked at.
+        Returns the removed session ids.
+        """
+        now = time.time() if now is None else now
+        cutoff = now - timeout_seconds
+        expired = []
+        for stripe in self.stripes:
+            with stripe.lock:
+                while stripe.lru_head != NO_SLOT and stripe.last_seen[stripe.lru_head] < cutoff:
+                    session_id = stripe.slot_ids[stripe.lru_head]
+                    self._remove_locked(stripe, session_id)
+                    expired.append(session_id)
+        with self.stats_lock:
+            self.stats["expirations"] += len(expired)
+        return expired
+
+    def get_stats(self):
+        """Returns session counts, eviction/expiry counters and an estimate of the memory used."""
+        sessions = 0
+        capacity = 0
+        column_bytes = 0
+        trail_bytes = 0
+        index_bytes = 0
+        for stripe in self.stripes:
+            with stripe.lock:
+                sessions += len(stripe.slots)
+                capacity += stripe.capacity
+                column_bytes += stripe.column_bytes()
+                trail_bytes += stripe.trail_bytes()
+                index_bytes += sys.getsizeof(stripe.slots) + sys.getsizeof(stripe.slot_ids)
+                index_bytes += sum(sys.getsizeof(session_id) for session_id in stripe.slots)
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats.update({
+            "backend": "memory",
+            "sessions": sessions,
+            "capacity": capacity,
+            "column_bytes": column_bytes, # Preallocated, independent of the session count
+            "trail_bytes": trail_bytes, # Also preallocated, trail_length samples per slot
+            "index_bytes": index_bytes, # Slot map, session id strings and slot list
+            "memory_bytes": column_bytes + trail_bytes + index_bytes,
+        })
+        return stats
+
+    def __len__(self):
+        return sum(len(stripe.slots) for stripe in self.stripes)
+
+
+# Schema for SQLiteSessionStore. session_id has no declared type so ids keep their JSON type.
+# The trail is a ring buffer: row `position` is overwritten once trail_count wraps around.
+SESSION_SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS sessions (
+        session_id NOT NULL PRIMARY KEY,
+        latitude REAL,
+        longitude REAL,
+        location_time REAL,
+        last_seen REAL NOT NULL,
+        generated_id INTEGER,
+        trail_count INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS sessions_last_seen ON sessions (last_seen);
+    CREATE TABLE IF NOT EXISTS session_trail (
+        session_id NOT NULL REFERENCES sessions (session_id) ON DELETE CASCADE,
+        position INTEGER NOT NULL,
+        timestamp REAL NOT NULL,
+        latitude REAL NOT NULL,
+        longitude REAL NOT NULL,
+        PRIMARY KEY (session_id, position)
+    );
+"""
+
+
+class SQLiteSessionStore:
+    """
+    Session store with the same interface as SessionStore, kept in a local SQLite file so
+    several worker processes see the same live locations, test ids and trails.
+
+    Each thread uses its own WAL-mode connection, so readers never wait for writers.
+    Expiry and LRU eviction run off the last_seen index instead of an LRU list. Live streams
+    cannot be woken across processes, so wait_for_location_change polls every
+    SESSION_POLL_INTERVAL_SECONDS, which bounds how stale a pushed location can be.
+    """
+    def __init__(self, path=SESSION_DB_PATH, capacity=SESSION_CAPACITY, trail_length=SESSION_TRAIL_LENGTH,
+                 poll_interval=SESSION_POLL_INTERVAL_SECONDS):
+        self.path = path
+        self.capacity = capacity
+        self.trail_length = trail_length
+        self.poll_interval = poll_interval
+        self.local = threading.local()
+        self.stats_lock = threading.Lock()
+        self.stats = {"evictions": 0, "expirations": 0} # Counted in this process only
+        self._connection().executescript(SESSION_SCHEMA_SQL)
+
+    def _connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            # Autocommit mode, transactions are opened explicitly with BEGIN
+            conn = sqlite3.connect(self.path, timeout=SESSION_DB_BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self.local.conn = conn
+        return conn
+
+    def _write(self, work):
+        """Runs work(conn) in one IMMEDIATE transaction and returns its result."""
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = work(conn)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return result
+
+    def _add_session(self, conn, session_id, timestamp):
+        """
+        Inserts an empty session row, evicting the least recently seen ones if at capacity.
+        Returns the new row's (location_time, trail_count).
+        """
+        if self.capacity:
+            (count,) = conn.execute("SELECT COUNT(*) FROM sessions").fetchone()
+            excess = count - self.capacity + 1
+            if excess > 0:
+                conn.execute("DELETE FROM sessions WHERE session_id IN "
+                             "(SELECT session_id FROM sessions ORDER BY last_seen LIMIT ?)", (excess,))
+                with self.stats_lock:
+                    self.stats["evictions"] += excess
+        conn.execute("INSERT INTO sessions (session_id, last_seen) VALUES (?, ?)", (session_id, timestamp))
+        return None, 0
+
+    def _apply_location(self, conn, session_id, latitude, longitude, timestamp, only_if_newer):
+        row = conn.execute("SELECT location_time, trail_count FROM sessions WHERE session_id = ?",
+                           (session_id,)).fetchone()
+        if row is None:
+            row = self._add_session(conn, session_id, timestamp)
+        location_time, trail_count = row
+        if only_if_newer and location_time is not None and timestamp <= location_time:
+            return False
+        conn.execute("UPDATE sessions SET latitude = ?, longitude = ?, location_time = ?, "
+                     "last_seen = MAX(last_seen, ?), trail_count = trail_count + 1 WHERE session_id = ?",
+                     (latitude, longitude, timestamp, timestamp, session_id))
+        conn.execute("INSERT OR REPLACE INTO session_trail (session_id, position, timestamp, latitude, longitude) "
+                     "VALUES (?, ?, ?, ?, ?)",
+                     (session_id, trail_count % self.trail_length, timestamp, latitude, longitude))
+        return True
+
+    # --- Updates ---
+    def update_location(self, session_id, latitude, longitude, timestamp=None):
+        """Stores the latest location for a session."""
+        timestamp = time.time() if timestamp is None else timestamp
+        self._write(lambda conn: self._apply_location(conn, session_id, latitude, longitude, timestamp, False))
+
+    def update_locations(self, fixes):
+        """
+        Applies many (session_id, lat, lon, timestamp) fixes in one transaction, oldest first,
+        skipping fixes not newer than the session's current location. Returns (applied, stale).
+        """
+        def work(conn):
+            applied = 0
+            for session_id, latitude, longitude, timestamp in sorted(fixes, key=lambda fix: fix[3]):
+                if self._apply_location(conn, session_id, latitude, longitude, timestamp, True):
+                    applied += 1
+            return applied
+        applied = self._write(work) if fixes else 0
+        return applied, len(fixes) - applied
+
+    def set_generated_id(self, session_id, generated_id, timestamp=None):
+        """Records the test id generated for a session, replacing any previous one."""
+        timestamp = time.time() if timestamp is None else timestamp
+        def work(conn):
+            if conn.execute("SELECT 1 FROM sessions WHERE session_id = ?", (session_id,)).fetchone() is None:
+                self._add_session(conn, session_id, timestamp)
+            conn.execute("UPDATE sessions SET generated_id = ?, last_seen = MAX(last_seen, ?) WHERE session_id = ?",
+                         (generated_id, timestamp, session_id))
+        self._write(work)
+
+    def clear_generated_id(self, session_id, generated_id):
+        """Forgets the session's test id once it is used up, unless a newer id has replaced it meanwhile."""
+        self._write(lambda conn: conn.execute(
+            "UPDATE sessions SET generated_id = NULL WHERE session_id = ? AND generated_id = ?", (session_id, generated_id)))
+
+    def remove(self, session_id):
+        """Drops everything stored for a session (the trail goes with it)."""
+        self._write(lambda conn: conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,)))
+
+    # --- Reads ---
+    def get_location(self, session_id):
+        """Returns (lat, lon, timestamp) for a session, or None if it has no location."""
+        row = self._connection().execute(
+            "SELECT latitude, longitude, location_time FROM sessions WHERE session_id = ? AND location_time IS NOT NULL",
+            (session_id,)).fetchone()
+        return row
+
+    def get_generated_id(self, session_id):
+        row = self._connection().execute(
+            "SELECT generated_id FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def get_trail(self, session_id, start_time=None, end_time=None):
+        """
+        Returns the session's recent (timestamps, latitudes, longitudes) within the time range,
+        oldest first, or None if the session is not tracked.
+        """
+        conn = self._connection()
+        conn.execute("BEGIN") # One read snapshot for both queries
+        try:
+            if conn.execute("SELECT 1 FROM sessions WHERE session_id = ?", (session_id,)).fetchone() is None:
+                return None
+            rows = conn.execute(
+                "SELECT timestamp, latitude, longitude FROM session_trail WHERE session_id = ? "
+                "AND (? IS NULL OR timestamp >= ?) AND (? IS NULL OR timestamp <= ?) ORDER BY timestamp",
+                (session_id, start_time, start_time, end_time, end_time)).fetchall()
+        finally:
+            conn.execute("COMMIT")
+        return [row[0] for row in rows], [row[1] for row in rows], [row[2] for row in rows]
+
+    def get_locations(self, session_ids=None):
+        """Returns a {session_id: (lat, lon, timestamp)} snapshot of the given sessions (or all of them)."""
+        sql = "SELECT session_id, latitude, longitude, location_time FROM sessions WHERE location_time IS NOT NULL"
+        rows = self._connection().execute(sql).fetchall() # A single statement reads one consistent snapshot
+        snapshot = {row[0]: (row[1], row[2], row[3]) for row in rows}
+        if session_ids is not None:
+            snapshot = {session_id: snapshot[session_id] for session_id in session_ids if session_id in snapshot}
+        return snapshot
+
+    def session_ids(self):
+        """Returns the ids of the sessions that have a location."""
+        return list(self.get_locations().keys())
+
+    def wait_for_location_change(self, session_id, previous, timeout):
+        """
+        Polls until the session's location differs from previous or timeout seconds pass.
+        Returns the current location (equal to previous on timeout).
+        """
+        deadline = time.monotonic() + timeout
+        current = self.get_location(session_id)
+        while current == previous:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(min(self.poll_interval, remaining))
+            current = self.get_location(session_id)
+        return current
+
+    # --- Expiry ---
+    def expire(self, timeout_seconds, now=None):
+        """Removes sessions not updated for more than timeout_seconds. Returns the removed session ids."""
+        now = time.time() if now is None else now
+        cutoff = now - timeout_seconds
+        def work(conn):
+            # Range scan on the last_seen index, only due sessions are read
+            expired = [row[0] for row in conn.execute("SELECT session_id FROM sessions WHERE last_seen < ?", (cutoff,))]
+            conn.execute("DELETE FROM sessions WHERE last_seen < ?", (cutoff,))
+            return expired
+        expired = self._write(work)
+        with self.stats_lock:
+            self.stats["expirations"] += len(expired)
+        return expired
+
+    def get_stats(self):
+        """Returns session counts, this process's eviction/expiry counters and the database size."""
+        conn = self._connection()
+        (sessions,) = conn.execute("SELECT COUNT(*) FROM sessions").fetchone()
+        (page_count,) = conn.execute("PRAGMA page_count").fetchone()
+        (page_size,) = conn.execute("PRAGMA page_size").fetchone()
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats.update({
+            "backend": "sqlite",
+            "sessions": sessions,
+            "capacity": self.capacity,
+            "memory_bytes": page_count * page_size, # Size of the shared session database
+        })
+        return stats
+
+    def __len__(self):
+        (count,) = self._connection().execute("SELECT COUNT(*) FROM sessions").fetchone()
+        return count
+
+
+def create_session_store(backend=None, **kwargs):
+    """Returns the session store selected by SESSION_BACKEND ("memory" or "sqlite")."""
+    backend = SESSION_BACKEND if backend is None else backend
+    if backend == "memory":
+        return SessionStore(**kwargs)
+    if backend == "sqlite":
+        return SQLiteSessionStore(**kwargs)
+    raise ValueError(f"Unknown session backend '{backend}'")
@@ -3,11 +3,53 @@ Unit tests for the Routes class
 """
 
 import unittest
-from Routes import Routes
+from Routes import Routes, bin_heatmap_points, IMAGE_WIDTH, IMAGE_HEIGHT
+from Routes import map_lat_lon_batch, map_lat_lon_to_pixels, calibrate_affine, CONTROL_POINTS, MAX_LIVE_STREAMS, live_stream_limit
+from Routes import map_pixels_to_lat_lon_batch, project_lat_lon_batch
+from IspLookup import IspLookup, PrefixTrie, load_prefix_file, NO_ISP
+from BackendRoutes import backend_bp, stream_garbage, PREGENERATED_DATA, TransferStats, discard_request_body, transfer_stats
+from SessionStore import SessionStore, SQLiteSessionStore, create_session_store, SESSION_TRAIL_LENGTH
+from DatabaseHandler import DatabaseHandler, IdAllocator
+from AsgiApp import AsgiApp, PooledWsgiToAsgi
+from FlaskApp import FlaskApp, build_production_server
+from myapp.models import Location, Internet, FIRST_ALLOCATED_ID
+from myapp.spatial import spatial_cell, covering_ranges
+from django.db import connection, connections, transaction, IntegrityError
+from django.conf import settings
 from flask import Flask
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 import time
 import json
+import threading
+import os
+import sys
+import subprocess
+import tempfile
+import asyncio
+import requests
+import io
+import datetime
+import shutil
+import tracemalloc
+import numpy as np
+
+
+def setUpModule():
+    """
+    Point Django at a temporary copy of the migrated database, so tests that save results,
+    allocate test ids or bump the data version never change the tracked database/db.sqlite3.
+    """
+    global test_database_dir
+    test_database_dir = tempfile.mkdtemp()
+    database = settings.DATABASES["default"] # Shared with django.db.connections
+    copy_path = os.path.join(test_database_dir, "db.sqlite3")
+    shutil.copyfile(database["NAME"], copy_path)
+    connections.close_all()
+    database["NAME"] = copy_path
+
+def tearDownModule():
+    connections.close_all()
+    shutil.rmtree(test_database_dir, ignore_errors=True)
 
 
 class TestRoutes(unittest.TestCase):
@@ -126,6 +168,20 @@ class TestRoutes(unittest.TestCase):
         time_limit = 1.0
         self.assertLess(duration, time_limit, msg = f"Generating {num} ids took more than {time_limit}s ({duration} s)")
 
+    def test_generate_id_unique_across_instances(self):
+        """
+        Test if separate Routes instances, like separate worker processes or restarts,
+        never hand out the same ID, and IDs start above the old random range.
+        """
+        other_routes = Routes(Flask(__name__))
+        ids = []
+        for _ in range(150): # More than one reserved block each
+            ids.append(self.routes_instance.generate_id())
+            ids.append(other_routes.generate_id())
+
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertGreaterEqual(min(ids), FIRST_ALLOCATED_ID)
+
     def test_generate_id_missing_session_id(self):
         """
         Test if the /generate_unique_id route returns HTTP status 400 (Bad Request)
@@ -164,7 +220,7 @@ class TestRoutes(unittest.TestCase):
         session_id = "submit-test-session-1"
         unique_id = 123456
         # Ensure the session ID exists
-        self.routes_instance.session_ids_to_generated_ids[session_id] = unique_id
+        self.routes_instance.sessions.set_generated_id(session_id, unique_id)
         # Mock the database handler method
         self.routes_instance.db_handler.save_speed_test = MagicMock()
 
@@ -197,11 +253,153 @@ class TestRoutes(unittest.TestCase):
             unique_id # id
         )
 
+    def test_submit_speed_flags_implausible_download(self):
+        """
+        Test if a download speed far above what the server observed for the test is flagged,
+        and still saved unless rejection is enabled.
+        """
+        session_id = "submit-test-session-observed"
+        unique_id = 246810
+        self.routes_instance.sessions.set_generated_id(session_id, unique_id)
+        self.routes_instance.db_handler.save_speed_test = MagicMock()
+        # 8 MB written in one second is 64 Mbps, as seen from the server
+        transfer_stats.record("127.0.0.1", str(unique_id), "download", 8 * 1000 * 1000, 10.0, 11.0)
+        payload = {"dlStatus": "500", "ulStatus": "20", "pingStatus": "10", "session_id": session_id}
+
+        response = self.client1.post("/submit-speed", data=json.dumps(payload), content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual(data["flags"], ["download_exceeds_server_observed"])
+        self.assertEqual(data["server_observed"], {"download": 64.0, "upload": None})
+        self.routes_instance.db_handler.save_speed_test.assert_called_once()
+
+        with patch("Routes.REJECT_IMPLAUSIBLE_SPEEDS", True):
+            response = self.client1.post("/submit-speed", data=json.dumps(payload), content_type='application/json')
+        self.assertEqual(response.status_code, 422)
+        self.routes_instance.db_handler.save_speed_test.assert_called_once()
+
+        payload["dlStatus"] = "60" # Within what the server saw
+        response = self.client1.post("/submit-speed", data=json.dumps(payload), content_type='application/json')
+        self.assertEqual(response.get_json()["flags"], [])
+
+    def test_submit_speed_retry_replaces_result(self):
+        """
+        Test if submitting a speed test again for the same test id replaces the stored result
+        instead of reporting success while keeping the first one.
+        """
+        session_id = "submit-test-session-retry"
+        unique_id = self.routes_instance.generate_id()
+        self.routes_instance.sessions.set_generated_id(session_id, unique_id)
+        try:
+            for dl in ("50", "55"):
+                payload = {"dlStatus": dl, "ulStatus": "20", "pingStatus": "10", "session_id": session_id}
+                response = self.client1.post("/submit-speed", data=json.dumps(payload), content_type='application/json')
+                self.assertEqual(response.status_code, 200)
+
+            self.assertEqual(list(Internet.objects.filter(unique_id=unique_id).values_list("download", "upload")), [(55.0, 20.0)])
+        finally:
+            Internet.objects.filter(unique_id=unique_id).delete()
+
+    def test_submit_speed_unchecked_with_several_workers(self):
+        """
+        Test if speeds are neither flagged nor rejected when the check is off, as with several workers.
+        """
+        session_id = "submit-test-session-unchecked"
+        unique_id = 246812
+        self.routes_instance.check_speeds = False
+        self.routes_instance.sessions.set_generated_id(session_id, unique_id)
+        self.routes_instance.db_handler.save_speed_test = MagicMock()
+        transfer_stats.record("127.0.0.1", str(unique_id), "download", 8 * 1000 * 1000, 10.0, 11.0)
+        payload = {"dlStatus": "500", "ulStatus": "20", "pingStatus": "10", "session_id": session_id}
+
+        with patch("Routes.REJECT_IMPLAUSIBLE_SPEEDS", True):
+            response = self.client1.post("/submit-speed", data=json.dumps(payload), content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["flags"], [])
+        self.assertEqual(response.get_json()["server_observed"], {"download": None, "upload": None})
+        self.routes_instance.db_handler.save_speed_test.assert_called_once()
+
+    def test_submit_measurement_saves_together(self):
+        """
+        Test if /submit-measurement saves speed, jitter and location in one call under the session's test id.
+        """
+        session_id = "measurement-session-1"
+        self.routes_instance.sessions.set_generated_id(session_id, 135790)
+        self.routes_instance.db_handler.save_measurement = MagicMock()
+        payload = {"dlStatus": "80.5", "ulStatus": "Fail", "pingStatus": 12, "jitterStatus": 1.5,
+                   "latitude": 43.0376, "longitude": -76.1326, "session_id": session_id}
+
+        response = self.client1.post("/submit-measurement", data=json.dumps(payload), content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual(data["id"], 135790)
+        self.assertTrue(data["location_saved"])
+        self.routes_instance.db_handler.save_measurement.assert_called_once_with(80.5, 0.0, 12.0, 1.5, 43.0376, -76.1326, 135790)
+
+    def test_submit_measurement_without_generated_id(self):
+        """
+        Test if /submit-measurement allocates a test id when the session has none,
+        and accepts a speed test without a location.
+        """
+        session_id = "measurement-session-2"
+        self.routes_instance.db_handler.save_measurement = MagicMock()
+        payload = {"dlStatus": 10, "ulStatus": 5, "pingStatus": 20, "session_id": session_id}
+
+        response = self.client1.post("/submit-measurement", data=json.dumps(payload), content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertFalse(data["location_saved"])
+        self.assertGreaterEqual(data["id"], FIRST_ALLOCATED_ID)
+        self.assertIsNone(self.routes_instance.sessions.get_generated_id(session_id)) # Used up by the save
+        self.routes_instance.db_handler.save_measurement.assert_called_once_with(10.0, 5.0, 20.0, None, None, None, data["id"])
+
+    def test_submit_measurement_twice_gets_new_id(self):
+        """
+        Test if a second measurement from the same session is saved under a fresh test id
+        instead of hitting the unique constraint on the first one.
+        """
+        session_id = "measurement-session-4"
+        self.routes_instance.sessions.set_generated_id(session_id, self.routes_instance.generate_id())
+        payload = {"dlStatus": 10, "ulStatus": 5, "pingStatus": 20, "latitude": 43.0376, "longitude": -76.1326, "session_id": session_id}
+
+        first = self.client1.post("/submit-measurement", data=json.dumps(payload), content_type='application/json')
+        second = self.client1.post("/submit-measurement", data=json.dumps(payload), content_type='application/json')
+        ids = [response.get_json().get("id") for response in (first, second)]
+        Internet.objects.filter(unique_id__in=ids).delete()
+        Location.objects.filter(unique_id__in=ids).delete()
+
+        self.assertEqual((first.status_code, second.status_code), (200, 200))
+        self.assertNotEqual(ids[0], ids[1])
+
+    def test_submit_measurement_invalid(self):
+        """
+        Test if /submit-measurement rejects bad values, a lone coordinate or a missing session
+        without saving anything, and reports database errors.
+        """
+        self.routes_instance.db_handler.save_measurement = MagicMock()
+        base = {"dlStatus": 10, "ulStatus": 5, "pingStatus": 20, "session_id": "measurement-session-3"}
+        for changes in ({"dlStatus": "fast"}, {"latitude": 43.0}, {"pingStatus": None}, {"session_id": None}, {"jitterStatus": "nan"},
+                        {"session_id": ["measurement-session-3"]}, {"session_id": 12345}):
+            response = self.client1.post("/submit-measurement", data=json.dumps(dict(base, **changes)), content_type='application/json')
+            self.assertEqual(response.status_code, 400, changes)
+        response = self.client1.post("/submit-measurement", data=json.dumps([base]), content_type='application/json')
+        self.assertEqual(response.status_code, 400) # A JSON array instead of an object
+        self.routes_instance.db_handler.save_measurement.assert_not_called()
+
+        self.routes_instance.db_handler.save_measurement.side_effect = Exception("DB down")
+        response = self.client1.post("/submit-measurement", data=json.dumps(base), content_type='application/json')
+        self.assertEqual(response.status_code, 500)
+        self.assertIsNotNone(self.routes_instance.sessions.get_generated_id("measurement-session-3")) # Kept for a retry
+
     def test_submit_speed_fail_values(self):
         """Test submission with 'Fail' values converted to 0.0."""
         session_id = "submit-test-session-fail"
         unique_id = 654321
-        self.routes_instance.session_ids_to_generated_ids[session_id] = unique_id
+        self.routes_instance.sessions.set_generated_id(session_id, unique_id)
         self.routes_instance.db_handler.save_speed_test = MagicMock()
 
         payload = {
@@ -230,7 +428,7 @@ class TestRoutes(unittest.TestCase):
         """Test submission with missing speed values default to 0.0."""
         session_id = "submit-test-session-missing"
         unique_id = 789012
-        self.routes_instance.session_ids_to_generated_ids[session_id] = unique_id
+        self.routes_instance.sessions.set_generated_id(session_id, unique_id)
         self.routes_instance.db_handler.save_speed_test = MagicMock()
 
         payload = {
@@ -258,7 +456,7 @@ class TestRoutes(unittest.TestCase):
         """Test submission with invalid non-numeric strings defaulting to 0.0."""
         session_id = "submit-test-session-invalid-str"
         unique_id = 112233
-        self.routes_instance.session_ids_to_generated_ids[session_id] = unique_id
+        self.routes_instance.sessions.set_generated_id(session_id, unique_id)
         self.routes_instance.db_handler.save_speed_test = MagicMock()
 
         payload = {
@@ -306,8 +504,7 @@ class TestRoutes(unittest.TestCase):
         """Test submission with a session_id not previously generated."""
         session_id = "unrecognized-session"
         # Ensure this session_id is NOT in the mapping
-        if session_id in self.routes_instance.session_ids_to_generated_ids:
-            del self.routes_instance.session_ids_to_generated_ids[session_id]
+        self.routes_instance.sessions.remove(session_id)
 
         self.routes_instance.db_handler.save_speed_test = MagicMock() # Mock DB just in case
 
@@ -364,7 +561,7 @@ class TestRoutes(unittest.TestCase):
         """Test handling of a database exception during save."""
         session_id = "submit-test-session-db-error"
         unique_id = 445566
-        self.routes_instance.session_ids_to_generated_ids[session_id] = unique_id
+        self.routes_instance.sessions.set_generated_id(session_id, unique_id)
 
         # Setup: Mock the database handler to raise an exception
         self.routes_instance.db_handler.save_speed_test = MagicMock(
@@ -509,6 +706,84 @@ class TestRoutes(unittest.TestCase):
         self.assertEqual(response.status_code, 400)
         self.assertIn("Missing required fields: session_id", response.get_json().get("error", ""))
 
+    def test_save_user_location_rejects_non_string_session_id(self):
+        """
+        Test if /save_user_location refuses integer, list and object session ids without storing them.
+        """
+        for session_id in (12345, ["a"], {"id": "a"}):
+            response = self.client1.post("/save_user_location", json={"latitude": 43.0, "longitude": -76.0, "session_id": session_id})
+            self.assertEqual(response.status_code, 400, session_id)
+            self.assertEqual(response.get_json()["error"], "session_id must be a string")
+        self.assertEqual(self.routes_instance.get_all_sessions(), [])
+        self.assertEqual(self.client1.post("/save_user_location", json=[1, 2]).status_code, 400)
+
+    def test_save_user_location_batch(self):
+        """
+        Test if /save_user_location_batch applies fixes for several sessions, newest last,
+        and reports the invalid ones by index.
+        """
+        now = time.time()
+        payload = {
+            "session_id": "batch-session-1",
+            "sent_at": now,
+            "fixes": [
+                {"latitude": 43.2, "longitude": -76.2, "timestamp": now - 5},
+                {"latitude": 43.1, "longitude": -76.1, "timestamp": now - 10}, # Arrives out of order
+                {"session_id": "batch-session-2", "latitude": 44.0, "longitude": -77.0},
+                {"latitude": "north", "longitude": -76.0},
+                {"longitude": -76.0},
+            ]
+        }
+
+        response = self.client1.post("/save_user_location_batch", json=payload)
+
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual(data["applied"], 3)
+        self.assertEqual([r["index"] for r in data["rejected"]], [3, 4])
+        self.assertEqual(self.routes_instance.get_user_session_location("batch-session-1"), (43.2, -76.2))
+        self.assertEqual(self.routes_instance.get_user_session_location("batch-session-2"), (44.0, -77.0))
+        self.assertEqual(len(self.routes_instance.sessions.get_trail("batch-session-1")[0]), 2)
+
+    def test_save_user_location_batch_keeps_newer_position(self):
+        """
+        Test if a late batch does not overwrite a position that is newer than its fixes.
+        """
+        session_id = "batch-session-3"
+        self.client1.post("/save_user_location", json={"session_id": session_id, "latitude": 43.5, "longitude": -76.5})
+
+        late = {"session_id": session_id, "fixes": [{"latitude": 43.0, "longitude": -76.0, "timestamp": time.time() - 60}]}
+        response = self.client1.post("/save_user_location_batch", json=late)
+
+        self.assertEqual(response.get_json()["stale"], 1)
+        self.assertEqual(self.routes_instance.get_user_session_location(session_id), (43.5, -76.5))
+
+    def test_save_user_location_batch_invalid_payload(self):
+        """
+        Test if /save_user_location_batch rejects a payload without a fixes list.
+        """
+        response = self.client1.post("/save_user_location_batch", json={"session_id": "batch-session-4"})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("'fixes' must be a list", response.get_json()["error"])
+
+    def test_save_user_location_batch_rejects_non_string_session_id(self):
+        """
+        Test if fixes with a numeric session_id are rejected, so session listings stay sortable.
+        """
+        payload = {"fixes": [
+            {"session_id": 12345, "latitude": 43.0, "longitude": -76.0},
+            {"session_id": "batch-session-5", "latitude": 43.0, "longitude": -76.0},
+        ]}
+
+        response = self.client1.post("/save_user_location_batch", json=payload)
+
+        data = response.get_json()
+        self.assertEqual(data["applied"], 1)
+        self.assertEqual(data["rejected"], [{"index": 0, "error": "session_id must be a string"}])
+        self.assertEqual(self.client1.get("/get_all_sessions").status_code, 200)
+        self.assertEqual(self.client1.get("/get-live-locations").status_code, 200)
+
     def test_index_route(self):
         """
         Test if the index route returns HTTP status 200 (OK)
@@ -589,5 +864,1607 @@ class TestRoutes(unittest.TestCase):
         self.assertEqual(data["data"], [])
         self.assertEqual(data["max"], 1.0)
 
+    def test_heatmap_data_cached_until_write(self):
+        """
+        Test if /heatmap-data reuses the cached payload until the database handler
+        reports a write, then rebuilds it.
+        """
+        mock_data = {1: {"download": 10.5, "location": {"latitude": 43.0376, "longitude": -76.1326}}}
+        self.routes_instance.db_handler.get_data = MagicMock(return_value=mock_data)
+
+        first = self.client1.get("/heatmap-data")
+        second = self.client1.get("/heatmap-data")
+
+        self.assertEqual(first.get_json(), second.get_json())
+        self.assertEqual(self.routes_instance.db_handler.get_data.call_count, 1)
+
+        # A write bumps the data version and invalidates the cache
+        self.routes_instance.db_handler._bump_data_version()
+        self.routes_instance.db_handler.get_data.return_value = {}
+        third = self.client1.get("/heatmap-data")
+
+        self.assertEqual(self.routes_instance.db_handler.get_data.call_count, 2)
+        self.assertEqual(third.get_json()["data"], [])
+        self.assertNotEqual(first.headers["ETag"], third.headers["ETag"])
+
+    def test_heatmap_data_not_modified(self):
+        """
+        Test if /heatmap-data answers a matching If-None-Match with 304 and no body.
+        """
+        mock_data = {1: {"download": 10.5, "location": {"latitude": 43.0376, "longitude": -76.1326}}}
+        self.routes_instance.db_handler.get_data = MagicMock(return_value=mock_data)
+
+        response = self.client1.get("/heatmap-data")
+        etag = response.headers["ETag"]
+        revalidated = self.client1.get("/heatmap-data", headers={"If-None-Match": etag})
+
+        self.assertEqual(revalidated.status_code, 304)
+        self.assertEqual(revalidated.data, b"")
+
+        stale = self.client1.get("/heatmap-data", headers={"If-None-Match": '"stale"'})
+        self.assertEqual(stale.status_code, 200)
+        self.assertEqual(len(stale.get_json()["data"]), 1)
+
+    def test_heatmap_data_since_returns_delta(self):
+        """
+        Test if /heatmap-data?since= returns only the rows after the cursor,
+        the next cursor and the overall max.
+        """
+        delta = {7: {"download": 12.5, "location": {"latitude": 43.0376, "longitude": -76.1326}}}
+        self.routes_instance.db_handler.get_data_since = MagicMock(return_value=(delta, (9, 8)))
+        self.routes_instance.db_handler.get_max_download = MagicMock(return_value=40.0)
+        self.routes_instance.db_handler.get_rows_replaced = MagicMock(return_value=4)
+
+        response = self.client1.get("/heatmap-data?since=3.2.4")
+        data = response.get_json()
+
+        self.assertEqual(response.status_code, 200)
+        self.routes_instance.db_handler.get_data_since.assert_called_once_with(3, 2, None, None)
+        self.assertEqual(len(data["data"]), 1)
+        self.assertEqual(data["data"][0]["value"], 12.5)
+        self.assertEqual(data["cursor"], "9.8.4")
+        self.assertEqual(data["max"], 40.0)
+        self.assertFalse(data["reset"])
+
+        # Two-part cursors from before replacements were tracked still work
+        self.assertEqual(self.client1.get("/heatmap-data?since=3.2").get_json()["cursor"], "9.8.4")
+
+    def test_heatmap_delta_resets_after_replaced_rows(self):
+        """
+        Test if a retried speed test, which replaces its row under the same ids, makes the next
+        delta send every point again with reset set instead of nothing.
+        """
+        session_id = "heatmap-replaced-session"
+        unique_id = self.routes_instance.generate_id()
+        self.routes_instance.sessions.set_generated_id(session_id, unique_id)
+        try:
+            self.routes_instance.db_handler.save_location(CONTROL_POINTS[0][0][0], CONTROL_POINTS[0][0][1], unique_id)
+            payload = {"dlStatus": "50", "ulStatus": "20", "pingStatus": "10", "session_id": session_id}
+            self.assertEqual(self.client1.post("/submit-speed", json=payload).status_code, 200)
+            cursor = self.client1.get("/heatmap-data?since=0").get_json()["cursor"]
+            self.assertEqual(self.client1.get(f"/heatmap-data?since={cursor}").get_json()["data"], [])
+
+            self.routes_instance.sessions.set_generated_id(session_id, unique_id) # Retried with the same test id
+            self.assertEqual(self.client1.post("/submit-speed", json=dict(payload, dlStatus="4321")).status_code, 200)
+            data = self.client1.get(f"/heatmap-data?since={cursor}").get_json()
+
+            self.assertTrue(data["reset"])
+            self.assertIn(4321.0, [point["value"] for point in data["data"]])
+            self.assertNotEqual(data["cursor"], cursor)
+            self.assertFalse(self.client1.get(f"/heatmap-data?since={data['cursor']}").get_json()["reset"])
+        finally:
+            Internet.objects.filter(unique_id=unique_id).delete()
+            Location.objects.filter(unique_id=unique_id).delete()
+
+    def test_heatmap_delta_max_cached_by_data_version(self):
+        """
+        Test if unwindowed deltas only query the overall max again after the data version moves.
+        """
+        self.routes_instance.db_handler.get_data_since = MagicMock(return_value=({}, (0, 0)))
+        self.routes_instance.db_handler.get_max_download = MagicMock(return_value=40.0)
+        self.routes_instance.db_handler.get_data_version = MagicMock(return_value=5)
+
+        for _ in range(3):
+            self.assertEqual(self.client1.get("/heatmap-data?since=0.0").get_json()["max"], 40.0)
+        self.assertEqual(self.routes_instance.db_handler.get_max_download.call_count, 1)
+
+        self.routes_instance.db_handler.get_data_version.return_value = 6
+        self.routes_instance.db_handler.get_max_download.return_value = 55.0
+        self.assertEqual(self.client1.get("/heatmap-data?since=0.0").get_json()["max"], 55.0)
+        self.assertEqual(self.routes_instance.db_handler.get_max_download.call_count, 2)
+
+    def test_heatmap_data_time_window(self):
+        """
+        Test if /heatmap-data?from=&to= passes the window to the database queries,
+        builds windowed payloads fresh each time and rejects an invalid range.
+        """
+        mock_data = {1: {"download": 10.5, "location": {"latitude": 43.0376, "longitude": -76.1326}}}
+        self.routes_instance.db_handler.get_data = MagicMock(return_value=mock_data)
+        self.routes_instance.db_handler.get_data_since = MagicMock(return_value=({}, (0, 0)))
+        self.routes_instance.db_handler.get_max_download = MagicMock(return_value=None)
+
+        first = self.client1.get("/heatmap-data?from=1700000000&to=1700003600")
+        self.client1.get("/heatmap-data?from=1700000000&to=1700003600")
+        self.client1.get("/heatmap-data?bin=10&from=1700000000")
+        self.client1.get("/heatmap-data?since=0&to=1700003600")
+
+        self.assertEqual(len(first.get_json()["data"]), 1)
+        self.assertEqual(self.routes_instance.db_handler.get_data.call_args_list[0].args, (1700000000.0, 1700003600.0))
+        self.assertEqual(self.routes_instance.db_handler.get_data.call_count, 3)
+        self.assertEqual(self.routes_instance.db_handler.get_data.call_args.args, (1700000000.0, None))
+        self.routes_instance.db_handler.get_data_since.assert_called_once_with(0, 0, None, 1700003600.0)
+        self.routes_instance.db_handler.get_max_download.assert_called_once_with(None, 1700003600.0)
+        for query in ["from=abc", "to=nan", "from=1700003600&to=1700000000"]:
+            self.assertEqual(self.client1.get(f"/heatmap-data?{query}").status_code, 400, msg = query)
+
+    def test_time_window_out_of_range(self):
+        """
+        Test if timestamps too large or small for a datetime are refused with 400 instead of failing in the query.
+        """
+        for path in ["/heatmap-data?from=1e20", "/heatmap-data?since=0&to=-1e20", "/heatmap-data?bin=10&from=1e20",
+                     "/measurements?bbox=43,-77,44,-76&from=1e20", "/get-location-trail/some-session?to=1e20"]:
+            response = self.client1.get(path)
+            self.assertEqual(response.status_code, 400, msg = path)
+            self.assertIn("out of range", response.get_json()["error"], msg = path)
+
+    def test_measurements_pixel_bbox(self):
+        """
+        Test if /measurements?pixel_bbox= queries the lat/lon box around the pixel box and keeps
+        only the tests inside it, while ?bbox= passes the box straight through.
+        """
+        inside = CONTROL_POINTS[0][0] # Pixel (0, 0)
+        outside = CONTROL_POINTS[3][0] # Pixel (IMAGE_WIDTH, IMAGE_HEIGHT)
+        mock_data = {
+            1: {"download": 10.0, "upload": 5.0, "ping": 20.0, "location": {"latitude": inside[0], "longitude": inside[1]}},
+            2: {"download": 30.0, "upload": 15.0, "ping": 8.0, "location": {"latitude": outside[0], "longitude": outside[1]}},
+        }
+        self.routes_instance.db_handler.get_data_in_bbox = MagicMock(return_value=mock_data)
+
+        data = self.client1.get("/measurements?pixel_bbox=0,0,100,100&from=1700000000").get_json()
+
+        self.assertEqual([m["id"] for m in data["measurements"]], [1])
+        self.assertEqual(data["summary"], {"count": 1, "download_mean": 10.0, "upload_mean": 5.0, "ping_mean": 20.0})
+        args, kwargs = self.routes_instance.db_handler.get_data_in_bbox.call_args
+        self.assertAlmostEqual(args[2], inside[0], places=9) # max_lat is the top left corner's
+        self.assertEqual(kwargs, {"start": 1700000000.0, "end": None})
+
+        data = self.client1.get("/measurements?bbox=43.0372,-76.1330,43.0380,-76.1321").get_json()
+        self.assertEqual(data["summary"]["count"], 2)
+        self.assertEqual(self.routes_instance.db_handler.get_data_in_bbox.call_args.args, (43.0372, -76.1330, 43.0380, -76.1321))
+
+    def test_measurements_invalid_bbox(self):
+        """
+        Test if /measurements requires exactly one well-formed bounding box.
+        """
+        for query in ["", "bbox=1,2,3,4&pixel_bbox=1,2,3,4", "bbox=1,2,3", "bbox=3,2,1,4", "pixel_bbox=a,b,c,d", "bbox=1,2,3,inf"]:
+            self.assertEqual(self.client1.get(f"/measurements?{query}").status_code, 400, msg = query)
+
+    def test_heatmap_data_since_invalid_cursor(self):
+        """
+        Test if /heatmap-data?since= rejects a malformed cursor with 400.
+        """
+        for cursor in ["abc", "12", "1.x", "-1.0", "1.2.-3", "1.2.3.4"]:
+            response = self.client1.get(f"/heatmap-data?since={cursor}")
+            self.assertEqual(response.status_code, 400, msg = f"Cursor '{cursor}' was accepted")
+
+    def test_heatmap_data_binned(self):
+        """
+        Test if /heatmap-data?bin= aggregates points that share a grid cell
+        into one point with the cell's mean, max and count.
+        """
+        mock_data = {
+            1: {"download": 10.0, "location": {"latitude": 43.0376, "longitude": -76.1326}},
+            2: {"download": 30.0, "location": {"latitude": 43.0376, "longitude": -76.1326}},
+            3: {"download": 5.0, "location": {"latitude": 43.0374, "longitude": -76.1324}},
+        }
+        self.routes_instance.db_handler.get_data = MagicMock(return_value=mock_data)
+
+        response = self.client1.get("/heatmap-data?bin=50")
+        data = response.get_json()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data["bin"], 50)
+        self.assertEqual(len(data["data"]), 2)
+        shared_cell = max(data["data"], key=lambda cell: cell["count"])
+        self.assertEqual(shared_cell["count"], 2)
+        self.assertAlmostEqual(shared_cell["value"], 20.0)
+        self.assertAlmostEqual(shared_cell["max"], 30.0)
+        self.assertAlmostEqual(data["max"], 20.0)
+
+    def test_heatmap_data_binned_invalid_size(self):
+        """
+        Test if /heatmap-data?bin= rejects non-numeric and out of range cell sizes with 400.
+        """
+        for cell_size in ["abc", "0", "5000"]:
+            response = self.client1.get(f"/heatmap-data?bin={cell_size}")
+            self.assertEqual(response.status_code, 400, msg = f"Bin size '{cell_size}' was accepted")
+
+    def test_bin_heatmap_points(self):
+        """
+        Test if bin_heatmap_points groups pixels by cell and reports per-cell statistics,
+        including cells on the image's bottom-right edge.
+        """
+        center_x, center_y, means, maxima, counts = bin_heatmap_points(
+            [0, 9, 15, IMAGE_WIDTH - 1], [0, 9, 0, IMAGE_HEIGHT - 1], [2.0, 4.0, 7.0, 1.0], 10)
+
+        self.assertEqual(counts.tolist(), [2, 1, 1])
+        self.assertEqual(means.tolist(), [3.0, 7.0, 1.0])
+        self.assertEqual(maxima.tolist(), [4.0, 7.0, 1.0])
+        # The last column's center would fall off the image, so it is clamped to the edge
+        self.assertEqual(center_x.tolist(), [5, 15, IMAGE_WIDTH - 1])
+        self.assertEqual(center_y.tolist(), [5, 5, 795])
+
+    def test_get_live_locations(self):
+        """
+        Test if /get-live-locations returns the same entries as /get-live-location for a list of
+        sessions, and every tracked session when no list is given.
+        """
+        corner = CONTROL_POINTS[0][0]
+        self.routes_instance.sessions.update_location("wall-1", corner[0], corner[1])
+        self.routes_instance.sessions.update_location("wall-2", 0.0, 0.0)
+
+        response = self.client1.get("/get-live-locations?session_ids=wall-1,wall-2,wall-3")
+
+        self.assertEqual(response.status_code, 200)
+        sessions = response.get_json()["sessions"]
+        for session_id in ("wall-1", "wall-2", "wall-3"):
+            single = self.client1.get(f"/get-live-location/{session_id}").get_json()
+            self.assertEqual(sessions[session_id], single)
+        self.assertEqual(sessions["wall-1"], {"x": 0, "y": 0, "in_bounds": True, "found": True})
+        self.assertFalse(sessions["wall-3"]["found"])
+
+        everything = self.client1.post("/get-live-locations", json={}).get_json()["sessions"]
+        self.assertEqual(set(everything), {"wall-1", "wall-2"})
+
+    def test_get_live_locations_invalid_list(self):
+        """
+        Test if /get-live-locations rejects a session_ids value that is not a list of strings.
+        """
+        response = self.client1.post("/get-live-locations", json={"session_ids": "wall-1"})
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_requests_recycle_database_connections(self):
+        """
+        Test if every Flask request runs Django's connection recycling before and after it,
+        which Django would otherwise only do on its own request signals.
+        """
+        with patch("Routes.close_old_connections") as close_old_connections:
+            routes = Routes(Flask(__name__))
+            routes.app.test_client().get("/get_all_sessions")
+
+        self.assertEqual(close_old_connections.call_count, 2)
+
+    def test_session_listings_with_mixed_id_types(self):
+        """
+        Test if session listings still work when the store holds a non-string id next to string ones.
+        """
+        self.routes_instance.sessions.update_location(12345, 43.0, -76.0)
+        self.routes_instance.sessions.update_location("mixed-session", 43.0, -76.0)
+
+        live = self.client1.get("/get-live-locations")
+        listed = self.client1.get("/get_all_sessions")
+
+        self.assertEqual((live.status_code, listed.status_code), (200, 200))
+        self.assertIn("12345", live.get_json()["sessions"])
+        self.assertIn("12345", listed.get_json())
+
+    def test_location_trail_route(self):
+        """
+        Test if /get-location-trail returns a session's samples in range, mapped to pixels.
+        """
+        session_id = "trail-session"
+        corner = CONTROL_POINTS[0][0]
+        self.routes_instance.sessions.update_location(session_id, corner[0], corner[1], timestamp=100.0)
+        self.routes_instance.sessions.update_location(session_id, 0.0, 0.0, timestamp=200.0)
+        self.routes_instance.sessions.update_location(session_id, corner[0], corner[1], timestamp=300.0)
+
+        response = self.client1.get(f"/get-location-trail/{session_id}?from=150&to=300")
+
+        self.assertEqual(response.status_code, 200)
+        points = response.get_json()["points"]
+        self.assertEqual([point["timestamp"] for point in points], [200.0, 300.0])
+        self.assertFalse(points[0]["in_bounds"])
+        self.assertEqual((points[1]["x"], points[1]["y"], points[1]["in_bounds"]), (0, 0, True))
+
+    def test_location_trail_route_errors(self):
+        """
+        Test if /get-location-trail rejects a bad time range and unknown sessions.
+        """
+        self.routes_instance.sessions.update_location("trail-session-2", 43.0, -76.0)
+
+        self.assertEqual(self.client1.get("/get-location-trail/trail-session-2?from=yesterday").status_code, 400)
+        self.assertEqual(self.client1.get("/get-location-trail/unknown-session").status_code, 404)
+        empty = self.client1.get("/get-location-trail/trail-session-2?to=0")
+        self.assertEqual(empty.get_json()["points"], [])
+
+    def test_live_location_stream_pushes_changes(self):
+        """
+        Test if the live location stream sends the current state, a heartbeat while idle,
+        and an event as soon as the session's location changes.
+        """
+        session_id = "stream-session-1"
+        stream = self.routes_instance.stream_live_location(session_id, heartbeat_seconds=0.2)
+
+        self.assertTrue(next(stream).startswith("retry:"))
+        first = json.loads(next(stream)[len("data: "):])
+        self.assertFalse(first["found"])
+        self.assertEqual(next(stream), ": heartbeat\n\n")
+
+        # Update the location from another thread while the stream is waiting
+        def post_location():
+            time.sleep(0.01)
+            self.client2.post("/save_user_location", json={"session_id": session_id, "latitude": 43.0376, "longitude": -76.1326})
+        poster = threading.Thread(target=post_location)
+        poster.start()
+        event = next(stream)
+        poster.join()
+
+        self.assertTrue(event.startswith("data: "))
+        update = json.loads(event[len("data: "):])
+        self.assertTrue(update["found"])
+        self.assertTrue(update["in_bounds"])
+        stream.close()
+
+    def test_live_location_stream_route(self):
+        """
+        Test if /live-location-stream returns an event stream and frees its slot when closed.
+        """
+        response = self.client1.get("/live-location-stream/stream-session-2")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "text/event-stream")
+        chunks = iter(response.response)
+        self.assertTrue(next(chunks).startswith(b"retry:"))
+        response.close()
+
+        # All slots should be free again once the stream is closed
+        slots = self.routes_instance.live_stream_slots
+        acquired = sum(1 for _ in range(MAX_LIVE_STREAMS) if slots.acquire(blocking=False))
+        self.assertEqual(acquired, MAX_LIVE_STREAMS)
+
+    def test_live_location_stream_limit(self):
+        """
+        Test if /live-location-stream answers 503 once the concurrent stream cap is reached.
+        """
+        self.routes_instance.live_stream_slots = threading.BoundedSemaphore(1)
+        self.routes_instance.live_stream_slots.acquire()
+
+        response = self.client1.get("/live-location-stream/stream-session-3")
+
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Retry-After", response.headers)
+
+
+class TestSessionStore(unittest.TestCase):
+    """Test for the striped session store and its LRU-ordered expiry."""
+
+    def setUp(self):
+        self.store = SessionStore(stripes=4)
+
+    def test_location_and_generated_id_expire_together(self):
+        """
+        Test if expiry removes a stale session's location and generated id, but keeps fresh ones.
+        """
+        self.store.update_location("old", 43.0, -76.0, timestamp=100.0)
+        self.store.set_generated_id("old", 123456, timestamp=100.0)
+        self.store.update_location("fresh", 43.1, -76.1, timestamp=1000.0)
+
+        expired = self.store.expire(timeout_seconds=500, now=1100.0)
+
+        self.assertEqual(expired, ["old"])
+        self.assertIsNone(self.store.get_location("old"))
+        self.assertIsNone(self.store.get_generated_id("old"))
+        self.assertEqual(self.store.get_location("fresh"), (43.1, -76.1, 1000.0))
+        self.assertEqual(len(self.store), 1)
+
+    def test_refreshed_session_survives_expiry(self):
+        """
+        Test if a session updated after it was first seen survives expiry and expires later.
+        """
+        self.store.update_location("session", 43.0, -76.0, timestamp=100.0)
+        self.store.update_location("session", 43.0, -76.0, timestamp=900.0)
+
+        self.assertEqual(self.store.expire(timeout_seconds=500, now=1000.0), [])
+        self.assertEqual(self.store.expire(timeout_seconds=500, now=1500.0), ["session"])
+
+    def test_expire_only_pops_due_entries(self):
+        """
+        Test if expiry stops at the first session in each stripe's LRU list that is not yet due.
+        """
+        for i in range(10):
+            self.store.update_location(f"s{i}", 43.0, -76.0, timestamp=float(i))
+
+        expired = self.store.expire(timeout_seconds=5, now=8.0)
+
+        self.assertEqual(sorted(expired), ["s0", "s1", "s2"])
+        self.assertEqual(len(self.store.session_ids()), 7)
+
+    def test_late_samples_keep_lru_order(self):
+        """
+        Test if a new session whose samples are older than the stripe's newest one is not expired first.
+        """
+        store = SessionStore(stripes=1)
+        store.update_location("current", 43.0, -76.0, timestamp=1000.0)
+        store.update_locations([("reconnected", 43.0, -76.0, 100.0)])
+
+        self.assertEqual(store.get_location("reconnected"), (43.0, -76.0, 100.0))
+        self.assertEqual(store.expire(timeout_seconds=500, now=1200.0), [])
+        self.assertEqual(store.expire(timeout_seconds=500, now=1600.0), ["current", "reconnected"])
+
+    def test_lru_list_consistent_under_churn(self):
+        """
+        Test if removing and evicting sessions and adding new ones keeps the LRU and free slot chains intact.
+        """
+        store = SessionStore(stripes=2, capacity=8)
+        for i in range(200):
+            store.update_location(f"s{i}", 43.0, -76.0, timestamp=float(i))
+            if i % 3 == 0:
+                store.remove(f"s{i}")
+
+        for stripe in store.stripes:
+            order = []
+            slot = stripe.lru_head
+            while slot != -1:
+                order.append(slot)
+                slot = stripe.lru_next[slot]
+            self.assertEqual(sorted(order), sorted(stripe.slots.values()))
+            self.assertEqual([stripe.last_seen[slot] for slot in order], sorted(stripe.last_seen[slot] for slot in order))
+        remaining = sorted(store.session_ids())
+        self.assertEqual(sorted(store.expire(timeout_seconds=5, now=1000.0)), remaining)
+        self.assertEqual(len(store), 0)
+        self.assertTrue(all(stripe.lru_head == -1 for stripe in store.stripes))
+
+    def test_capacity_evicts_least_recently_updated(self):
+        """
+        Test if a full store evicts the least recently updated session and reuses its slot.
+        """
+        store = SessionStore(stripes=1, capacity=2)
+        store.update_location("a", 43.0, -76.0, timestamp=1.0)
+        store.set_generated_id("b", 111111, timestamp=2.0)
+        store.update_location("a", 43.5, -76.5, timestamp=3.0) # "a" is now the most recent
+
+        store.update_location("c", 44.0, -77.0, timestamp=4.0)
+
+        self.assertIsNone(store.get_generated_id("b"))
+        self.assertEqual(store.get_location("a"), (43.5, -76.5, 3.0))
+        self.assertEqual(store.get_location("c"), (44.0, -77.0, 4.0))
+        self.assertEqual(store.stripes[0].slots["c"], 1) # Took over the evicted session's slot
+        self.assertEqual(store.get_stats()["evictions"], 1)
+
+    def test_stats_report_memory(self):
+        """
+        Test if the stats report the preallocated columns and grow with the tracked sessions.
+        """
+        store = SessionStore(stripes=2, capacity=100)
+        empty = store.get_stats()
+        for i in range(50):
+            store.update_location(f"device-{i}", 43.0, -76.0, timestamp=float(i))
+        stats = store.get_stats()
+
+        self.assertEqual(stats["capacity"], 100)
+        self.assertEqual(stats["sessions"], 50)
+        self.assertEqual(stats["column_bytes"], empty["column_bytes"])
+        self.assertGreater(stats["memory_bytes"], empty["memory_bytes"])
+        self.assertEqual(stats["memory_bytes"], stats["column_bytes"] + stats["trail_bytes"] + stats["index_bytes"])
+
+    def test_memory_per_session(self):
+        """
+        Test if a full store, columns and index included, costs less per session than a plain
+        {session_id: (lat, lon, timestamp)} dict with a second dict for the generated ids, and if
+        trails add no more than their preallocated samples.
+        """
+        capacity = 20000
+        session_ids = [f"device-{i:08d}" for i in range(capacity)] # Owned by the caller, not counted
+
+        def traced_bytes(fill):
+            tracemalloc.start()
+            try:
+                before = tracemalloc.get_traced_memory()[0]
+                kept = fill()
+                return tracemalloc.get_traced_memory()[0] - before, kept
+            finally:
+                tracemalloc.stop()
+
+        def fill_store():
+            store = SessionStore(stripes=16, capacity=capacity)
+            for i, session_id in enumerate(session_ids):
+                store.set_generated_id(session_id, 100000 + i, timestamp=float(i))
+            return store
+
+        def fill_located_store():
+            store = SessionStore(stripes=16, capacity=capacity)
+            for i, session_id in enumerate(session_ids):
+                store.update_location(session_id, 43.0, -76.0, timestamp=float(i))
+            return store
+
+        def fill_dicts():
+            locations = {}; generated_ids = {}
+            for i, session_id in enumerate(session_ids):
+                locations[session_id] = (43.0 + i * 1e-6, -76.0, float(i))
+                generated_ids[session_id] = 100000 + i
+            return locations, generated_ids
+
+        store_bytes, store = traced_bytes(fill_store)
+        dict_bytes, _ = traced_bytes(fill_dicts)
+        located_bytes, located_store = traced_bytes(fill_located_store)
+
+        sessions = len(store) # A little under capacity, ids don't hash perfectly evenly over the stripes
+        self.assertGreater(sessions, capacity * 0.9)
+        store_bytes -= store.get_stats()["trail_bytes"] # Checked on its own below
+        self.assertLess(store_bytes / sessions, 128)
+        self.assertLess(store_bytes / sessions, dict_bytes / capacity)
+        trail_slot_bytes = SESSION_TRAIL_LENGTH * 3 * 8 + 2 * 4
+        self.assertLess(located_bytes / len(located_store), 128 + trail_slot_bytes)
+
+    def test_trail_ring_buffer_keeps_recent_samples(self):
+        """
+        Test if the trail keeps only the newest samples, in order, and filters by time range.
+        """
+        store = SessionStore(stripes=1, capacity=1, trail_length=3)
+        for i in range(5):
+            store.update_location("device", 43.0 + i, -76.0 - i, timestamp=float(i))
+        buffer = store.stripes[0].trail_time
+
+        self.assertEqual(store.get_trail("device"), ([2.0, 3.0, 4.0], [45.0, 46.0, 47.0], [-78.0, -79.0, -80.0]))
+        self.assertEqual(store.get_trail("device", start_time=3.0, end_time=3.5), ([3.0], [46.0], [-79.0]))
+        self.assertIs(store.stripes[0].trail_time, buffer) # Appends reuse the preallocated columns
+        self.assertEqual(len(buffer), 3)
+        self.assertIsNone(store.get_trail("unknown"))
+
+        # A new session reusing the slot starts with an empty trail
+        store.remove("device")
+        store.update_location("other", 44.0, -77.0, timestamp=10.0)
+        self.assertEqual(store.get_trail("other"), ([10.0], [44.0], [-77.0]))
+
+    def test_wait_only_woken_by_own_session(self):
+        """
+        Test if a waiting live stream is notified for its own session only, not for others in its stripe.
+        """
+        store = SessionStore(stripes=1)
+        store.update_location("watched", 43.0, -76.0, timestamp=1.0)
+        stripe = store.stripes[0]
+        result = []
+        waiting = threading.Thread(target=lambda: result.append(
+            store.wait_for_location_change("watched", (43.0, -76.0, 1.0), timeout=5.0)))
+        waiting.start()
+        deadline = time.monotonic() + 2.0
+        while "watched" not in stripe.waiters and time.monotonic() < deadline:
+            time.sleep(0.001)
+        condition = stripe.waiters["watched"].condition
+        condition.notify_all = MagicMock(side_effect=condition.notify_all)
+
+        for i in range(5):
+            store.update_location(f"other-{i}", 44.0, -77.0, timestamp=2.0)
+        self.assertEqual(condition.notify_all.call_count, 0)
+
+        store.update_location("watched", 43.5, -76.5, timestamp=3.0)
+        waiting.join(timeout=2.0)
+
+        self.assertEqual(condition.notify_all.call_count, 1)
+        self.assertEqual(result, [(43.5, -76.5, 3.0)])
+        self.assertEqual(stripe.waiters, {})
+
+    def test_cleanup_inactive_sessions_route_state(self):
+        """
+        Test if Routes.cleanup_inactive_sessions drops expired sessions from the live location lookup.
+        """
+        app = Flask(__name__)
+        routes_instance = Routes(app)
+        routes_instance.sessions.update_location("stale", 43.0, -76.0, timestamp=time.time() - 3600)
+        routes_instance.sessions.set_generated_id("stale", 654321)
+
+        # The generated id refreshed the session, so nothing is due yet
+        routes_instance.cleanup_inactive_sessions(1800)
+        self.assertEqual(routes_instance.get_all_sessions(), ["stale"])
+
+        routes_instance.cleanup_inactive_sessions(0)
+        self.assertEqual(routes_instance.get_all_sessions(), [])
+        self.assertEqual(routes_instance.get_user_session_location("stale"), (None, None))
+
+
+class TestSQLiteSessionStore(unittest.TestCase):
+    """Test for the SQLite session backend shared between worker processes."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temp_dir.name, "sessions.sqlite3")
+        self.store = SQLiteSessionStore(path=self.path, capacity=3, trail_length=2, poll_interval=0.01)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_stores_share_sessions(self):
+        """
+        Test if a second store on the same file (another worker) sees locations and test ids.
+        """
+        other = SQLiteSessionStore(path=self.path)
+        self.store.update_location("shared", 43.0, -76.0, timestamp=100.0)
+        self.store.set_generated_id("shared", 222222, timestamp=101.0)
+
+        self.assertEqual(other.get_location("shared"), (43.0, -76.0, 100.0))
+        self.assertEqual(other.get_generated_id("shared"), 222222)
+        self.assertEqual(other.get_locations(["shared", "missing"]), {"shared": (43.0, -76.0, 100.0)})
+
+    def test_sees_writes_from_another_process(self):
+        """
+        Test if a location written by a separate Python process is visible to this one.
+        """
+        code = ("from SessionStore import SQLiteSessionStore; "
+                f"SQLiteSessionStore(path={self.path!r}).update_location('worker-2', 44.0, -77.0, timestamp=5.0)")
+        subprocess.run([sys.executable, "-c", code], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+        self.assertEqual(self.store.get_location("worker-2"), (44.0, -77.0, 5.0))
+
+    def test_batch_trail_and_expiry(self):
+        """
+        Test if batches skip stale fixes, the trail keeps only the newest samples and
+        expiry removes the session with its trail.
+        """
+        applied, stale = self.store.update_locations([
+            ("device", 43.0, -76.0, 1.0), ("device", 43.2, -76.2, 3.0), ("device", 43.1, -76.1, 2.0)])
+        self.assertEqual((applied, stale), (3, 0))
+        self.assertEqual(self.store.update_locations([("device", 42.0, -75.0, 2.5)]), (0, 1))
+
+        self.assertEqual(self.store.get_location("device"), (43.2, -76.2, 3.0))
+        self.assertEqual(self.store.get_trail("device"), ([2.0, 3.0], [43.1, 43.2], [-76.1, -76.2]))
+
+        self.assertEqual(self.store.expire(timeout_seconds=10, now=20.0), ["device"])
+        self.assertIsNone(self.store.get_trail("device"))
+        self.assertEqual(len(self.store), 0)
+
+    def test_capacity_evicts_least_recently_seen(self):
+        """
+        Test if adding a session beyond capacity evicts the least recently seen one.
+        """
+        for i in range(4):
+            self.store.update_location(f"s{i}", 43.0, -76.0, timestamp=float(i))
+
+        self.assertIsNone(self.store.get_location("s0"))
+        self.assertEqual(sorted(self.store.session_ids()), ["s1", "s2", "s3"])
+        self.assertEqual(self.store.get_stats()["evictions"], 1)
+
+    def test_wait_for_location_change_polls(self):
+        """
+        Test if waiting returns the new location written through another store, or times out.
+        """
+        other = SQLiteSessionStore(path=self.path)
+        self.assertIsNone(self.store.wait_for_location_change("polled", None, timeout=0.05))
+
+        timer = threading.Timer(0.02, lambda: other.update_location("polled", 43.0, -76.0, timestamp=1.0))
+        timer.start()
+        current = self.store.wait_for_location_change("polled", None, timeout=2.0)
+        timer.join()
+
+        self.assertEqual(current, (43.0, -76.0, 1.0))
+
+    def test_create_session_store(self):
+        """
+        Test if the backend factory defaults to memory and rejects unknown backends.
+        """
+        self.assertIsInstance(create_session_store("memory"), SessionStore)
+        self.assertIsInstance(create_session_store("sqlite", path=self.path), SQLiteSessionStore)
+        with self.assertRaises(ValueError):
+            create_session_store("redis")
+
+
+class TestCoordinateMapping(unittest.TestCase):
+    """Test for the lat/lon to pixel transform in Routes."""
+
+    def test_batch_maps_corners(self):
+        """
+        Test if the control point corners land on the image corners, clamped inside the image.
+        """
+        latitudes = [point[0][0] for point in CONTROL_POINTS]
+        longitudes = [point[0][1] for point in CONTROL_POINTS]
+
+        x_pixels, y_pixels, in_bounds, valid = map_lat_lon_batch(latitudes, longitudes)
+
+        self.assertEqual(x_pixels.tolist(), [0, IMAGE_WIDTH - 1, 0, IMAGE_WIDTH - 1])
+        self.assertEqual(y_pixels.tolist(), [0, 0, IMAGE_HEIGHT - 1, IMAGE_HEIGHT - 1])
+        self.assertTrue(in_bounds.all())
+        self.assertTrue(valid.all())
+
+    def test_batch_flags_out_of_bounds_and_invalid(self):
+        """
+        Test if points off the map are clamped and flagged, and non-numeric entries are marked invalid.
+        """
+        x_pixels, y_pixels, in_bounds, valid = map_lat_lon_batch(
+            [43.0376, 43.0400, "bad", None], [-76.1326, -76.1326, -76.1326, -76.1326])
+
+        self.assertEqual(in_bounds.tolist(), [True, False, False, False])
+        self.assertEqual(valid.tolist(), [True, True, False, False])
+        self.assertEqual(x_pixels[1], 0) # North of the map clamps to the left edge
+
+    def test_scalar_wrapper_matches_batch(self):
+        """
+        Test if map_lat_lon_to_pixels returns the batch result as plain Python values.
+        """
+        x_pixels, y_pixels, in_bounds, _ = map_lat_lon_batch([43.0376], [-76.1326])
+
+        result = map_lat_lon_to_pixels("43.0376", "-76.1326")
+
+        self.assertEqual(result, (int(x_pixels[0]), int(y_pixels[0]), bool(in_bounds[0])))
+        self.assertIsInstance(result[0], int)
+        self.assertEqual(map_lat_lon_to_pixels("bad", "data"), (None, None, False))
+
+    def test_pixels_to_lat_lon_inverts_mapping(self):
+        """
+        Test if the inverse transform maps the corners back to their control points
+        and round-trips an interior pixel.
+        """
+        latitudes, longitudes = map_pixels_to_lat_lon_batch([point[1][0] for point in CONTROL_POINTS],
+                                                            [point[1][1] for point in CONTROL_POINTS])
+        for (lat_lon, _), latitude, longitude in zip(CONTROL_POINTS, latitudes, longitudes):
+            self.assertAlmostEqual(latitude, lat_lon[0], places=9)
+            self.assertAlmostEqual(longitude, lat_lon[1], places=9)
+
+        x_float, y_float, _ = project_lat_lon_batch(*map_pixels_to_lat_lon_batch([321.5], [654.25]))
+        self.assertAlmostEqual(x_float[0], 321.5, places=4)
+        self.assertAlmostEqual(y_float[0], 654.25, places=4)
+
+    def test_spatial_cells_cover_bbox(self):
+        """
+        Test if every point inside a bounding box has a spatial key in one of its covering ranges,
+        and the ranges stay few for a box of any size.
+        """
+        rng = np.random.default_rng(7)
+        for min_lat, min_lon, max_lat, max_lon in [(43.0373, -76.1329, 43.0377, -76.1324), (-10.0, -20.0, 50.0, 80.0), (43.0376, -76.1326, 43.0376, -76.1326)]:
+            ranges = covering_ranges(min_lat, min_lon, max_lat, max_lon)
+            self.assertLessEqual(len(ranges), 64)
+            for lat, lon in zip(rng.uniform(min_lat, max_lat, 200), rng.uniform(min_lon, max_lon, 200)):
+                cell = spatial_cell(lat, lon)
+                self.assertTrue(any(low <= cell <= high for low, high in ranges), msg = f"({lat}, {lon}) not covered")
+        self.assertIsNone(spatial_cell(None, -76.0))
+        self.assertIsNone(spatial_cell(float("nan"), -76.0))
+
+    def test_calibrate_affine_rejects_collinear_points(self):
+        """
+        Test if calibration fails for control points that cannot define a 2D transform.
+        """
+        collinear = [((1.0, 1.0), (0, 0)), ((2.0, 2.0), (10, 10)), ((3.0, 3.0), (20, 20))]
+
+        with self.assertRaises(ValueError):
+            calibrate_affine(collinear)
+
+
+class TestBackendRoutes(unittest.TestCase):
+    """Test for the LibreSpeed backend routes defined in BackendRoutes."""
+
+    def setUp(self):
+        """
+        Set up a test Flask app with the backend blueprint registered.
+        """
+        self.app = Flask(__name__)
+        self.app.config['TESTING'] = True
+        self.app.register_blueprint(backend_bp)
+        self.client = self.app.test_client()
+
+    def test_garbage_streams_requested_chunks(self):
+        """
+        Test if /backend/garbage streams ckSize copies of the shared buffer
+        with an exact Content-Length.
+        """
+        response = self.client.get("/backend/garbage?ckSize=3")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.headers["Content-Length"], str(3 * len(PREGENERATED_DATA)))
+        self.assertEqual(response.data, PREGENERATED_DATA * 3)
+
+    def test_garbage_invalid_chunk_size(self):
+        """
+        Test if /backend/garbage falls back to 4 chunks for an invalid ckSize
+        and clamps oversized values to 1024.
+        """
+        response = self.client.get("/backend/garbage?ckSize=abc")
+        self.assertEqual(response.headers["Content-Length"], str(4 * len(PREGENERATED_DATA)))
+
+        response = self.client.get("/backend/garbage?ckSize=5000")
+        self.assertEqual(response.headers["Content-Length"], str(1024 * len(PREGENERATED_DATA)))
+        response.close()
+
+    def test_empty_records_upload(self):
+        """
+        Test if /backend/empty reads the upload and records the bytes per client and test id.
+        """
+        body = os.urandom(300 * 1024)
+        for _ in range(2):
+            response = self.client.post("/backend/empty?test_id=upload-test-1", data=body)
+            self.assertEqual(response.status_code, 200)
+
+        stats = self.client.get("/backend/transfer-stats?test_id=upload-test-1").get_json()
+
+        self.assertEqual(stats["upload"]["bytes"], 2 * len(body))
+        self.assertEqual(stats["upload"]["requests"], 2)
+        self.assertGreaterEqual(stats["upload"]["seconds"], 0)
+        self.assertEqual(self.client.get("/backend/transfer-stats?test_id=unknown").status_code, 404)
+
+    def test_garbage_records_download(self):
+        """
+        Test if /backend/garbage records the bytes it streamed per client and test id.
+        """
+        response = self.client.get("/backend/garbage?ckSize=2&test_id=download-test-1")
+        self.assertEqual(len(response.data), 2 * len(PREGENERATED_DATA))
+        response.close()
+
+        stats = self.client.get("/backend/transfer-stats?test_id=download-test-1").get_json()
+
+        self.assertEqual(stats["download"]["bytes"], 2 * len(PREGENERATED_DATA))
+        self.assertEqual(stats["download"]["requests"], 1)
+
+    def test_stream_garbage_counts_written_chunks(self):
+        """
+        Test if an abandoned download only counts the chunks the server asked past.
+        """
+        closed = []
+        chunks = stream_garbage(5, on_close=lambda nbytes, started, finished: closed.append((nbytes, finished >= started)))
+        next(chunks); next(chunks) # Second chunk handed out, first one written
+        chunks.close() # Client disconnected
+
+        self.assertEqual(closed, [(len(PREGENERATED_DATA), True)])
+
+        closed.clear()
+        list(stream_garbage(3, on_close=lambda nbytes, started, finished: closed.append(nbytes)))
+        self.assertEqual(closed, [3 * len(PREGENERATED_DATA)])
+
+    def test_discard_request_body_reuses_buffer(self):
+        """
+        Test if the body is read in fixed-size chunks into one buffer, with or without readinto.
+        """
+        class ReadOnlyStream:
+            def __init__(self, data): self.data = data; self.reads = []
+            def read(self, size):
+                self.reads.append(size)
+                chunk, self.data = self.data[:size], self.data[size:]
+                return chunk
+
+        self.assertEqual(discard_request_body(io.BytesIO(b"x" * 10000), chunk_size=4096), 10000)
+        stream = ReadOnlyStream(b"y" * 10000)
+        self.assertEqual(discard_request_body(stream, chunk_size=4096), 10000)
+        self.assertEqual(set(stream.reads), {4096})
+
+    def test_discard_request_body_reports_aborted_upload(self):
+        """
+        Test if an upload the client aborts still reports the bytes read before the abort.
+        """
+        class AbortedStream(io.BytesIO):
+            def readinto(self, buffer):
+                count = super().readinto(buffer)
+                if not count:
+                    raise ConnectionResetError("client went away")
+                return count
+
+        closed = []
+        with self.assertRaises(ConnectionResetError):
+            discard_request_body(AbortedStream(b"x" * 10000), chunk_size=4096,
+                                 on_close=lambda nbytes, started, finished: closed.append(nbytes))
+        self.assertEqual(closed, [10000])
+
+    def test_transfer_stats_bounded(self):
+        """
+        Test if the transfer table drops its oldest test and measures the span of overlapping requests.
+        """
+        stats = TransferStats(max_tests=2)
+        stats.record("1.1.1.1", "a", "upload", 1000000, 0.0, 1.0)
+        stats.record("1.1.1.1", "a", "upload", 1000000, 0.5, 1.0) # Parallel stream
+        stats.record("1.1.1.1", "b", "upload", 10, 0.0, 1.0)
+        stats.record("1.1.1.1", "c", "upload", 10, 0.0, 1.0)
+
+        self.assertIsNone(stats.get("1.1.1.1", "a"))
+        stats.record("2.2.2.2", "d", "upload", 1000000, 0.0, 1.0)
+        stats.record("2.2.2.2", "d", "upload", 1000000, 0.5, 1.0)
+        self.assertEqual(stats.get("2.2.2.2", "d")["upload"]["mbps"], 16.0)
+
+    def test_stream_garbage_reuses_buffer(self):
+        """
+        Test if stream_garbage hands out the pregenerated buffer itself
+        instead of copies of it.
+        """
+        chunks = list(stream_garbage(5))
+
+        self.assertEqual(len(chunks), 5)
+        for chunk in chunks:
+            self.assertIs(chunk, PREGENERATED_DATA)
+
+
+class TestProductionServer(unittest.TestCase):
+    """Test for the gunicorn configuration built by run_production."""
+
+    def test_multiple_workers_share_sessions(self):
+        """
+        Test if more than one worker switches memory sessions to SQLite, turns off the speed check and passes
+        the worker, thread and timeout options to gunicorn.
+        """
+        server = build_production_server(workers=4, threads=16, session_backend="memory")
+
+        self.assertEqual(server.session_backend, "sqlite")
+        self.assertFalse(server.check_speeds) # Each worker only sees its own transfers
+        self.assertEqual(server.cfg.workers, 4)
+        self.assertEqual(server.cfg.threads, 16)
+        self.assertEqual(server.cfg.worker_class_str, "gthread")
+        self.assertEqual(server.cfg.graceful_timeout, 30)
+
+    def test_single_worker_keeps_memory_sessions(self):
+        """
+        Test if a single worker keeps in-memory sessions and checks submitted speeds.
+        """
+        server = build_production_server(workers=1, threads=8, session_backend="memory")
+
+        self.assertEqual(server.session_backend, "memory")
+        self.assertEqual(server.cfg.workers, 1)
+        self.assertTrue(server.check_speeds)
+
+    def test_live_streams_leave_threads_free(self):
+        """
+        Test if live location streams may take at most half of a worker's threads.
+        """
+        self.assertEqual(build_production_server(workers=1, threads=32, session_backend="memory").max_live_streams, 16)
+        self.assertEqual(live_stream_limit(1), 0)
+        self.assertEqual(live_stream_limit(10000), MAX_LIVE_STREAMS)
+
+        routes = Routes(Flask(__name__), max_live_streams=1)
+        client = routes.app.test_client()
+        routes.live_stream_slots.acquire() # The only slot is taken by another stream
+        self.assertEqual(client.get("/live-location-stream/some-session").status_code, 503)
+
+
+class TestAsgiApp(unittest.TestCase):
+    """Test for the ASGI entry point serving the long-lived endpoints on the event loop."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.asgi_app = AsgiApp(FlaskApp())
+
+    def request(self, method, path, query=b"", body_chunks=(b"",), until=None):
+        """Runs one request through the ASGI app and returns the messages it sent."""
+        scope = {"type": "http", "method": method, "path": path, "query_string": query, "headers": [],
+                 "http_version": "1.1", "scheme": "http", "root_path": "", "server": ("testserver", 80)}
+        sent = []
+        async def run():
+            incoming = asyncio.Queue()
+            for i, chunk in enumerate(body_chunks):
+                incoming.put_nowait({"type": "http.request", "body": chunk, "more_body": i < len(body_chunks) - 1})
+            async def send(message):
+                sent.append(message)
+                if until is not None and until(sent):
+                    incoming.put_nowait({"type": "http.disconnect"}) # The client goes away
+            await asyncio.wait_for(self.asgi_app(scope, incoming.get, send), timeout=5)
+        asyncio.run(run())
+        return sent
+
+    def test_garbage_streams_chunks(self):
+        """
+        Test if /backend/garbage sends ckSize chunks of the shared buffer with the Flask headers.
+        """
+        sent = self.request("GET", "/backend/garbage", b"ckSize=3&cors&test_id=asgi-download")
+
+        headers = dict(sent[0]["headers"])
+        self.assertEqual(sent[0]["status"], 200)
+        self.assertEqual(headers[b"content-length"], str(3 * len(PREGENERATED_DATA)).encode())
+        self.assertEqual(headers[b"access-control-allow-origin"], b"*")
+        bodies = sent[1:]
+        self.assertEqual(len(bodies), 3)
+        self.assertTrue(all(message["body"] is PREGENERATED_DATA for message in bodies))
+        self.assertFalse(bodies[-1]["more_body"])
+        self.assertEqual(transfer_stats.get("0.0.0.0", "asgi-download")["download"]["bytes"], 3 * len(PREGENERATED_DATA))
+
+    def test_empty_discards_upload(self):
+        """
+        Test if /backend/empty reads the whole upload, records it and answers with an empty body.
+        """
+        sent = self.request("POST", "/backend/empty", b"test_id=asgi-upload", body_chunks=(b"x" * 1024, b"y" * 1024, b""))
+
+        self.assertEqual(sent[0]["status"], 200)
+        self.assertEqual([value for name, value in sent[0]["headers"] if name == b"cache-control"],
+                         [b"no-store, no-cache, must-revalidate, max-age=0, s-maxage=0", b"post-check=0, pre-check=0"])
+        self.assertEqual(sent[1]["body"], b"")
+        self.assertEqual(transfer_stats.get("0.0.0.0", "asgi-upload")["upload"]["bytes"], 2048)
+
+    def test_empty_records_aborted_upload(self):
+        """
+        Test if an upload that ends in a client disconnect still records the bytes received.
+        """
+        scope = {"type": "http", "method": "POST", "path": "/backend/empty", "query_string": b"test_id=asgi-aborted",
+                 "headers": [], "http_version": "1.1", "scheme": "http", "root_path": "", "server": ("testserver", 80)}
+        messages = [{"type": "http.request", "body": b"x" * 1024, "more_body": True}, {"type": "http.disconnect"}]
+        sent = []
+        async def receive():
+            return messages.pop(0)
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(self.asgi_app(scope, receive, send))
+
+        self.assertEqual(sent, [])
+        self.assertEqual(transfer_stats.get("0.0.0.0", "asgi-aborted")["upload"]["bytes"], 1024)
+
+    def test_live_location_stream(self):
+        """
+        Test if the stream sends the retry line and the current location, and ends on disconnect.
+        """
+        self.asgi_app.sessions.update_location("asgi-session", CONTROL_POINTS[0][0][0], CONTROL_POINTS[0][0][1])
+
+        sent = self.request("GET", "/live-location-stream/asgi-session", until=lambda sent: len(sent) == 3)
+
+        self.assertEqual(dict(sent[0]["headers"])[b"content-type"], b"text/event-stream; charset=utf-8")
+        self.assertTrue(sent[1]["body"].startswith(b"retry:"))
+        event = json.loads(sent[2]["body"].decode()[len("data: "):])
+        self.assertEqual(event, {"x": 0, "y": 0, "in_bounds": True, "found": True})
+        self.assertEqual(self.asgi_app.live_streams, 0)
+
+    def test_live_location_stream_pushes_changes(self):
+        """
+        Test if a memory-backed stream gets a move from another thread pushed to it, without polling
+        through a worker thread, and unregisters its listener when it ends.
+        """
+        sessions = self.asgi_app.sessions
+        sessions.update_location("asgi-pushed", CONTROL_POINTS[0][0][0], CONTROL_POINTS[0][0][1])
+        def move(sent):
+            if len(sent) == 3: # The first location went out, move the device on another thread
+                threading.Thread(target=sessions.update_location,
+                                 args=("asgi-pushed", CONTROL_POINTS[3][0][0], CONTROL_POINTS[3][0][1])).start()
+            return len(sent) == 4
+
+        with patch("AsgiApp.asyncio.to_thread") as to_thread:
+            sent = self.request("GET", "/live-location-stream/asgi-pushed", until=move)
+
+        to_thread.assert_not_called()
+        event = json.loads(sent[3]["body"].decode()[len("data: "):])
+        self.assertTrue(event["found"])
+        self.assertGreater(event["x"], IMAGE_WIDTH / 2) # Moved from the top left to the bottom right corner
+        self.assertGreater(event["y"], IMAGE_HEIGHT / 2)
+        self.assertNotIn("asgi-pushed", sessions._stripe("asgi-pushed").waiters)
+
+    def test_other_routes_use_flask(self):
+        """
+        Test if routes without a native handler are answered by the Flask app.
+        """
+        sent = self.request("GET", "/get-live-location/asgi-unknown")
+
+        self.assertEqual(sent[0]["status"], 200)
+        body = b"".join(message.get("body", b"") for message in sent[1:])
+        self.assertFalse(json.loads(body)["found"])
+
+    def test_flask_routes_run_concurrently(self):
+        """
+        Test if two proxied Flask requests run at the same time, on separate threads.
+        """
+        app = Flask(__name__)
+        both_running = threading.Barrier(2, timeout=2)
+        @app.route("/wait")
+        def wait():
+            both_running.wait() # Breaks unless the other request is running too
+            return "ok"
+        wsgi = PooledWsgiToAsgi(app, threads=2)
+        scope = {"type": "http", "method": "GET", "path": "/wait", "query_string": b"", "headers": [],
+                 "http_version": "1.1", "scheme": "http", "root_path": "", "server": ("testserver", 80)}
+
+        async def one_request():
+            sent = []
+            async def receive():
+                return {"type": "http.request", "body": b"", "more_body": False}
+            async def send(message):
+                sent.append(message)
+            await wsgi(scope, receive, send)
+            return sent[0]["status"]
+        async def run():
+            return await asyncio.wait_for(asyncio.gather(one_request(), one_request()), timeout=5)
+
+        self.assertEqual(asyncio.run(run()), [200, 200])
+
+    def test_flask_teardown_runs_behind_asgi(self):
+        """
+        Test if a proxied Flask request is answered in full with its teardown hooks run on the pool thread.
+        """
+        app = Flask(__name__)
+        torn_down = []
+        app.teardown_request(lambda exc: torn_down.append(exc))
+        @app.route("/hello")
+        def hello():
+            return "hello"
+        wsgi = PooledWsgiToAsgi(app, threads=1)
+        scope = {"type": "http", "method": "GET", "path": "/hello", "query_string": b"", "headers": [],
+                 "http_version": "1.1", "scheme": "http", "root_path": "", "server": ("testserver", 80)}
+        sent = []
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(asyncio.wait_for(wsgi(scope, receive, send), timeout=5))
+
+        self.assertEqual(sent[0]["status"], 200)
+        self.assertEqual(b"".join(message.get("body", b"") for message in sent[1:]), b"hello")
+        self.assertEqual(torn_down, [None])
+
+
+class TestIspLookup(unittest.TestCase):
+    """Test for the cached and offline ISP lookups behind /backend/getIP?isp."""
+
+    def setUp(self):
+        prefix_file = tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False)
+        prefix_file.write("# cidr asn name\n8.8.0.0/16 AS15169 Google LLC\n8.8.8.0/24 AS15169 Google DNS\n"
+                          "2001:4860::/32 AS15169 Google IPv6\n\n1.0.0.0/8 AS13335\n")
+        prefix_file.close()
+        self.prefix_path = prefix_file.name
+
+    def tearDown(self):
+        os.remove(self.prefix_path)
+
+    def test_prefix_trie_longest_match(self):
+        """
+        Test if the trie returns the most specific prefix for IPv4 and IPv6 addresses.
+        """
+        trie = load_prefix_file(self.prefix_path)
+
+        self.assertEqual(len(trie), 4)
+        self.assertEqual(trie.lookup("8.8.8.8")["org"], "AS15169 Google DNS")
+        self.assertEqual(trie.lookup("8.8.4.4")["org"], "AS15169 Google LLC")
+        self.assertEqual(trie.lookup("2001:4860:4860::8888")["org"], "AS15169 Google IPv6")
+        self.assertEqual(trie.lookup("1.1.1.1")["org"], "AS13335")
+        self.assertIsNone(trie.lookup("9.9.9.9"))
+        default = PrefixTrie(); default.insert("0.0.0.0/0", "any")
+        self.assertEqual(default.lookup("203.0.113.7"), "any")
+
+    def test_get_ip_offline(self):
+        """
+        Test if /backend/getIP?isp answers from the prefix file without any network access.
+        """
+        app = Flask(__name__)
+        app.register_blueprint(backend_bp)
+        offline = IspLookup(prefix_table=load_prefix_file(self.prefix_path))
+
+        with patch("BackendRoutes.isp_lookup", offline):
+            data = app.test_client().get("/backend/getIP?isp", environ_base={"REMOTE_ADDR": "8.8.8.8"}).get_json()
+
+        self.assertEqual(data["ISP"], "15169 Google DNS")
+        self.assertEqual(data["processedString"], "8.8.8.8 - 15169 Google DNS")
+        self.assertEqual(data["rawIspInfo"]["network"], "8.8.8.0/24")
+        self.assertEqual(offline.lookup("not an ip"), NO_ISP)
+
+    def test_cache_and_negative_cache(self):
+        """
+        Test if answers are cached until their TTL, and failures are cached for the shorter TTL.
+        """
+        lookup = IspLookup(token="test", ttl_seconds=60, negative_ttl_seconds=0)
+        lookup._fetch = MagicMock(return_value=("Example ISP", {"org": "AS64500 Example ISP"}))
+
+        self.assertEqual(lookup.lookup("203.0.113.1")[0], "Example ISP")
+        self.assertEqual(lookup.lookup("203.0.113.1")[0], "Example ISP")
+        self.assertEqual(lookup._fetch.call_count, 1)
+
+        lookup._fetch.side_effect = requests.ConnectionError("down")
+        self.assertEqual(lookup.lookup("203.0.113.2"), NO_ISP)
+        self.assertEqual(lookup.lookup("203.0.113.2"), NO_ISP) # Negative entry already expired
+        self.assertEqual(lookup._fetch.call_count, 3)
+        self.assertEqual(lookup.get_stats()["failures"], 2)
+
+    def test_unexpected_response_is_negative_cached(self):
+        """
+        Test if a response that breaks parsing (a numeric "org") is cached as a failure
+        and leaves no pending lookup behind.
+        """
+        lookup = IspLookup(token="test", negative_ttl_seconds=60)
+        lookup.session = MagicMock()
+        lookup.session.get.return_value.json.return_value = {"org": 123}
+
+        self.assertEqual(lookup.lookup("203.0.113.3"), NO_ISP)
+        self.assertEqual(lookup.lookup("203.0.113.3"), NO_ISP)
+
+        self.assertEqual(lookup.session.get.call_count, 1)
+        stats = lookup.get_stats()
+        self.assertEqual((stats["pending"], stats["failures"]), (0, 1))
+
+    def test_slow_lookup_does_not_block(self):
+        """
+        Test if a slow lookup returns no ISP after the wait, is shared by concurrent requests,
+        and fills the cache when it completes.
+        """
+        release = threading.Event()
+        lookup = IspLookup(token="test", wait_seconds=0.01)
+        def slow_fetch(ip):
+            release.wait(5)
+            return "Slow ISP", {"org": "AS64501 Slow ISP"}
+        lookup._fetch = MagicMock(side_effect=slow_fetch)
+
+        self.assertEqual(lookup.lookup("198.51.100.1"), NO_ISP)
+        self.assertEqual(lookup.lookup("198.51.100.1"), NO_ISP)
+        self.assertEqual(lookup._fetch.call_count, 1)
+        release.set()
+        lookup.executor.shutdown(wait=True)
+        self.assertEqual(lookup.lookup("198.51.100.1")[0], "Slow ISP")
+
+
+class TestDatabaseHandler(unittest.TestCase):
+    """Test for the DatabaseHandler queries against the Django models."""
+
+    # IDs outside the range handed out by Routes.generate_id
+    TEST_IDS = [42, 43]
+
+    def setUp(self):
+        """
+        Set up a DatabaseHandler and clear any rows left over from the test IDs.
+        """
+        self.db_handler = DatabaseHandler()
+        self.tearDown()
+
+    def tearDown(self):
+        """
+        Remove the rows created for the test IDs.
+        """
+        Internet.objects.filter(unique_id__in=self.TEST_IDS).delete()
+        Location.objects.filter(unique_id__in=self.TEST_IDS).delete()
+
+    def test_get_data_joins_location(self):
+        """
+        Test if get_data joins a speed test to the location with the same unique_id
+        and leaves the location empty for a speed test without one.
+        """
+        Internet.objects.create(download=10, upload=5, ping=20, unique_id=42)
+        Location.objects.create(latitude=43.0376, longitude=-76.1326, unique_id=42)
+        Internet.objects.create(download=30, upload=15, ping=8, unique_id=43)
+
+        data = self.db_handler.get_data()
+
+        self.assertEqual(data[42]["download"], 10)
+        self.assertEqual(data[42]["ping"], 20)
+        self.assertEqual(data[42]["location"]["latitude"], 43.0376)
+        self.assertEqual(data[42]["location"]["longitude"], -76.1326)
+        self.assertEqual(data[43]["upload"], 15)
+        self.assertIsNone(data[43]["location"])
+
+    def test_get_data_ignores_orphan_location(self):
+        """
+        Test if get_data skips locations that have no matching speed test.
+        """
+        Location.objects.create(latitude=43.0376, longitude=-76.1326, unique_id=43)
+
+        data = self.db_handler.get_data()
+
+        self.assertNotIn(43, data)
+
+    def test_data_version_shared_between_handlers(self):
+        """
+        Test if a write through one handler (another worker process in production)
+        moves the data version every handler reads from the database.
+        """
+        other_handler = DatabaseHandler(write_behind=False)
+        before = self.db_handler.get_data_version()
+
+        other_handler.save_speed_test(10.0, 5.0, 20.0, 42)
+
+        self.assertGreater(self.db_handler.get_data_version(), before)
+
+    def test_get_data_since_cursor(self):
+        """
+        Test if get_data_since only returns pairs completed after the cursor,
+        whether the speed test or the location arrived last.
+        """
+        Internet.objects.create(download=30, upload=15, ping=8, unique_id=43)
+        _, cursor = self.db_handler.get_data_since(0, 0)
+
+        Internet.objects.create(download=10, upload=5, ping=20, unique_id=42)
+        Location.objects.create(latitude=43.0376, longitude=-76.1326, unique_id=42)
+        data, next_cursor = self.db_handler.get_data_since(*cursor)
+
+        self.assertIn(42, data)
+        self.assertNotIn(43, data)
+
+        # A location arriving for a speed test the client already has
+        Location.objects.create(latitude=43.0375, longitude=-76.1325, unique_id=43)
+        data, last_cursor = self.db_handler.get_data_since(*next_cursor)
+
+        self.assertEqual(list(data.keys()), [43])
+        self.assertEqual(data[43]["location"]["latitude"], 43.0375)
+        self.assertEqual(self.db_handler.get_data_since(*last_cursor), ({}, last_cursor))
+
+    def test_get_data_time_window(self):
+        """
+        Test if get_data, get_data_since and get_max_download only see speed tests measured
+        in the window, and tests without a measured time are left out of any window.
+        """
+        now = time.time()
+        old = Internet.objects.create(download=10, upload=5, ping=20, unique_id=42)
+        old.measured_at = datetime.datetime.fromtimestamp(now - 2 * 86400, tz=datetime.timezone.utc); old.save()
+        Internet.objects.create(download=30, upload=15, ping=8, unique_id=43)
+        Location.objects.create(latitude=43.0376, longitude=-76.1326, unique_id=42)
+        Location.objects.create(latitude=43.0375, longitude=-76.1325, unique_id=43)
+        undated = Internet.objects.create(download=99, upload=1, ping=1, unique_id=44)
+        Internet.objects.filter(pk=undated.pk).update(measured_at=None)
+        try:
+            recent = self.db_handler.get_data(start=now - 3600)
+            older = self.db_handler.get_data(end=now - 86400)
+
+            self.assertEqual(set(recent) & {42, 43, 44}, {43})
+            self.assertEqual(set(older) & {42, 43, 44}, {42})
+            self.assertEqual(recent[43]["location"]["latitude"], 43.0375)
+            self.assertEqual(self.db_handler.get_max_download(now - 3 * 86400, now - 86400), 10)
+            data, _ = self.db_handler.get_data_since(0, 0, now - 3600, now + 60)
+            self.assertEqual(set(data) & {42, 43, 44}, {43})
+            self.assertIn(44, self.db_handler.get_data())
+        finally:
+            Internet.objects.filter(unique_id=44).delete()
+
+    def test_get_data_in_bbox(self):
+        """
+        Test if bounding box queries return only speed tests located inside the box,
+        for rows saved through the handler, created directly or queued for a batch write.
+        """
+        self.db_handler.save_measurement(10.0, 5.0, 20.0, None, 43.0376, -76.1326, 42)
+        Internet.objects.create(download=30, upload=15, ping=8, unique_id=43)
+        Location.objects.create(latitude=43.0500, longitude=-76.1326, unique_id=43) # Outside the box
+
+        data = self.db_handler.get_data_in_bbox(43.0370, -76.1330, 43.0380, -76.1320)
+        self.assertEqual(set(data) & {42, 43}, {42})
+        self.assertEqual(data[42]["download"], 10.0)
+        wide = self.db_handler.get_data_in_bbox(43.0, -76.2, 43.1, -76.1)
+        self.assertEqual(set(wide) & {42, 43}, {42, 43})
+        self.assertEqual(Location.objects.get(unique_id=43).cell, spatial_cell(43.0500, -76.1326))
+
+        handler = DatabaseHandler(write_behind=True, flush_interval_ms=60000)
+        try:
+            handler.save_location(43.0500, -76.1326, 42)
+            self.assertTrue(handler.flush())
+        finally:
+            handler.close()
+        self.assertTrue(Location.objects.filter(unique_id=42, cell=spatial_cell(43.0500, -76.1326)).exists())
+
+    def test_save_speed_test_keeps_fractions(self):
+        """
+        Test if fractional Mbps and ms values are stored without truncation.
+        """
+        self.db_handler.save_speed_test(123.45, 50.2, 15.6, 42)
+
+        data = self.db_handler.get_data()
+
+        self.assertEqual(data[42]["download"], 123.45)
+        self.assertEqual(data[42]["upload"], 50.2)
+        self.assertEqual(data[42]["ping"], 15.6)
+
+    def test_save_location_stores_floats(self):
+        """
+        Test if saved coordinates come back as floats that SQLite can range filter.
+        """
+        self.db_handler.save_location(43.0376, -76.1326, 42)
+
+        in_range = Location.objects.filter(unique_id=42, latitude__gte=43.0, latitude__lte=43.1)
+
+        self.assertEqual(in_range.count(), 1)
+        self.assertIsInstance(in_range.first().longitude, float)
+
+    def test_write_behind_flushes_queued_records(self):
+        """
+        Test if write-behind mode queues saves and writes them all on flush.
+        """
+        handler = DatabaseHandler(write_behind=True, flush_interval_ms=60000)
+        try:
+            handler.save_speed_test(10.5, 5.0, 20.0, 42)
+            handler.save_location(43.0376, -76.1326, 42)
+
+            self.assertTrue(handler.flush())
+            data = self.db_handler.get_data()
+
+            self.assertEqual(data[42]["download"], 10.5)
+            self.assertEqual(data[42]["location"]["latitude"], 43.0376)
+            stats = handler.get_write_stats()
+            self.assertEqual(stats["records_flushed"], 2)
+            self.assertEqual(stats["queue_depth"], 0)
+        finally:
+            handler.close()
+
+    def test_save_measurement_atomic(self):
+        """
+        Test if save_measurement writes both rows, or neither when one of them fails.
+        """
+        self.db_handler.save_measurement(10.5, 5.0, 20.0, 1.25, 43.0376, -76.1326, 42)
+
+        data = self.db_handler.get_data()
+        self.assertEqual(data[42]["download"], 10.5)
+        self.assertEqual(data[42]["location"]["latitude"], 43.0376)
+        self.assertEqual(Internet.objects.get(unique_id=42).jitter, 1.25)
+
+        with patch.object(Location, "save", side_effect=Exception("disk full")):
+            with self.assertRaises(Exception):
+                self.db_handler.save_measurement(1.0, 1.0, 1.0, None, 43.0, -76.0, 43)
+        self.assertFalse(Internet.objects.filter(unique_id=43).exists())
+
+    def test_write_behind_measurement_flushed_together(self):
+        """
+        Test if a queued measurement counts as one queue item and is written in the same flush.
+        """
+        handler = DatabaseHandler(write_behind=True, flush_interval_ms=60000, flush_batch_size=1)
+        try:
+            handler.save_measurement(10.5, 5.0, 20.0, None, 43.0376, -76.1326, 42)
+
+            self.assertTrue(handler.flush())
+            self.assertEqual(self.db_handler.get_data()[42]["location"]["longitude"], -76.1326)
+            stats = handler.get_write_stats()
+            self.assertEqual(stats["records_flushed"], 2)
+            self.assertEqual(stats["flushes"], 1)
+        finally:
+            handler.close()
+
+    def test_id_allocator_threads(self):
+        """
+        Test if concurrent threads get unique IDs while blocks are reserved only as they run out.
+        """
+        reserved = []
+        def reserve(size):
+            start = reserved[-1][1] if reserved else 5000
+            reserved.append((start, start + size))
+            return reserved[-1]
+        allocator = IdAllocator(reserve, block_size=50)
+        ids = []; ids_lock = threading.Lock()
+        def allocate():
+            mine = [allocator.next_id() for _ in range(500)]
+            with ids_lock: ids.extend(mine)
+
+        threads = [threading.Thread(target=allocate) for _ in range(8)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+
+        self.assertEqual(sorted(ids), list(range(5000, 5000 + 8 * 500)))
+        self.assertEqual(len(reserved), 8 * 500 // 50)
+
+    def test_allocated_ids_enforced_unique(self):
+        """
+        Test if the database refuses a second speed test for an allocated ID,
+        and a write-behind batch with such a duplicate measurement still writes its other records.
+        """
+        start, end = self.db_handler.reserve_id_block(2)
+        self.assertGreaterEqual(start, FIRST_ALLOCATED_ID)
+        self.assertEqual(self.db_handler.reserve_id_block(1)[0], end)
+        handler = DatabaseHandler(write_behind=True, flush_interval_ms=60000)
+        try:
+            Internet.objects.create(download=1, upload=1, ping=1, unique_id=start)
+            with self.assertRaises(IntegrityError):
+                with transaction.atomic():
+                    Internet.objects.create(download=2, upload=2, ping=2, unique_id=start)
+            Internet.objects.create(download=3, upload=3, ping=3, unique_id=42) # Old ids may still repeat
+            Internet.objects.create(download=4, upload=4, ping=4, unique_id=42)
+
+            handler.save_measurement(5.0, 5.0, 5.0, None, 43.0, -76.0, start) # Duplicate speed test
+            handler.save_measurement(6.0, 6.0, 6.0, None, 43.0, -76.0, start + 1)
+            self.assertTrue(handler.flush())
+
+            self.assertEqual(Internet.objects.get(unique_id=start).download, 1)
+            self.assertEqual(Location.objects.get(unique_id=start + 1).latitude, 43.0)
+            self.assertEqual(handler.get_write_stats()["flush_errors"], 1)
+        finally:
+            handler.close()
+            Internet.objects.filter(unique_id__in=[start, start + 1]).delete()
+            Location.objects.filter(unique_id__in=[start, start + 1]).delete()
+
+    def test_retried_location_replaces_earlier_one(self):
+        """
+        Test if saving a location again for an allocated ID, directly or through a write-behind
+        batch, moves the stored location instead of failing on the unique constraint.
+        """
+        start, _ = self.db_handler.reserve_id_block(2)
+        handler = DatabaseHandler(write_behind=True, flush_interval_ms=60000)
+        try:
+            self.db_handler.save_location(43.0, -76.0, start)
+            self.db_handler.save_location(43.5, -76.5, start) # Retried request
+            handler.save_location(44.0, -77.0, start + 1)
+            handler.save_location(44.5, -77.5, start + 1) # Same batch
+            handler.save_location(45.0, -78.0, start) # Already in the database
+            self.assertTrue(handler.flush())
+
+            self.assertEqual(list(Location.objects.filter(unique_id=start).values_list("latitude", "longitude")), [(45.0, -78.0)])
+            self.assertEqual(list(Location.objects.filter(unique_id=start + 1).values_list("latitude", "longitude")), [(44.5, -77.5)])
+            self.assertEqual(Location.objects.get(unique_id=start).cell, spatial_cell(45.0, -78.0))
+            self.assertEqual(handler.get_write_stats()["flush_errors"], 0)
+        finally:
+            handler.close()
+            Location.objects.filter(unique_id__in=[start, start + 1]).delete()
+
+    def test_write_behind_flushes_full_batch(self):
+        """
+        Test if write-behind mode writes a batch as soon as it reaches the batch size,
+        without waiting for the flush interval.
+        """
+        handler = DatabaseHandler(write_behind=True, flush_interval_ms=60000, flush_batch_size=2)
+        try:
+            handler.save_speed_test(1.0, 1.0, 1.0, 42)
+            handler.save_speed_test(2.0, 2.0, 2.0, 43)
+
+            deadline = time.time() + 5
+            while Internet.objects.filter(unique_id__in=self.TEST_IDS).count() < 2 and time.time() < deadline:
+                time.sleep(0.01)
+
+            self.assertEqual(Internet.objects.filter(unique_id__in=self.TEST_IDS).count(), 2)
+            self.assertEqual(handler.get_write_stats()["flushes"], 1)
+        finally:
+            handler.close()
+
+    def test_write_behind_close_flushes_queue(self):
+        """
+        Test if closing the handler writes records that are still queued.
+        """
+        handler = DatabaseHandler(write_behind=True, flush_interval_ms=60000)
+        handler.save_location(43.0376, -76.1326, 43)
+
+        handler.close()
+
+        self.assertEqual(Location.objects.filter(unique_id=43).count(), 1)
+
+    def test_write_behind_failed_batch_written_per_item(self):
+        """
+        Test if a batch whose bulk insert fails for another reason than a constraint
+        is still written item by item instead of being dropped.
+        """
+        handler = DatabaseHandler(write_behind=True, flush_interval_ms=60000)
+        try:
+            handler.save_speed_test(1.0, 1.0, 1.0, 42)
+            handler.save_location(43.0376, -76.1326, 43)
+            with patch.object(Internet.objects, "bulk_create", side_effect=Exception("disk I/O error")):
+                self.assertTrue(handler.flush())
+
+            self.assertEqual(Internet.objects.filter(unique_id=42).count(), 1)
+            self.assertEqual(Location.objects.filter(unique_id=43).count(), 1)
+            self.assertEqual(handler.get_write_stats()["flush_errors"], 0)
+        finally:
+            handler.close()
+
+    def test_write_behind_flush_full_queue_times_out(self):
+        """
+        Test if flush and close give up after their timeout while the queue is full,
+        instead of blocking the caller.
+        """
+        handler = DatabaseHandler(write_behind=True, flush_interval_ms=60000, flush_batch_size=1, max_queue_size=1)
+        writing = threading.Event(); release = threading.Event()
+        write_batch = handler._write_batch
+        def slow_write_batch(batch):
+            writing.set(); release.wait(5); write_batch(batch)
+        handler._write_batch = slow_write_batch
+        try:
+            handler.save_speed_test(1.0, 1.0, 1.0, 42)
+            self.assertTrue(writing.wait(5)) # The writer is stuck on the first record
+            handler.save_speed_test(2.0, 2.0, 2.0, 43) # Fills the queue
+
+            started = time.monotonic()
+            self.assertFalse(handler.flush(timeout=0.1))
+            self.assertFalse(handler.close(timeout=0.1))
+            self.assertLess(time.monotonic() - started, 2)
+        finally:
+            release.set()
+            self.assertTrue(handler.close())
+        self.assertEqual(Internet.objects.filter(unique_id__in=self.TEST_IDS).count(), 2)
+
+    def test_reader_does_not_block_writer(self):
+        """
+        Test if a write commits promptly while another thread holds an open read,
+        which needs the WAL journal mode from the SQLite settings profile.
+        """
+        Internet.objects.create(download=1, upload=1, ping=1, unique_id=42)
+        Internet.objects.create(download=2, upload=2, ping=2, unique_id=42)
+        reading = threading.Event()
+        finished = threading.Event()
+
+        def hold_read():
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(f"SELECT id FROM {Internet._meta.db_table}")
+                    cursor.fetchone() # Leave the statement open so the read lock is held
+                    reading.set()
+                    finished.wait(10)
+            finally:
+                connection.close()
+
+        reader = threading.Thread(target=hold_read)
+        reader.start()
+        try:
+            self.assertTrue(reading.wait(5))
+            start_time = time.time()
+            Internet.objects.create(download=3, upload=3, ping=3, unique_id=43)
+            duration = time.time() - start_time
+        finally:
+            finished.set()
+            reader.join()
+
+        self.assertEqual(Internet.objects.filter(unique_id=43).count(), 1)
+        self.assertLess(duration, 1.0, msg = f"Write waited {duration} s behind an open read")
+
 if __name__ == '__main__':
     unittest.main()
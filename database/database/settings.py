@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -74,10 +75,38 @@ WSGI_APPLICATION = 'database.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+# SQLite concurrency profile, applied to every new connection.
+# WAL lets readers and the writer work at the same time, busy_timeout makes
+# writers wait for the lock instead of failing with "database is locked", and
+# synchronous=NORMAL only fsyncs at WAL checkpoints.
+SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE', '-65536'))  # Negative values are KiB (64 MiB)
+
+# Seconds to keep a connection open for reuse; None keeps it for the thread's lifetime
+SQLITE_CONN_MAX_AGE = os.environ.get('SQLITE_CONN_MAX_AGE')
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'CONN_MAX_AGE': None if SQLITE_CONN_MAX_AGE is None else int(SQLITE_CONN_MAX_AGE),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'timeout': SQLITE_BUSY_TIMEOUT_MS / 1000,
+            # Take the write lock at BEGIN so concurrent write transactions wait
+            # on busy_timeout rather than deadlocking on a lock upgrade
+            'transaction_mode': 'IMMEDIATE',
+            'init_command': (
+                f'PRAGMA journal_mode={SQLITE_JOURNAL_MODE};'
+                f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS};'
+                f'PRAGMA synchronous={SQLITE_SYNCHRONOUS};'
+                f'PRAGMA mmap_size={SQLITE_MMAP_SIZE};'
+                f'PRAGMA cache_size={SQLITE_CACHE_SIZE};'
+            ),
+        },
     }
 }
 
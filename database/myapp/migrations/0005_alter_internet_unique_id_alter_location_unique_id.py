@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0004_alter_internet_unique_id_alter_location_unique_id'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='internet',
+            name='unique_id',
+            field=models.IntegerField(db_index=True, default=100000),
+        ),
+        migrations.AlterField(
+            model_name='location',
+            name='unique_id',
+            field=models.IntegerField(db_index=True, default=100000),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0005_alter_internet_unique_id_alter_location_unique_id'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='internet',
+            name='download',
+            field=models.FloatField(),
+        ),
+        migrations.AlterField(
+            model_name='internet',
+            name='upload',
+            field=models.FloatField(),
+        ),
+        migrations.AlterField(
+            model_name='internet',
+            name='ping',
+            field=models.FloatField(),
+        ),
+        migrations.AlterField(
+            model_name='location',
+            name='latitude',
+            field=models.CharField(max_length=255, null=True),
+        ),
+        migrations.AlterField(
+            model_name='location',
+            name='longitude',
+            field=models.CharField(max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='location',
+            name='latitude_float',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='location',
+            name='longitude_float',
+            field=models.FloatField(null=True),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Converts the old CharField coordinates into the new float columns.
+# Rows are processed in primary key order, BATCH_SIZE at a time, so large
+# tables never have to be loaded into memory at once.
+
+from django.db import migrations
+
+BATCH_SIZE = 1000
+
+
+def to_float(value):
+    # Unparseable coordinates become NULL instead of aborting the migration
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def backfill_coordinates(apps, schema_editor):
+    Location = apps.get_model('myapp', 'Location')
+    last_pk = 0
+    while True:
+        batch = list(Location.objects.filter(pk__gt=last_pk).order_by('pk')[:BATCH_SIZE])
+        if not batch:
+            break
+        for location in batch:
+            location.latitude_float = to_float(location.latitude)
+            location.longitude_float = to_float(location.longitude)
+        Location.objects.bulk_update(batch, ['latitude_float', 'longitude_float'])
+        last_pk = batch[-1].pk
+
+
+def restore_coordinates(apps, schema_editor):
+    Location = apps.get_model('myapp', 'Location')
+    last_pk = 0
+    while True:
+        batch = list(Location.objects.filter(pk__gt=last_pk).order_by('pk')[:BATCH_SIZE])
+        if not batch:
+            break
+        for location in batch:
+            location.latitude = '' if location.latitude_float is None else str(location.latitude_float)
+            location.longitude = '' if location.longitude_float is None else str(location.longitude_float)
+        Location.objects.bulk_update(batch, ['latitude', 'longitude'])
+        last_pk = batch[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0006_internet_float_speeds_location_float_coordinates'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_coordinates, restore_coordinates),
+    ]
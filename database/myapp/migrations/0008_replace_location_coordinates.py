@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:12
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0007_backfill_float_coordinates'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='location',
+            name='latitude',
+        ),
+        migrations.RemoveField(
+            model_name='location',
+            name='longitude',
+        ),
+        migrations.RenameField(
+            model_name='location',
+            old_name='latitude_float',
+            new_name='latitude',
+        ),
+        migrations.RenameField(
+            model_name='location',
+            old_name='longitude_float',
+            new_name='longitude',
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0008_replace_location_coordinates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='internet',
+            name='jitter',
+            field=models.FloatField(null=True),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:27
+
+from django.db import migrations, models
+from django.db.models import Max
+
+FIRST_ALLOCATED_ID = 1000000
+
+
+def create_test_id_counter(apps, schema_editor):
+    # Start past every id already in use, so allocated ids never meet an old random one
+    IdCounter = apps.get_model('myapp', 'IdCounter')
+    highest = FIRST_ALLOCATED_ID - 1
+    for model_name in ('Internet', 'Location'):
+        model_highest = apps.get_model('myapp', model_name).objects.aggregate(highest=Max('unique_id'))['highest']
+        highest = max(highest, model_highest or 0)
+    IdCounter.objects.create(name='test_id', next_id=highest + 1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0009_internet_jitter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=32, unique=True)),
+                ('next_id', models.BigIntegerField()),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='internet',
+            constraint=models.UniqueConstraint(condition=models.Q(('unique_id__gte', 1000000)), fields=('unique_id',), name='internet_unique_allocated_id'),
+        ),
+        migrations.AddConstraint(
+            model_name='location',
+            constraint=models.UniqueConstraint(condition=models.Q(('unique_id__gte', 1000000)), fields=('unique_id',), name='location_unique_allocated_id'),
+        ),
+        migrations.RunPython(create_test_id_counter, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Adds the indexed time a speed test was saved. Existing rows keep NULL instead of
+# the migration time, so old tests never show up in a recent time window.
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0010_test_id_allocator'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='internet',
+            name='measured_at',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='internet',
+            name='measured_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, null=True),
+        ),
+    ]
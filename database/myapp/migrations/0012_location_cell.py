@@ -0,0 +1,36 @@
+# Adds the indexed spatial key to locations and fills it in for existing rows,
+# BATCH_SIZE at a time in primary key order like 0007.
+
+from django.db import migrations, models
+from myapp.spatial import spatial_cell
+
+BATCH_SIZE = 1000
+
+
+def backfill_cells(apps, schema_editor):
+    Location = apps.get_model('myapp', 'Location')
+    last_pk = 0
+    while True:
+        batch = list(Location.objects.filter(pk__gt=last_pk).order_by('pk')[:BATCH_SIZE])
+        if not batch:
+            break
+        for location in batch:
+            location.cell = spatial_cell(location.latitude, location.longitude)
+        Location.objects.bulk_update(batch, ['cell'])
+        last_pk = batch[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0011_internet_measured_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='location',
+            name='cell',
+            field=models.BigIntegerField(db_index=True, null=True),
+        ),
+        migrations.RunPython(backfill_cells, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Adds the "data_version" counter row. Every write bumps it, so heatmap caches in
+# separate worker processes can tell when the database has changed.
+
+from django.db import migrations
+
+
+def create_data_version_counter(apps, schema_editor):
+    # Bumped by every write, so worker processes can tell when cached payloads are stale
+    apps.get_model('myapp', 'IdCounter').objects.create(name='data_version', next_id=0)
+
+
+def delete_data_version_counter(apps, schema_editor):
+    apps.get_model('myapp', 'IdCounter').objects.filter(name='data_version').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0012_location_cell'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_data_version_counter, delete_data_version_counter),
+    ]
@@ -0,0 +1,24 @@
+# Adds the "rows_replaced" counter row. Bumped whenever a retried save replaces a stored
+# row in place, so /heatmap-data?since= clients know to reload instead of appending.
+
+from django.db import migrations
+
+
+def create_rows_replaced_counter(apps, schema_editor):
+    # Replaced rows keep their ids, so the delta cursor alone cannot show them
+    apps.get_model('myapp', 'IdCounter').objects.create(name='rows_replaced', next_id=0)
+
+
+def delete_rows_replaced_counter(apps, schema_editor):
+    apps.get_model('myapp', 'IdCounter').objects.filter(name='rows_replaced').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0013_data_version_counter'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_rows_replaced_counter, delete_rows_replaced_counter),
+    ]
@@ -1,20 +1,56 @@
 from django.db import models
+from django.utils import timezone
+from .spatial import spatial_cell
 
 # Create your models here.
 
+# Test ids from the block allocator start here, above the old random 100000-999999 ids,
+# and are enforced unique. Older rows may share ids and are left as they are.
+FIRST_ALLOCATED_ID = 1000000
+
 class Location(models.Model):
-    latitude = models.CharField(max_length=255)
-    longitude = models.CharField(max_length=255)
-    unique_id = models.IntegerField(default = 100000)
+    latitude = models.FloatField(null = True)
+    longitude = models.FloatField(null = True)
+    unique_id = models.IntegerField(default = 100000, db_index = True)
+    cell = models.BigIntegerField(null = True, db_index = True) # Spatial key of latitude/longitude, see spatial.py
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields = ["unique_id"], condition = models.Q(unique_id__gte = FIRST_ALLOCATED_ID),
+                                    name = "location_unique_allocated_id"),
+        ]
+
+    def save(self, *args, **kwargs):
+        # bulk_create skips this, so callers building rows for it set cell themselves
+        self.cell = spatial_cell(self.latitude, self.longitude)
+        super().save(*args, **kwargs)
 
     def __str__(self):
-        return self.latitude + ", " + self.longitude + f"\nid: {self.unique_id}"
+        return f"{self.latitude}, {self.longitude}\nid: {self.unique_id}"
 
 class Internet(models.Model):
-    download = models.IntegerField()
-    upload = models.IntegerField()
-    ping = models.IntegerField()
-    unique_id = models.IntegerField(default = 100000)
+    download = models.FloatField()
+    upload = models.FloatField()
+    ping = models.FloatField()
+    jitter = models.FloatField(null = True) # Only sent by /submit-measurement
+    measured_at = models.DateTimeField(null = True, db_index = True, default = timezone.now) # None for tests saved before it existed
+    unique_id = models.IntegerField(default = 100000, db_index = True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields = ["unique_id"], condition = models.Q(unique_id__gte = FIRST_ALLOCATED_ID),
+                                    name = "internet_unique_allocated_id"),
+        ]
+
+    def __str__(self):
+        return f"Download Speed: {self.download:.2f} Mbps\nUpload Speed: {self.upload:.2f} Mbps\nPing: {self.ping:.3f} ms\nid: {self.unique_id}"
+
+class IdCounter(models.Model):
+    # Named counters shared by all processes. "test_id" is the next unreserved test id,
+    # processes reserve ids in blocks by moving it forward. "data_version" is bumped by every write,
+    # "rows_replaced" by every retried save that replaced a stored row.
+    name = models.CharField(max_length = 32, unique = True)
+    next_id = models.BigIntegerField()
 
     def __str__(self):
-        return f"Download Speed: {self.download:.2f} Mbps\nUpload Speed: {self.upload:.2f} Mbps\nPing: {self.ping:.3f} ms\nid: {self.unique_id}"
\ No newline at end of file
+        return f"{self.name}: next id {self.next_id}"
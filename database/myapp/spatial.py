@@ -0,0 +1,69 @@
+# Spatial bucket keys for Location rows.
+# A key is the Z-order (Morton) interleaving of the latitude and longitude grid cells at
+# CELL_BITS bits per axis, so each quadtree cell at any coarser level is one contiguous
+# key range. A bounding box is covered by a few such ranges, each an index range scan.
+
+import math
+
+CELL_BITS = 30 # Bits per axis: 360 / 2**30 degrees, about 4 cm of longitude
+MAX_COVERING_CELLS = 64 # Cells used to cover a bounding box before moving up a level
+
+GRID_SIZE = 1 << CELL_BITS
+
+
+def _spread(value):
+    # Moves bit i of a 30 bit value to bit 2i
+    value &= GRID_SIZE - 1
+    value = (value | (value << 16)) & 0x0000FFFF0000FFFF
+    value = (value | (value << 8)) & 0x00FF00FF00FF00FF
+    value = (value | (value << 4)) & 0x0F0F0F0F0F0F0F0F
+    value = (value | (value << 2)) & 0x3333333333333333
+    value = (value | (value << 1)) & 0x5555555555555555
+    return value
+
+
+def interleave(x, y):
+    """Morton code of grid cell (x, y): x bits in the even positions, y bits in the odd ones."""
+    return _spread(x) | (_spread(y) << 1)
+
+
+def grid_cell(latitude, longitude):
+    """(x, y) grid cell of a coordinate, clamped to the grid."""
+    x = int((longitude + 180.0) / 360.0 * GRID_SIZE)
+    y = int((latitude + 90.0) / 180.0 * GRID_SIZE)
+    return min(max(x, 0), GRID_SIZE - 1), min(max(y, 0), GRID_SIZE - 1)
+
+
+def spatial_cell(latitude, longitude):
+    """Spatial key of a coordinate, or None if either value is missing or not a number."""
+    try:
+        latitude = float(latitude); longitude = float(longitude)
+    except (TypeError, ValueError):
+        return None
+    if not (math.isfinite(latitude) and math.isfinite(longitude)):
+        return None
+    return interleave(*grid_cell(latitude, longitude))
+
+
+def covering_ranges(min_lat, min_lon, max_lat, max_lon, max_cells=MAX_COVERING_CELLS):
+    """
+    Key ranges [(low, high), ...] (inclusive) whose cells cover the bounding box.
+    Uses the finest quadtree level at which the box needs at most max_cells cells,
+    and merges cells whose key ranges touch.
+    """
+    x0, y0 = grid_cell(min_lat, min_lon)
+    x1, y1 = grid_cell(max_lat, max_lon)
+    shift = 0
+    while ((x1 >> shift) - (x0 >> shift) + 1) * ((y1 >> shift) - (y0 >> shift) + 1) > max_cells:
+        shift += 1
+    prefixes = sorted(interleave(x, y)
+                      for x in range(x0 >> shift, (x1 >> shift) + 1)
+                      for y in range(y0 >> shift, (y1 >> shift) + 1))
+    ranges = []
+    for prefix in prefixes:
+        low = prefix << (2 * shift); high = ((prefix + 1) << (2 * shift)) - 1
+        if ranges and ranges[-1][1] + 1 == low:
+            ranges[-1][1] = high
+        else:
+            ranges.append([low, high])
+    return [tuple(key_range) for key_range in ranges]